@@ -0,0 +1,447 @@
+import numpy as np
+import sys
+import os
+import imp
+import time
+import json
+import shutil
+import socket
+import platform
+import resource
+import tempfile
+import argparse
+import multiprocessing
+import scipy
+import scipy.spatial
+import scipy.spatial.distance
+
+# jem_utilities imports pylab and the hist paths draw with it, so pick a
+# backend that works without a display before it is imported.
+import matplotlib
+matplotlib.use('Agg')
+
+import jem_utilities as jem
+
+################################################################################
+# Benchmark of the pair-counting paths on reproducible mock catalogs.
+#
+# The mocks fill a survey-like footprint in RA, Dec and redshift, either
+# uniformly or as Poisson-distributed clusters, and every path counts the
+# DD pairs of the same mock. Each path runs in its own process, so that the
+# memory peak of one does not leak into the next, and the counts are checked
+# against a brute-force cdist histogram for the smaller mocks.
+#
+#   python benchmark_pair_counts.py --sizes 1000,10000 --output bench.json
+#   python benchmark_pair_counts.py --sizes 1000,10000 --baseline bench.json
+################################################################################
+
+# Roughly the CMASS north footprint and redshift cut (see catalog_table).
+RA_RANGE = (120.,240.)
+DEC_RANGE = (0.,60.)
+Z_RANGE = (0.43,0.7)
+
+# Same cosmology as get_coordinates_with_weight.
+H0 = 70
+OM0 = 0.274
+
+PATHS = ['tree','grid','chunked','multipoles','hist','hist_grid']
+
+################################################################################
+def _distance_to_redshift(comdist):
+    """Invert the catalog distance (comoving_distance*H0/100) on a fine grid."""
+
+    # Stay inside the default distance table (z<=1), so that generating a
+    # mock never rebuilds it and the same seed always gives the same mock.
+    zz = np.linspace(0.,1.,4096)
+    dd = jem.comoving_distance(zz,H0=H0,Om0=OM0) * (H0/100.)
+
+    return np.interp(comdist,dd,zz)
+
+def _footprint(ra,dec,redshift):
+    """True for the points inside the footprint and redshift range."""
+
+    return ((ra>RA_RANGE[0])*(ra<RA_RANGE[1])*
+            (dec>DEC_RANGE[0])*(dec<DEC_RANGE[1])*
+            (redshift>Z_RANGE[0])*(redshift<Z_RANGE[1]))
+
+def uniform_mock(n,rng):
+    """RA, Dec (degrees) and redshift of n points spread uniformly in
+    comoving volume over the footprint.
+
+    Args:
+        n (int): Number of points.
+        rng (numpy.random.RandomState): Source of random numbers.
+
+    Returns:
+        ra, dec, redshift (numpy.ndarray)
+    """
+
+    ra = rng.uniform(RA_RANGE[0],RA_RANGE[1],n)
+    sindec = rng.uniform(np.sin(np.deg2rad(DEC_RANGE[0])),np.sin(np.deg2rad(DEC_RANGE[1])),n)
+    dec = np.rad2deg(np.arcsin(sindec))
+
+    # Uniform in volume, i.e. uniform in comdist**3.
+    dlo,dhi = jem.comoving_distance(np.array(Z_RANGE),H0=H0,Om0=OM0) * (H0/100.)
+    comdist = rng.uniform(dlo**3,dhi**3,n)**(1./3)
+    redshift = _distance_to_redshift(comdist)
+
+    # The edges of the distance grid can round just outside the cut.
+    redshift = np.clip(redshift,Z_RANGE[0]+1e-9,Z_RANGE[1]-1e-9)
+
+    return ra,dec,redshift
+
+def clustered_mock(n,rng,members=20.,sigma=5.):
+    """RA, Dec (degrees) and redshift of n points in Poisson clusters.
+
+    The cluster centers are spread uniformly over the footprint, each has a
+    Poisson number of members (mean members) scattered around it with a
+    Gaussian of width sigma in each of x, y and z, and members that land
+    outside the footprint are dropped (a Neyman-Scott process).
+
+    Args:
+        n (int): Number of points.
+        rng (numpy.random.RandomState): Source of random numbers.
+        members (float): Mean number of members per cluster.
+        sigma (float): Size of the clusters, in the units of the catalog
+                       distances (Mpc/h).
+
+    Returns:
+        ra, dec, redshift (numpy.ndarray)
+    """
+
+    ra = np.zeros(0)
+    dec = np.zeros(0)
+    redshift = np.zeros(0)
+    while len(ra)<n:
+        ncl = int((n-len(ra))/members)+1
+        cra,cdec,cz = uniform_mock(ncl,rng)
+        centers = jem.catalog_table(np.deg2rad(cra),np.deg2rad(cdec),cz,np.ones(ncl),
+                                    H0=H0,Om0=OM0)[4:7].T
+        nmem = rng.poisson(members,ncl)
+        xyz = np.repeat(centers,nmem,axis=0) + rng.normal(0.,sigma,(nmem.sum(),3))
+
+        comdist = np.sqrt((xyz*xyz).sum(axis=1))
+        mra = np.rad2deg(np.arctan2(xyz[:,1],xyz[:,0])) % 360.
+        mdec = np.rad2deg(np.arcsin(xyz[:,2]/comdist))
+        mz = _distance_to_redshift(comdist)
+        inside = _footprint(mra,mdec,mz)
+
+        ra = np.concatenate((ra,mra[inside]))
+        dec = np.concatenate((dec,mdec[inside]))
+        redshift = np.concatenate((redshift,mz[inside]))
+
+    # The members of a cluster are contiguous, so shuffle before cutting.
+    index = rng.permutation(len(ra))[0:n]
+
+    return ra[index],dec[index],redshift[index]
+
+def make_mock(kind,n,seed=1,outdir=None):
+    """Generate a mock, write it as a text catalog and convert it.
+
+    The text file has the ra,dec,redshift columns read_catalog expects,
+    written at full precision so reading it back gives exactly the same
+    coordinates as the in-memory conversion.
+
+    Args:
+        kind (str): 'uniform' or 'clustered'.
+        n (int): Number of points.
+        seed (int): Seed of the random numbers; the same kind, n and seed
+                    always give the same mock.
+        outdir (str): Directory for the text file (no file if None).
+
+    Returns:
+        coords (numpy.ndarray): x,y,z,weight,comdist columns, as from
+                                get_coordinates_with_weight(xyz=True).
+        filename (str): The text catalog, or None.
+    """
+
+    rng = np.random.RandomState(seed)
+    if kind=='uniform':
+        ra,dec,redshift = uniform_mock(n,rng)
+    elif kind=='clustered':
+        ra,dec,redshift = clustered_mock(n,rng)
+    else:
+        raise ValueError("Unrecognized mock %s (use uniform or clustered)" % (kind))
+
+    filename = None
+    if outdir is not None:
+        filename = os.path.join(outdir,'mock_%s_%d_%d.dat' % (kind,n,seed))
+        np.savetxt(filename,np.column_stack((ra,dec,redshift)),fmt='%.17g')
+
+    table = jem.catalog_table(np.deg2rad(ra),np.deg2rad(dec),redshift,np.ones(n),
+                              H0=H0,Om0=OM0)
+    coords = np.column_stack((table[4],table[5],table[6],table[3],table[7]))
+
+    return coords,filename
+
+################################################################################
+def brute_force_counts(coords,nbins=20,maxrange=200,blocksize=2000):
+    """Reference DD counts from every pairwise distance (scipy cdist).
+
+    Args:
+        coords (numpy.ndarray): x,y,z,weight columns.
+        nbins (int): Number of separation bins.
+        maxrange (float): Upper edge of the last bin; the first is at 0.
+        blocksize (int): Rows of the distance matrix held at a time.
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    edges = np.linspace(0,maxrange,nbins+1)
+    tot_freq = np.zeros(nbins)
+    for lo in xrange(0,len(coords),blocksize):
+        block = coords[lo:lo+blocksize]
+        other = coords[lo:]
+        dist = scipy.spatial.distance.cdist(block[:,0:3],other[:,0:3])
+        weight = np.outer(block[:,3],other[:,3])
+        # Each pair once: only the columns after the row's own galaxy.
+        upper = np.arange(len(other))[np.newaxis,:] > np.arange(len(block))[:,np.newaxis]
+        tot_freq += np.histogram(dist[upper],bins=edges,weights=weight[upper])[0]
+
+    return tot_freq
+
+################################################################################
+# The pair-counting paths. Each takes the mock and the binning and returns
+# the DD counts, or None if they are not comparable with the reference.
+################################################################################
+def _engine_path(engine):
+    def path(coords,filename,nbins,maxrange,nproc):
+        voxels0,voxels1,ngrids = jem.voxelize_the_data(coords,coords,maxsep=maxrange)[0:3]
+        return jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxrange,
+                                  samefile=True,engine=engine,nproc=nproc)
+    return path
+
+def _chunked_path(coords,filename,nbins,maxrange,nproc):
+    chunks = jem.CatalogChunks(filename,max(len(coords)//4,1),H0=H0,Om0=OM0,cache=False)
+    return jem.chunked_self_pair_counts(chunks,nbins=nbins,maxrange=maxrange)
+
+def _multipoles_path(coords,filename,nbins,maxrange,nproc):
+    # The in-house replacement for CUTE in research/lss; its first row is
+    # the monopole, i.e. the ordinary pair counts.
+    # It imports its sibling modules, so research/lss goes on the path.
+    lssdir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','lss')
+    if lssdir not in sys.path:
+        sys.path.append(lssdir)
+    cute = imp.load_source('cute_2ptcor',os.path.join(lssdir,'cute-2ptcor.py'))
+    counts = cute.paircount_multipoles(coords[:,0:3],coords[:,3],rmax=maxrange,nrbin=nbins)
+    return counts[0]
+
+def _hist_path(coords,filename,nbins,maxrange,nproc):
+    # The original chunked loop; a 2D histogram in a different cosmology,
+    # so it is timed but not checked.
+    jem.twopoint_hist(filename,filename,nbins,maxrange,oned=True)
+    return None
+
+def _hist_grid_path(coords,filename,nbins,maxrange,nproc):
+    # The original voxelized loop, also in the other cosmology.
+    jem.twopoint_hist_grid(filename,filename,nbins,maxrange,oned=True)
+    return None
+
+PATH_FUNCTIONS = {'tree':_engine_path('tree'),
+                  'grid':_engine_path('grid'),
+                  'chunked':_chunked_path,
+                  'multipoles':_multipoles_path,
+                  'hist':_hist_path,
+                  'hist_grid':_hist_grid_path}
+
+################################################################################
+def _peak_rss_mb():
+    """Largest resident set size of this process and its children, in MB."""
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kB, OS X bytes.
+    if sys.platform=='darwin':
+        return peak/1024.**2
+    return peak/1024.
+
+def _run_case(func,args,queue,quiet):
+    if quiet:
+        sys.stdout = open(os.devnull,'w')
+    try:
+        rss_start = _peak_rss_mb()
+        start = time.time()
+        counts = func(*args)
+        seconds = time.time()-start
+        queue.put((seconds,rss_start,_peak_rss_mb(),counts,None))
+    except Exception as err:
+        queue.put((None,None,None,None,'%s: %s' % (type(err).__name__,err)))
+
+def time_path(path,coords,filename,nbins=20,maxrange=200,nproc=1,quiet=True):
+    """Run one pair-counting path in a fresh process and time it.
+
+    The process is forked from this one, so it starts with the mock
+    already in memory; rss_start_mb is its size before counting.
+
+    Args:
+        path (str): One of PATHS.
+        coords (numpy.ndarray): The mock (see make_mock).
+        filename (str): The mock as a text catalog.
+        nbins, maxrange: The binning.
+        nproc (int): Processes for the tree and grid engines.
+        quiet (Boolean): Throw away what the path prints.
+
+    Returns:
+        result (dict): seconds, rss_start_mb, peak_rss_mb, counts and error.
+    """
+
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_case,
+                                   args=(PATH_FUNCTIONS[path],
+                                         (coords,filename,nbins,maxrange,nproc),
+                                         queue,quiet))
+    proc.start()
+    seconds,rss_start,peak,counts,error = queue.get()
+    proc.join()
+
+    return {'seconds':seconds,'rss_start_mb':rss_start,'peak_rss_mb':peak,
+            'counts':counts,'error':error}
+
+def compare_counts(counts,reference):
+    """Largest relative difference per bin, and whether it is at round-off."""
+
+    counts = np.asarray(counts,dtype=float)
+    diff = np.abs(counts-reference)/np.maximum(np.abs(reference),1.)
+    maxdiff = float(diff.max()) if len(diff)>0 else 0.
+
+    return maxdiff,bool(maxdiff<1e-9)
+
+################################################################################
+def compare_reports(report,baseline,tolerance=1.25):
+    """Print the change in run time of every case that is in both reports.
+
+    Returns:
+        regressions (list): The cases more than tolerance times slower.
+    """
+
+    old = {}
+    for case in baseline['cases']:
+        old[(case['mock'],case['n'],case['path'])] = case
+
+    regressions = []
+    print "%-10s %9s %-10s %10s %10s %7s" % ('mock','n','path','old (s)','new (s)','ratio')
+    for case in report['cases']:
+        prev = old.get((case['mock'],case['n'],case['path']))
+        if prev is None or case['seconds'] is None or not prev['seconds']:
+            continue
+        ratio = case['seconds']/prev['seconds']
+        flag = ''
+        if ratio>tolerance:
+            flag = '  <-- regression'
+            regressions.append(case)
+        print "%-10s %9d %-10s %10.3f %10.3f %7.2f%s" % (case['mock'],case['n'],case['path'],
+                                                           prev['seconds'],case['seconds'],
+                                                           ratio,flag)
+
+    return regressions
+
+################################################################################
+def main():
+
+    parser = argparse.ArgumentParser(description='Time the pair-counting paths on mock catalogs.')
+    parser.add_argument('--sizes', dest='sizes',default='1000,10000',help='Comma separated mock sizes, e.g. 1e3,1e4,1e5,1e6,1e7')
+    parser.add_argument('--mocks', dest='mocks',default='uniform,clustered',help='Comma separated mock kinds (uniform, clustered)')
+    parser.add_argument('--paths', dest='paths',default=','.join(PATHS),help='Comma separated paths to time (%s)' % (', '.join(PATHS)))
+    parser.add_argument('--seed', dest='seed',default=1,type=int,help='Seed for the mocks')
+    parser.add_argument('--nbins', dest='nbins',default=20,type=int,help='Number of separation bins')
+    parser.add_argument('--maxsep', dest='maxsep',default=200.,type=float,help='Maximum separation')
+    parser.add_argument('--nproc', dest='nproc',default=1,type=int,help='Processes for the tree and grid engines')
+    parser.add_argument('--brute-max', dest='brute_max',default=20000,type=int,help='Largest mock checked against the cdist reference')
+    parser.add_argument('--grid-max', dest='grid_max',default=1000000,type=int,help='Largest mock for the grid engine')
+    parser.add_argument('--legacy-max', dest='legacy_max',default=2000,type=int,help='Largest mock for the original hist and hist_grid loops')
+    parser.add_argument('--output', dest='output',default='benchmark_pair_counts.json',help='JSON report to write')
+    parser.add_argument('--baseline', dest='baseline',default=None,help='Earlier JSON report to compare the timings with')
+    parser.add_argument('--tolerance', dest='tolerance',default=1.25,type=float,help='Slowdown relative to the baseline flagged as a regression')
+    parser.add_argument('--keep-mocks', dest='keep_mocks',default=None,help='Write the mock catalogs to this directory and keep them')
+    parser.add_argument('--verbose', dest='verbose',default=False,action='store_true',help='Show what the paths print')
+    args=parser.parse_args()
+
+    sizes = [int(float(s)) for s in args.sizes.split(',')]
+    mocks = args.mocks.split(',')
+    paths = args.paths.split(',')
+    for path in paths:
+        if path not in PATH_FUNCTIONS:
+            raise ValueError("Unrecognized path %s (use %s)" % (path,', '.join(PATHS)))
+    limits = {'grid':args.grid_max,'hist':args.legacy_max,'hist_grid':args.legacy_max}
+
+    mockdir = args.keep_mocks
+    if mockdir is None:
+        mockdir = tempfile.mkdtemp(prefix='jem_bench_')
+    elif not os.path.isdir(mockdir):
+        os.makedirs(mockdir)
+
+    report = {'date':time.strftime('%Y-%m-%d %H:%M:%S'),
+              'host':socket.gethostname(),
+              'platform':platform.platform(),
+              'python':platform.python_version(),
+              'numpy':np.__version__,
+              'scipy':scipy.__version__,
+              'ncpu':multiprocessing.cpu_count(),
+              'settings':{'seed':args.seed,'nbins':args.nbins,'maxsep':args.maxsep,
+                          'nproc':args.nproc,'ra_range':RA_RANGE,'dec_range':DEC_RANGE,
+                          'z_range':Z_RANGE,'H0':H0,'Om0':OM0},
+              'cases':[]}
+
+    try:
+        for kind in mocks:
+            for n in sizes:
+                print "Generating %s mock with %d points...." % (kind,n)
+                start = time.time()
+                coords,filename = make_mock(kind,n,seed=args.seed,outdir=mockdir)
+                print "Time to generate mock %f" % (time.time()-start)
+
+                reference = None
+                brute_seconds = None
+                if n<=args.brute_max:
+                    start = time.time()
+                    reference = brute_force_counts(coords,nbins=args.nbins,maxrange=args.maxsep)
+                    brute_seconds = time.time()-start
+                    print "Time for brute force reference %f" % (brute_seconds)
+
+                for path in paths:
+                    if n>limits.get(path,n):
+                        print "Skipping %s for %d points" % (path,n)
+                        continue
+                    result = time_path(path,coords,filename,nbins=args.nbins,
+                                       maxrange=args.maxsep,nproc=args.nproc,
+                                       quiet=not args.verbose)
+                    case = {'mock':kind,'n':n,'path':path,
+                            'seconds':result['seconds'],
+                            'rss_start_mb':result['rss_start_mb'],
+                            'peak_rss_mb':result['peak_rss_mb'],
+                            'brute_seconds':brute_seconds,
+                            'error':result['error'],
+                            'max_rel_diff':None,'match':None}
+                    if result['counts'] is not None:
+                        case['counts'] = list(result['counts'])
+                        if reference is not None:
+                            case['max_rel_diff'],case['match'] = compare_counts(result['counts'],reference)
+                    report['cases'].append(case)
+
+                    if case['error'] is not None:
+                        print "%-10s %9d %-10s failed: %s" % (kind,n,path,case['error'])
+                    else:
+                        print "%-10s %9d %-10s %10.3f s %9.1f MB  match: %s" % (kind,n,path,case['seconds'],
+                                                                          case['peak_rss_mb'],case['match'])
+    finally:
+        if args.keep_mocks is None:
+            shutil.rmtree(mockdir)
+
+    with open(args.output,'w') as outfile:
+        json.dump(report,outfile,indent=1,sort_keys=True)
+    print "Wrote %s" % (args.output)
+
+    failed = [case for case in report['cases'] if case['error'] is not None or case['match'] is False]
+    if args.baseline is not None:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        failed += compare_reports(report,baseline,tolerance=args.tolerance)
+
+    if len(failed)>0:
+        print "%d case(s) failed or regressed" % (len(failed))
+        sys.exit(1)
+
+################################################################################
+if __name__=="__main__":
+    main()
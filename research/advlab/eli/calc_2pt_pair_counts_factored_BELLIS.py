@@ -10,12 +10,226 @@ import matplotlib.pylab as plt
 from astropy.cosmology import FlatLambdaCDM
 import time
 import argparse
+import os
 #import location
 
 import jem_utilities as jem
+import jem_kernels
 
 
+################################################################################
+def count_pairs(args,infilename0,infilename1,outfilename,samefile,nbins,maxsep,start,
+                checkpoint=None):
+    """Read the two catalogs and count the pairs.
+
+    Returns:
+        pair_counts (numpy.ndarray): The summed pair weights in each bin.
+        ngals0, ngals1 (int): Number of galaxies in each catalog.
+        tot_weights (tuple): tot_weight0, 1, 2 and 3 for the header.
+    """
+    # Assume reading in from a text file.
+    # Return x,y,z, weight and comoving distance. The conversion from
+    # ra,dec,z is done once per catalog and kept in the binary cache.
+    print "Reading in data...."
+    if args.chunksize>0 and args.jackknife is not None:
+        raise ValueError("--jackknife can not be combined with --chunksize")
+    if not args.oned and (args.chunksize>0 or args.jackknife is not None):
+        raise ValueError("--chunksize and --jackknife need --1d")
+    if args.chunksize>0:
+        # Stream the second catalog (the randoms) in chunks rather than
+        # holding it in memory. Its weights are all one.
+        print "Streaming ",infilename1
+        chunks1 = jem.CatalogChunks(infilename1,args.chunksize,cache=not args.no_cache)
+        w1 = np.ones(chunks1.ngals)
+        if samefile:
+            w0 = w1
+        else:
+            print "Opening ",infilename0
+            coords0 = jem.get_coordinates_with_weight(infilename0,xyz=True,cache=not args.no_cache)
+            w0 = coords0[:,3]
+    else:
+        print "Opening ",infilename0
+        coords0 = jem.get_coordinates_with_weight(infilename0,xyz=True,cache=not args.no_cache)
+        print "Opening ",infilename1
+        coords1 = jem.get_coordinates_with_weight(infilename1,xyz=True,cache=not args.no_cache)
+        w0 = coords0[:,3]
+        w1 = coords1[:,3]
+    print "Read in data......"
+    time_read = time.time()
+    print "Time to read in data %f" % (time_read - start)
+    print "Total execution time %f" % (time.time() - start)
+    time_convert = time.time()
+    print "Time to convert data %f" % (time_convert - time_read)
+    print "Total execution time %f" % (time.time() - start)
+
+    ngals0 = len(w0)
+    ngals1 = len(w1)
+
+    print "Ngals 0/1: ",ngals0,ngals0
+
+    ############################################################################
+    # Break up into voxels.
+    ############################################################################
+
+    #'''
+    if args.chunksize>0:
+        print "Performing the pair counts chunk by chunk...."
+        if samefile:
+            pair_counts = jem.chunked_self_pair_counts(chunks1,nbins=nbins,maxrange=maxsep)
+        else:
+            pair_counts = jem.chunked_pair_counts(coords0,chunks1,nbins=nbins,maxrange=maxsep)
+        time_pc = time.time()
+        print "Time to perform pair counts %f" % (time_pc - time_convert)
+        print "Total execution time %f" % (time.time() - start)
+    else:
+        if args.jackknife is not None:
+            # Tag each galaxy with its jackknife region, in an extra column.
+            nra,ndec = [int(n) for n in args.jackknife.split(',')]
+            nregions = nra*ndec
+            refcoords = jem.get_coordinates_with_weight(args.jackknife_ref or infilename1,xyz=True,cache=not args.no_cache)
+            jkedges = jem.jackknife_edges(*jem.xyz2radec(refcoords),nra=nra,ndec=ndec)
+            del refcoords
+            labels0 = jem.jackknife_labels(*jem.xyz2radec(coords0),edges=jkedges)
+            labels1 = jem.jackknife_labels(*jem.xyz2radec(coords1),edges=jkedges)
+            coords0 = np.column_stack((coords0,labels0))
+            coords1 = np.column_stack((coords1,labels1))
+
+        print "Breaking up into voxels..."
+        # ngrids tells you how many galaxies are along each axis. For the
+        # 2D counts the voxels must hold every pair inside the
+        # (r_perp, r_parallel) grid.
+        voxsep = maxsep
+        if not args.oned:
+            dmin = min(jem.mag(coords0[:,0:3]).min(),jem.mag(coords1[:,0:3]).min())
+            voxsep = jem.pair_search_radius(maxsep,maxsep,args.los,dmin)
+        voxels0,voxels1,ngrids,gridwidths,loranges,hiranges  = jem.voxelize_the_data(coords0,coords1,maxsep=voxsep)
+        time_vox = time.time()
+        print "Time to voxelize data %f" % (time_vox - time_convert)
+        print "Total execution time %f" % (time.time() - start)
+
+        print "Performing the pair counts...."
+        if args.jackknife is not None:
+            region_counts = jem.do_region_pair_counts(voxels0,voxels1,ngrids,nregions,nbins=nbins,maxrange=maxsep,samefile=samefile,nproc=args.nproc,nshards=args.nshards,checkpoint=checkpoint)
+            pair_counts = region_counts.sum(axis=(0,1))
+
+            jkfilename = outfilename + '.jackknife.npz'
+            print('Writing {}'.format(jkfilename))
+            np.savez(jkfilename,region_counts=region_counts,
+                     jackknife_counts=jem.jackknife_pair_counts(region_counts),
+                     tot_weights=jem.jackknife_weight_totals(w0,labels0,w1,labels1,nregions,samefile=samefile),
+                     edges=np.linspace(0,maxsep,nbins+1),ra_edges=jkedges[0],dec_edges=jkedges[1],
+                     ra_offset=jkedges[2])
+        elif args.oned:
+            pair_counts = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=samefile,nproc=args.nproc,nshards=args.nshards,checkpoint=checkpoint)
+        else:
+            pair_counts = jem.do_pair_counts_2d(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=samefile,nproc=args.nproc,convention=args.los,nshards=args.nshards,checkpoint=checkpoint)
+        time_pc = time.time()
+        print "PAIR COUNTS"
+        print  pair_counts.shape
+        print "Time to perform pair counts %f" % (time_pc - time_pc)
+        print "Total execution time %f" % (time.time() - start)
+    #'''
+
+    '''
+    # Alternatively (for small numbers, <10k)
+    coords0t=np.column_stack((coords0[:,0],coords0[:,1],coords0[:,2]))
+    coords1t=np.column_stack((coords1[:,0],coords1[:,1],coords1[:,2]))
+    print len(coords0t)
+    print len(coords0t[0])
+    #distances=scipy.spatial.distance.pdist(coords)
+    distances=scipy.spatial.distance.cdist(coords0t,coords1t)
+    #print np.sort(distances[distances<maxsep])
+    hist=np.histogram(distances,bins=nbins,range=(0,maxsep))
+    pair_counts = hist[0]
+    '''
+
+    # New way to normalize the weighting, in closed form
+    tot_weight0,tot_weight1,tot_weight2,tot_weight3 = jem.pair_weight_totals(w0,w1,samefile=samefile)
+
+    return pair_counts,ngals0,ngals1,(tot_weight0,tot_weight1,tot_weight2,tot_weight3)
+
+################################################################################
+def count_appended_pairs(args,parts,nbins,maxsep,start,keyargs,hashes=None):
+    """DD counts of a catalog and the batches appended to it, one batch at
+    a time.
 
+    The counts of each prefix parts[:k] are kept in the pair-count store,
+    with a record of what they were built from, so adding one more batch
+    only counts the pairs that involve it. hashes are the catalog_hash of
+    each part, if they are already known.
+
+    Returns:
+        pair_counts (numpy.ndarray): The summed pair weights in each bin.
+        ngals (int): Number of galaxies in all the parts together.
+        tot_weights (tuple): tot_weight0, 1, 2 and 3 for the header.
+    """
+
+    coords = []
+    for infilename in parts:
+        print "Opening ",infilename
+        coords.append(jem.get_coordinates_with_weight(infilename,xyz=True,cache=not args.no_cache))
+    print "Time to read in data %f" % (time.time() - start)
+
+    # Each part is hashed once, and only if the store is used.
+    keys = [None]*len(parts)
+    if not args.no_store:
+        if hashes is None:
+            hashes = [jem.catalog_hash(infilename) for infilename in parts]
+        ids = jem.prefix_catalog_ids(hashes)
+        for k in range(0,len(parts)):
+            keys[k] = jem.pair_count_key(parts[:k+1],parts[:k+1],catalog_ids=[ids[k],ids[k]],**keyargs)
+
+    # Start from the longest prefix that has already been counted.
+    first = 0
+    pair_counts = None
+    if not args.no_store:
+        for k in range(len(parts)-1,-1,-1):
+            stored = jem.load_pair_counts(keys[k][0])
+            if stored is not None:
+                print "Using stored pair counts %s for %s" % (keys[k][0],', '.join(parts[:k+1]))
+                pair_counts = stored[0]
+                first = k+1
+                break
+
+    if pair_counts is None:
+        print "Performing the pair counts for %s...." % (parts[0])
+        pair_counts = jem.tree_pair_counts(coords[0],coords[0],nbins=nbins,maxrange=maxsep,
+                                           samefile=True,nproc=args.nproc)
+        if not args.no_store:
+            provenance = {'method':'full','catalog':os.path.abspath(parts[0])}
+            save_appended_pairs(keys[0],pair_counts,coords[:1],provenance)
+        first = 1
+
+    for k in range(first,len(parts)):
+        print "Adding the pairs of %s (%d galaxies)...." % (parts[k],len(coords[k]))
+        pair_counts = jem.incremental_pair_counts(np.concatenate(coords[:k]),coords[k],pair_counts,
+                                                  nbins=nbins,maxrange=maxsep,nproc=args.nproc)
+        if not args.no_store:
+            provenance = {'method':'incremental','base':keys[k-1][0],
+                          'batch':os.path.abspath(parts[k]),
+                          'batch_hash':hashes[k],
+                          'batch_ngals':len(coords[k]),
+                          'date':time.strftime('%Y-%m-%d %H:%M:%S')}
+            save_appended_pairs(keys[k],pair_counts,coords[:k+1],provenance)
+    print "Time to perform pair counts %f" % (time.time() - start)
+
+    w = np.concatenate([c[:,3] for c in coords])
+
+    return pair_counts,len(w),jem.pair_weight_totals(w,w,samefile=True)
+
+def save_appended_pairs(key,pair_counts,coords,provenance):
+    """Store the counts of a prefix of the appended catalogs."""
+
+    w = np.concatenate([c[:,3] for c in coords])
+    meta = dict(key[1])
+    meta['ngals'] = [len(w),len(w)]
+    meta['tot_weights'] = list(jem.pair_weight_totals(w,w,samefile=True))
+    meta['provenance'] = provenance
+    storefile = jem.save_pair_counts(key[0],pair_counts,meta)
+    if storefile is not None:
+        print "Saved pair counts to %s" % (storefile)
+
+################################################################################
 def main():
     """Given command-line arguments, will return
         frequency arrays for galactic distances.
@@ -34,11 +248,27 @@ def main():
     parser.add_argument('--lado', dest='lado',default=False,action='store_true',help='Use Lado\'s calculations')
     parser.add_argument('--pysurvey', dest='pysurvey',default=False,action='store_true',help='Use pysurvey\'s calculations')
     parser.add_argument('--1d', dest='oned',default=False,action='store_true',help='One dimensional function')
+    parser.add_argument('--los', dest='los',default=None,choices=jem_kernels.CONVENTIONS,help='Line of sight for the r_perp, r_parallel counts (default midpoint, or lado with --lado)')
+    parser.add_argument('--no-cache', dest='no_cache',default=False,action='store_true',help='Do not read or write the binary catalog cache')
+    parser.add_argument('--no-store', dest='no_store',default=False,action='store_true',help='Do not reuse or save pair counts in the pair-count store')
+    parser.add_argument('--chunksize', dest='chunksize',default=0,type=int,help='Stream the second catalog in chunks of this many rows (0 reads it all at once)')
+    parser.add_argument('--jackknife', dest='jackknife',default=None,help='Also count pairs per pair of NRA,NDEC jackknife regions (e.g. 4,4)')
+    parser.add_argument('--jackknife-ref', dest='jackknife_ref',default=None,help='Catalog that defines the jackknife regions (default: infile2); use the same one for DD, DR and RR')
+    parser.add_argument('--nshards', dest='nshards',default=None,type=int,help='Number of pieces the pair counts are cut into and checkpointed by (default 16 with --checkpoint, otherwise 4 per process)')
+    parser.add_argument('--checkpoint', dest='checkpoint',default=False,action='store_true',help='Save the finished pieces of the pair counts, so that a killed run can be continued with --resume')
+    parser.add_argument('--resume', dest='resume',default=False,action='store_true',help='Continue from the checkpoint of a run that was killed (implies --checkpoint)')
+    parser.add_argument('--nproc', dest='nproc',default=1,type=int,help='Number of processes to use for the pair counts')
+    parser.add_argument('--append', dest='append',default=None,action='append',help='A batch of galaxies appended to the catalog (DD with --1d only; can be given more than once); only the pairs involving the batch are counted')
     args=parser.parse_args()
 
     if args.no_plots:
         plt.switch_backend('Agg')
 
+    if args.los is None:
+        args.los = 'midpoint'
+        if args.lado:
+            args.los = 'lado'
+
     infilename0 = args.infile1
     infilename1 = args.infile2
 
@@ -50,87 +280,84 @@ def main():
     if (infilename0==infilename1):
         samefile = True
 
-    # Assume reading in from a text file.
-    # Return ra,dec (in radians), redshift z, and weight.
-    start = time.time()
-    print "Reading in data...."
-    print "Opening ",infilename0
-    coords0 = jem.get_coordinates_with_weight(infilename0)
-    print "Opening ",infilename1
-    coords1 = jem.get_coordinates_with_weight(infilename1)
-    print "Read in data......"
-    time_read = time.time()
-    print "Time to read in data %f" % (time_read - start)
-    print "Total execution time %f" % (time.time() - start)
-
-    # Convert to x,y,z
-    print "Converting to x,y,z...."
-    coords0 = jem.radecredshift2xyz_with_weights(coords0)
-    coords1 = jem.radecredshift2xyz_with_weights(coords1)
-    time_convert = time.time()
-    print "Time to convert data %f" % (time_convert - time_read)
-    print "Total execution time %f" % (time.time() - start)
-
-    ngals0 = len(coords0)
-    ngals1 = len(coords1)
-
-    print "Ngals 0/1: ",ngals0,ngals0
-
-    ############################################################################
-    # Break up into voxels.
-    ############################################################################
-
     maxsep=200
     nbins=20
-    #'''
-    print "Breaking up into voxels..."
-    # ngrids tells you how many galaxies are along each axis. 
-    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges  = jem.voxelize_the_data(coords0,coords1,maxsep=maxsep)
-    time_vox = time.time()
-    print "Time to voxelize data %f" % (time_vox - time_convert)
-    print "Total execution time %f" % (time.time() - start)
-
-    print "Performing the pair counts...."
-    pair_counts = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=samefile)
-    #pair_counts = jem.do_pair_counts_2d(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=samefile)
-    time_pc = time.time()
-    print "PAIR COUNTS"
-    print  pair_counts.shape
-    print "Time to perform pair counts %f" % (time_pc - time_pc)
-    print "Total execution time %f" % (time.time() - start)
-    #'''
-
-    '''
-    # Alternatively (for small numbers, <10k)
-    coords0t=np.column_stack((coords0[:,0],coords0[:,1],coords0[:,2]))
-    coords1t=np.column_stack((coords1[:,0],coords1[:,1],coords1[:,2]))
-    print len(coords0t)
-    print len(coords0t[0])
-    #distances=scipy.spatial.distance.pdist(coords)
-    distances=scipy.spatial.distance.cdist(coords0t,coords1t)
-    #print np.sort(distances[distances<maxsep])
-    hist=np.histogram(distances,bins=nbins,range=(0,maxsep))
-    pair_counts = hist[0]
-    '''
-
-    # New way to normalize the weighting
-    tot_weight2 = 0.
-    w0 = coords0.transpose()[3]
-    w1 = coords1.transpose()[3]
-    for i in w0:
-       tot_weight2 += (i*w1).sum()
+    start = time.time()
 
-    #'''
-    if samefile==True:
-        tot_weight2 -= (w0*w1).sum()
-        tot_weight2 /= 2.
-        tot_weight3 = (w0*w1).sum()
+    # The counts only depend on the catalogs, the cosmology, the binning and
+    # the weights, so take them from the pair-count store if this exact
+    # combination has been counted before.
+    edges = np.linspace(0,maxsep,nbins+1)
+    los = None
+    if not args.oned:
+        edges = [edges,edges]
+        los = args.los
+    keyargs = {'edges':edges,'samefile':samefile,
+               'cosmology':{'H0':70,'Om0':0.274},
+               'weights':'unit',
+               'selection':{'zmin':0.43,'zmax':0.7},
+               'los':los}
+
+    # Hashing the catalogs reads them in full, so only do it if the store is
+    # used. The jackknife region counts are not kept in the store.
+    use_store = not args.no_store and args.jackknife is None
+    if args.append is not None:
+        if not samefile or not args.oned or args.jackknife is not None or args.chunksize>0:
+            raise ValueError("--append only works for DD counts with --1d, without --jackknife or --chunksize")
+        parts = [infilename0] + args.append
+
+    stored = None
+    hashes = None
+    if use_store:
+        if args.append is not None:
+            hashes = [jem.catalog_hash(infilename) for infilename in parts]
+            catalog_id = jem.prefix_catalog_ids(hashes)[-1]
+            key,description = jem.pair_count_key(parts,parts,catalog_ids=[catalog_id,catalog_id],**keyargs)
+        else:
+            key,description = jem.pair_count_key(infilename0,infilename1,**keyargs)
+        stored = jem.load_pair_counts(key)
+
+    # Save the finished shards of the pair counts as they come in, so that
+    # a killed run can be picked up again with --resume.
+    checkpoint = None
+    if (args.checkpoint or args.resume) and (args.chunksize>0 or args.append is not None):
+        raise ValueError("--checkpoint and --resume can not be combined with --chunksize or --append")
+    if args.checkpoint or args.resume:
+        if args.nshards is None:
+            args.nshards = 16
+        # Identify the run by the files and the binning. The region labels
+        # also depend on the catalog that defines them.
+        jkref = None
+        if args.jackknife is not None:
+            jkref = jem.catalog_stamp(args.jackknife_ref or infilename1)
+        ckkey = '%s|%s|%d|%d|%s|%s|%s|%s|%d' % (jem.catalog_stamp(infilename0),jem.catalog_stamp(infilename1),
+                                               maxsep,nbins,args.oned,los,args.jackknife,jkref,args.nshards)
+        checkpoint = jem.Checkpoint(outfilename+'.checkpoint.npz',key=ckkey,
+                                    resume=args.resume)
+
+    if stored is not None:
+        print "Using stored pair counts %s" % (key)
+        pair_counts,meta = stored
+        ngals0,ngals1 = meta['ngals']
+        tot_weight0,tot_weight1,tot_weight2,tot_weight3 = meta['tot_weights']
+    elif args.append is not None:
+        # Saved in the store along the way, with their provenance.
+        pair_counts,ngals0,tot_weights = count_appended_pairs(args,parts,nbins,maxsep,start,keyargs,
+                                                              hashes=hashes)
+        ngals1 = ngals0
+        tot_weight0,tot_weight1,tot_weight2,tot_weight3 = tot_weights
     else:
-        tot_weight3 = 1.0 # Otherwise, not necessarily the same size.
-    #'''
-
-    tot_weight0 = w0.sum()
-    tot_weight1 = w1.sum()
+        pair_counts,ngals0,ngals1,tot_weights = count_pairs(args,infilename0,infilename1,outfilename,
+                                                            samefile,nbins,maxsep,start,
+                                                            checkpoint=checkpoint)
+        tot_weight0,tot_weight1,tot_weight2,tot_weight3 = tot_weights
+        if use_store:
+            meta = dict(description)
+            meta['ngals'] = [ngals0,ngals1]
+            meta['tot_weights'] = list(tot_weights)
+            storefile = jem.save_pair_counts(key,pair_counts,meta)
+            if storefile is not None:
+                print "Saved pair counts to %s" % (storefile)
 
     print "Tot weight calc the new way: %f %f %f %f" % (tot_weight2,tot_weight0,tot_weight1,tot_weight3)
 
@@ -140,26 +367,32 @@ def main():
     #print "Sum: ",sum(pair_counts)
 
 
-    # Do this for the 1D
-    xvals = np.linspace(0,maxsep,nbins+1) # THIS IS PROBABLY NOT EXACTLY CORRECT
+    # Bin edges (along both axes for the 2D counts).
+    xvals = np.linspace(0,maxsep,nbins+1)
 
     if args.no_plots==False:
         print 'Final Plot'    
-        plt.plot(xvals[0:nbins],pair_counts,'k.')
+        if args.oned:
+            plt.plot(xvals[0:nbins],pair_counts,'k.')
+        else:
+            plt.imshow(pair_counts.T,origin='lower',extent=(0,maxsep,0,maxsep))
+            plt.xlabel(r'$r_\perp$')
+            plt.ylabel(r'$r_\parallel$')
 
         plt.show()
 
     if args.oned==False:
+        # Same header as the 1D files; each following line is
+        # perp_lo,perp_hi,para_lo,para_hi,count,0 with r_parallel varying
+        # fastest (see jem_estimators.read_pair_counts_2d).
         print('Writing {}'.format(outfilename))
         outfile = open(outfilename,"w")
-        line_one = np.zeros(nbins)
-        line_one = np.insert(line_one,0,ngals0)
-        line_one = np.insert(line_one,1,ngals1)
-        output = line_one
-        outfile.write(output)
-        output = pair_counts
-        print output
+        output = "%d,%d,%f,%f,%f,%f\n" % (ngals0,ngals1,tot_weight0,tot_weight1,tot_weight2,tot_weight3)
         outfile.write(output)
+        for i in xrange(nbins):
+            for j in xrange(nbins):
+                output = "%f,%f,%f,%f,%f,0\n" % (xvals[i],xvals[i+1],xvals[j],xvals[j+1],pair_counts[i,j])
+                outfile.write(output)
         outfile.close()
 
     else:
@@ -173,6 +406,9 @@ def main():
             outfile.write(output)
         outfile.close()
 
+    if checkpoint is not None:
+        checkpoint.remove()
+
     print "Finished writing out data."
     print "Total execution time %f" % (time.time() - start)
 
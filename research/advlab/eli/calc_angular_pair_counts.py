@@ -0,0 +1,92 @@
+import numpy as np
+import time
+import argparse
+import matplotlib.pylab as plt
+
+import jem_utilities as jem
+
+################################################################################
+# Angular (w(theta)) pair counts for photometric catalogs.
+#
+# Writes the same format as calc_2pt_pair_counts_factored_BELLIS.py --1d,
+# with the bins in degrees, so the DD, DR and RR files go straight into
+# jem_estimators.xi_from_files (or twopoint_1D.py) to give w(theta).
+################################################################################
+def main():
+    """Given command-line arguments, will write the angular pair counts
+        of two catalogs.
+    """
+    parser= argparse.ArgumentParser()
+    parser.add_argument("infile1", help="Photometric data or random catalog (RA, Dec in degrees)")
+    parser.add_argument("infile2", help="Photometric data or random catalog (RA, Dec in degrees)")
+    parser.add_argument("--outfilename", default='default.dat', help="Outfile name")
+    parser.add_argument('--no-plots', dest='no_plots', default=False,action='store_true', help='do not generate plots')
+    parser.add_argument('--nbins', dest='nbins',default=20,type=int,help='Number of theta bins')
+    parser.add_argument('--theta-min', dest='theta_min',default=0.01,type=float,help='Lower edge of the first bin in degrees')
+    parser.add_argument('--theta-max', dest='theta_max',default=10.,type=float,help='Upper edge of the last bin in degrees')
+    parser.add_argument('--linear', dest='linear',default=False,action='store_true',help='Evenly spaced bins in theta instead of in log(theta)')
+    parser.add_argument('--engine', dest='engine',default='tree',choices=['tree','grid'],help='Pair counting engine')
+    parser.add_argument('--nproc', dest='nproc',default=1,type=int,help='Number of processes for the grid engine')
+    args=parser.parse_args()
+
+    if args.no_plots:
+        plt.switch_backend('Agg')
+
+    infilename0 = args.infile1
+    infilename1 = args.infile2
+    outfilename = args.outfilename
+
+    # Check to see if we are using the same file for both (DD or RR)
+    # or if they are different (DR)
+    samefile = (infilename0==infilename1)
+
+    if args.linear:
+        theta_edges = np.linspace(args.theta_min,args.theta_max,args.nbins+1)
+        theta_mid = (theta_edges[1:]+theta_edges[:-1])/2.
+    else:
+        theta_edges = np.logspace(np.log10(args.theta_min),np.log10(args.theta_max),args.nbins+1)
+        theta_mid = np.sqrt(theta_edges[1:]*theta_edges[:-1])
+
+    start = time.time()
+
+    print "Opening ",infilename0
+    ra0,dec0,w0 = jem.read_angular_catalog(infilename0)
+    coords0 = jem.radec2unit(ra0,dec0,w0)
+    if samefile:
+        coords1 = coords0
+    else:
+        print "Opening ",infilename1
+        ra1,dec1,w1 = jem.read_angular_catalog(infilename1)
+        coords1 = jem.radec2unit(ra1,dec1,w1)
+    w0 = coords0[:,3]
+    w1 = coords1[:,3]
+    ngals0 = len(w0)
+    ngals1 = len(w1)
+    print "Ngals 0/1: ",ngals0,ngals1
+    print "Time to read in data %f" % (time.time() - start)
+
+    print "Performing the pair counts...."
+    pair_counts = jem.angular_pair_counts(coords0,coords1,theta_edges,samefile=samefile,
+                                          engine=args.engine,nproc=args.nproc)
+
+    tot_weight0,tot_weight1,tot_weight2,tot_weight3 = jem.pair_weight_totals(w0,w1,samefile=samefile)
+
+    if args.no_plots==False:
+        plt.loglog(theta_mid,pair_counts,'k.')
+        plt.xlabel(r'$\theta$ (degrees)')
+        plt.show()
+
+    print('Writing {}'.format(outfilename))
+    outfile = open(outfilename,"w")
+    output = "%d,%d,%f,%f,%f,%f\n" % (ngals0,ngals1,tot_weight0,tot_weight1,tot_weight2,tot_weight3)
+    outfile.write(output)
+    for i in xrange(args.nbins):
+        output = "%.8g,%.8g,%.8g,%f,0,0\n" % (theta_edges[i],theta_mid[i],theta_edges[i+1],pair_counts[i])
+        outfile.write(output)
+    outfile.close()
+
+    print "Total execution time %f" % (time.time() - start)
+
+################################################################################
+if __name__=='__main__':
+    main()
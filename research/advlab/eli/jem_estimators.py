@@ -0,0 +1,235 @@
+import numpy as np
+
+################################################################################
+# Two-point correlation function estimators.
+#
+# Everything here works on pair counts that are already in memory. The
+# counts can be a single histogram, a stack of mock realizations or a stack
+# of jackknife realizations: the bins are always the trailing axes and any
+# leading axes are realizations, so all of them are handled in one go.
+################################################################################
+
+ESTIMATORS = ['LS','Hamilton','DP','natural']
+
+def normalize_counts(counts,norm):
+    """Divide pair counts by their total pair weight.
+
+    Args:
+        counts (numpy.ndarray): Pair counts, bins on the trailing axes.
+        norm (float or numpy.ndarray): Total pair weight, one per
+                                       realization (the leading axes).
+
+    Returns:
+        normed (numpy.ndarray): counts/norm.
+    """
+
+    counts = np.asarray(counts,dtype=float)
+    norm = np.asarray(norm,dtype=float)
+    norm = norm.reshape(norm.shape + (1,)*(counts.ndim-norm.ndim))
+
+    return counts/norm
+
+def _ratio(num,den):
+    """num/den, and 0 wherever den is 0."""
+
+    return (num/(den+(den==0)))*(den!=0)
+
+def xi_estimator(DD,DR,RR,norm_dd=1.,norm_dr=1.,norm_rr=1.,estimator='LS'):
+    """Correlation function from DD, DR and RR pair counts.
+
+    The counts are normalized by their total pair weights first (see
+    pair_weight_totals in jem_utilities, or the headers written by the
+    pair-count drivers); leave the norms at 1 if they already are.
+    Bins where the denominator is empty are set to 0.
+
+    Args:
+        DD, DR, RR (numpy.ndarray): Pair counts, bins on the trailing axes
+                                    and realizations on any leading axes.
+        norm_dd, norm_dr, norm_rr (float or numpy.ndarray): Total pair
+                                   weights, one per realization.
+        estimator (str): 'LS' (Landy-Szalay), 'Hamilton', 'DP'
+                         (Davis-Peebles) or 'natural'.
+
+    Returns:
+        xi (numpy.ndarray): Same shape as the counts.
+    """
+
+    dd = normalize_counts(DD,norm_dd)
+    dr = normalize_counts(DR,norm_dr)
+    rr = normalize_counts(RR,norm_rr)
+
+    if estimator=='LS':
+        xi = _ratio(dd - 2*dr + rr,rr)
+    elif estimator=='Hamilton':
+        xi = _ratio(dd*rr,dr*dr) - (dr!=0)
+    elif estimator=='DP':
+        xi = _ratio(dd,dr) - (dr!=0)
+    elif estimator=='natural':
+        xi = _ratio(dd,rr) - (rr!=0)
+    else:
+        raise ValueError("Unrecognized estimator %s (use one of %s)" % (estimator,', '.join(ESTIMATORS)))
+
+    return xi
+
+def covariance(xi,jackknife=False):
+    """Covariance of the bins over a stack of realizations.
+
+    Args:
+        xi (numpy.ndarray): Realizations along axis 0, bins on the others.
+        jackknife (Boolean): If true, the realizations are leave-one-out
+                             jackknife samples and the covariance is
+                             scaled by (N-1)/N instead of 1/(N-1).
+
+    Returns:
+        mean (numpy.ndarray): Mean over the realizations.
+        cov (numpy.ndarray): nbins x nbins covariance, with the bins
+                             flattened in C order.
+    """
+
+    nreal = xi.shape[0]
+    flat = xi.reshape(nreal,-1)
+    mean = flat.mean(axis=0)
+    resid = flat - mean
+
+    if jackknife:
+        scale = (nreal-1.)/nreal
+    else:
+        scale = 1./(nreal-1.)
+    cov = scale*np.dot(resid.T,resid)
+
+    return mean.reshape(xi.shape[1:]),cov
+
+def xi_with_covariance(DD,DR,RR,norm_dd=1.,norm_dr=1.,norm_rr=1.,
+                       estimator='LS',jackknife=False):
+    """Correlation function for every realization, its mean and covariance.
+
+    Args:
+        DD, DR, RR (numpy.ndarray): Stacks of pair counts, realizations
+                                    along axis 0.
+        norm_dd, norm_dr, norm_rr (numpy.ndarray): Total pair weights of
+                                                   each realization.
+        estimator (str): See xi_estimator.
+        jackknife (Boolean): See covariance.
+
+    Returns:
+        xi (numpy.ndarray): xi of each realization.
+        mean (numpy.ndarray): Mean xi.
+        cov (numpy.ndarray): Covariance of xi.
+    """
+
+    xi = xi_estimator(DD,DR,RR,norm_dd,norm_dr,norm_rr,estimator=estimator)
+    mean,cov = covariance(xi,jackknife=jackknife)
+
+    return xi,mean,cov
+
+################################################################################
+# Reading pair counts written by calc_2pt_pair_counts_factored_BELLIS.py
+################################################################################
+def read_pair_counts(filename):
+    """Read a 1D pair-count file written with --1d.
+
+    The first line is ngals0,ngals1,tot_weight0,tot_weight1,tot_weight2,
+    tot_weight3 and each following line is lo,mid,hi,count,0,0.
+
+    Args:
+        filename (str): The pair-count file.
+
+    Returns:
+        rmid (numpy.ndarray): Bin centers.
+        counts (numpy.ndarray): Pair counts.
+        norm (float): Total pair weight (tot_weight2).
+        header (numpy.ndarray): The six numbers on the first line.
+    """
+
+    table = np.loadtxt(filename,dtype='float',delimiter=',',ndmin=2)
+
+    return table[1:,1],table[1:,3],table[0,4],table[0]
+
+def read_pair_counts_2d(filename):
+    """Read a 2D (r_perp, r_parallel) pair-count file written without --1d.
+
+    The first line is the same as for read_pair_counts and each following
+    line is perp_lo,perp_hi,para_lo,para_hi,count,0, with r_parallel
+    varying fastest.
+
+    Args:
+        filename (str): The pair-count file.
+
+    Returns:
+        perp_edges, para_edges (numpy.ndarray): Bin edges.
+        counts (numpy.ndarray): nperp x npara pair counts.
+        norm (float): Total pair weight (tot_weight2).
+        header (numpy.ndarray): The six numbers on the first line.
+    """
+
+    table = np.loadtxt(filename,dtype='float',delimiter=',',ndmin=2)
+    bins = table[1:]
+    perp_edges = np.append(np.unique(bins[:,0]),bins[:,1].max())
+    para_edges = np.append(np.unique(bins[:,2]),bins[:,3].max())
+    counts = bins[:,4].reshape(len(perp_edges)-1,len(para_edges)-1)
+
+    return perp_edges,para_edges,counts,table[0,4],table[0]
+
+def read_jackknife_counts(filename):
+    """Read the jackknife realizations written with --jackknife.
+
+    Returns:
+        counts (numpy.ndarray): nregions x nbins counts with each region
+                                left out in turn.
+        norm (numpy.ndarray): Total pair weight of each realization.
+    """
+
+    stored = np.load(filename)
+    counts = stored['jackknife_counts']
+    norm = stored['tot_weights'][:,2]
+    stored.close()
+
+    return counts,norm
+
+def xi_from_files(ddfile,drfile,rrfile,estimator='LS',jackknife=False):
+    """Correlation function from the DD, DR and RR files of the driver.
+
+    Args:
+        ddfile, drfile, rrfile (str): Pair-count files (see
+                                      read_pair_counts).
+        estimator (str): See xi_estimator.
+        jackknife (Boolean): If true, also read <file>.jackknife.npz for
+                             each term and return the jackknife
+                             covariance.
+
+    Returns:
+        rmid (numpy.ndarray): Bin centers.
+        xi (numpy.ndarray): The correlation function.
+        cov (numpy.ndarray): Its jackknife covariance (only if jackknife).
+    """
+
+    rmid,DD,norm_dd,header = read_pair_counts(ddfile)
+    DR,norm_dr = read_pair_counts(drfile)[1:3]
+    RR,norm_rr = read_pair_counts(rrfile)[1:3]
+    xi = xi_estimator(DD,DR,RR,norm_dd,norm_dr,norm_rr,estimator=estimator)
+
+    if not jackknife:
+        return rmid,xi
+
+    counts = [read_jackknife_counts(f+'.jackknife.npz') for f in (ddfile,drfile,rrfile)]
+    xi_jk,mean,cov = xi_with_covariance(counts[0][0],counts[1][0],counts[2][0],
+                                        counts[0][1],counts[1][1],counts[2][1],
+                                        estimator=estimator,jackknife=True)
+
+    return rmid,xi,cov
+
+def xi_from_files_2d(ddfile,drfile,rrfile,estimator='LS'):
+    """Correlation function in (r_perp, r_parallel) bins from the 2D DD, DR
+    and RR files of the driver (see read_pair_counts_2d).
+
+    Returns:
+        perp_edges, para_edges (numpy.ndarray): Bin edges.
+        xi (numpy.ndarray): nperp x npara correlation function.
+    """
+
+    perp_edges,para_edges,DD,norm_dd = read_pair_counts_2d(ddfile)[0:4]
+    DR,norm_dr = read_pair_counts_2d(drfile)[2:4]
+    RR,norm_rr = read_pair_counts_2d(rrfile)[2:4]
+    xi = xi_estimator(DD,DR,RR,norm_dd,norm_dr,norm_rr,estimator=estimator)
+
+    return perp_edges,para_edges,xi
@@ -0,0 +1,242 @@
+import numpy as np
+
+################################################################################
+# Line-of-sight decomposition of galaxy pairs.
+#
+# Every pair is split into its separation s, the cosine mu of the angle
+# between the separation and the line of sight, and the components r_par
+# and r_perp along and across the line of sight. The conventions are:
+#
+#   'midpoint'  the line of sight is r0+r1, the direction to the midpoint
+#               of the pair (our_para_perp_with_weights).
+#   'lado'      the line of sight bisects the directions to the two
+#               galaxies, r0/|r0| + r1/|r1| (lado_para_perp).
+#   'angular'   r_perp is the angle between the galaxies times the distance
+#               to the first one and r_par the difference of their
+#               distances (one_dimension_trial); s is sqrt(r_par^2+r_perp^2).
+#
+# The kernels work on whole blocks of pairs and write into buffers that are
+# allocated once and reused, so the inner loops of the pair counters do not
+# create a new set of temporaries for every tile.
+################################################################################
+
+CONVENTIONS = ['midpoint','lado','angular']
+
+# Number of pairs the buffers are first sized for; they grow if a larger
+# block comes along.
+DEFAULT_SIZE = 2**15
+
+class LOSKernel(object):
+    """Line-of-sight decomposition with preallocated buffers.
+
+    r_par and mu carry the sign of the separation r1-r0 along the line of
+    sight (for 'angular', of |r1|-|r0|); take their absolute values for
+    histograms. Pairs at zero separation get mu = 0.
+
+    The arrays returned by pairs() and block() are views into the buffers
+    and are overwritten by the next call; copy them to keep them.
+
+    Attributes:
+        convention (str): One of CONVENTIONS.
+        size (int): Number of pairs the buffers can hold.
+    """
+
+    _names = ['dx','dy','dz','lx','ly','lz','tmp','s','mu','rpar','rperp']
+
+    def __init__(self,convention='midpoint',size=DEFAULT_SIZE):
+        if convention not in CONVENTIONS:
+            raise ValueError("Unrecognized line-of-sight convention %s (use one of %s)" % (convention,', '.join(CONVENTIONS)))
+        self.convention = convention
+        self.size = 0
+        self._buffers = {}
+        self._reserve(size)
+
+    def _reserve(self,npairs):
+        if npairs>self.size:
+            self.size = max(npairs,2*self.size)
+            for name in self._names:
+                self._buffers[name] = np.empty(self.size)
+
+    def _views(self,shape):
+        npairs = int(np.prod(shape))
+        self._reserve(npairs)
+        return dict((name,buf[:npairs].reshape(shape)) for name,buf in self._buffers.items())
+
+    def pairs(self,r0,r1,d0=None):
+        """Decompose the pairs (r0[i],r1[i]).
+
+        Args:
+            r0, r1 (numpy.ndarray): (K,3) positions (extra columns are
+                                    ignored).
+            d0 (numpy.ndarray): Distance to use for the first galaxy of
+                                each pair in the 'angular' convention
+                                (default |r0|).
+
+        Returns:
+            s, mu, rpar, rperp (numpy.ndarray): Arrays of length K.
+        """
+
+        cols0 = [r0[:,i] for i in range(3)]
+        cols1 = [r1[:,i] for i in range(3)]
+        if d0 is not None:
+            d0 = np.asarray(d0,dtype=float)
+
+        return self._decompose(cols0,cols1,(len(r0),),d0)
+
+    def block(self,r0,r1,d0=None):
+        """Decompose every pair between two blocks of galaxies.
+
+        Args:
+            r0 (numpy.ndarray): (N,3) positions of the first block.
+            r1 (numpy.ndarray): (M,3) positions of the second block.
+            d0 (numpy.ndarray): Distances of the N galaxies of the first
+                                block, for the 'angular' convention
+                                (default |r0|).
+
+        Returns:
+            s, mu, rpar, rperp (numpy.ndarray): (N,M) arrays.
+        """
+
+        cols0 = [r0[:,i,np.newaxis] for i in range(3)]
+        cols1 = [r1[np.newaxis,:,i] for i in range(3)]
+        if d0 is not None:
+            d0 = np.asarray(d0,dtype=float).reshape(-1,1)
+
+        return self._decompose(cols0,cols1,(len(r0),len(r1)),d0)
+
+    def _decompose(self,cols0,cols1,shape,d0):
+
+        buf = self._views(shape)
+        if self.convention=='angular':
+            return self._angular(cols0,cols1,d0,buf)
+
+        dx,dy,dz = buf['dx'],buf['dy'],buf['dz']
+        lx,ly,lz = buf['lx'],buf['ly'],buf['lz']
+        tmp = buf['tmp']
+        s,mu,rpar,rperp = buf['s'],buf['mu'],buf['rpar'],buf['rperp']
+
+        for d,a,b in zip((dx,dy,dz),cols0,cols1):
+            np.subtract(b,a,out=d)
+
+        if self.convention=='midpoint':
+            for l,a,b in zip((lx,ly,lz),cols0,cols1):
+                np.add(a,b,out=l)
+        else:
+            # The bisector of the two directions.
+            n0 = np.sqrt(cols0[0]*cols0[0] + cols0[1]*cols0[1] + cols0[2]*cols0[2])
+            n1 = np.sqrt(cols1[0]*cols1[0] + cols1[1]*cols1[1] + cols1[2]*cols1[2])
+            for l,a,b in zip((lx,ly,lz),cols0,cols1):
+                np.divide(a,n0,out=l)
+                np.divide(b,n1,out=tmp)
+                l += tmp
+
+        # s^2, then d.l, then |l|
+        np.multiply(dx,dx,out=s)
+        for d in (dy,dz):
+            np.multiply(d,d,out=tmp)
+            s += tmp
+        np.multiply(dx,lx,out=rpar)
+        for d,l in ((dy,ly),(dz,lz)):
+            np.multiply(d,l,out=tmp)
+            rpar += tmp
+        np.multiply(lx,lx,out=tmp)
+        for l in (ly,lz):
+            np.multiply(l,l,out=mu)
+            tmp += mu
+        np.sqrt(tmp,out=tmp)
+        rpar /= tmp
+
+        # Pythagoras for r_perp, clipped at 0 against round-off.
+        np.multiply(rpar,rpar,out=tmp)
+        np.subtract(s,tmp,out=rperp)
+        np.maximum(rperp,0,out=rperp)
+        np.sqrt(rperp,out=rperp)
+        np.sqrt(s,out=s)
+
+        self._mu(s,rpar,mu,tmp)
+
+        return s,mu,rpar,rperp
+
+    def _angular(self,cols0,cols1,d0,buf):
+
+        dx,dy,dz = buf['dx'],buf['dy'],buf['dz']
+        tmp = buf['tmp']
+        s,mu,rpar,rperp = buf['s'],buf['mu'],buf['rpar'],buf['rperp']
+
+        n0 = np.sqrt(cols0[0]*cols0[0] + cols0[1]*cols0[1] + cols0[2]*cols0[2])
+        n1 = np.sqrt(cols1[0]*cols1[0] + cols1[1]*cols1[1] + cols1[2]*cols1[2])
+
+        # Chord between the unit vectors, then the angle 2*arcsin(chord/2),
+        # which stays accurate at small separations where arccos does not.
+        for d,a,b in zip((dx,dy,dz),cols0,cols1):
+            np.divide(b,n1,out=d)
+            np.divide(a,n0,out=tmp)
+            d -= tmp
+        np.multiply(dx,dx,out=rperp)
+        for d in (dy,dz):
+            np.multiply(d,d,out=tmp)
+            rperp += tmp
+        np.sqrt(rperp,out=rperp)
+        rperp *= 0.5
+        np.minimum(rperp,1,out=rperp)
+        np.arcsin(rperp,out=rperp)
+        rperp *= 2
+        if d0 is None:
+            d0 = n0
+        rperp *= d0
+
+        np.subtract(n1,n0,out=rpar)
+
+        np.multiply(rpar,rpar,out=s)
+        np.multiply(rperp,rperp,out=tmp)
+        s += tmp
+        np.sqrt(s,out=s)
+
+        self._mu(s,rpar,mu,tmp)
+
+        return s,mu,rpar,rperp
+
+    def _mu(self,s,rpar,mu,tmp):
+        # mu = rpar/s, and 0 where s is 0.
+        np.equal(s,0,out=tmp)
+        tmp += s
+        np.divide(rpar,tmp,out=mu)
+
+################################################################################
+# One kernel per convention and process, so that the buffers are shared by
+# all the calls from the pair counters.
+_kernels = {}
+
+def get_kernel(convention='midpoint'):
+    """The shared LOSKernel for a convention."""
+
+    kernel = _kernels.get(convention)
+    if kernel is None:
+        kernel = LOSKernel(convention)
+        _kernels[convention] = kernel
+
+    return kernel
+
+def los_decompose(r0,r1,convention='midpoint',d0=None,block=False):
+    """s, mu, r_par and r_perp of a set of pairs.
+
+    Args:
+        r0, r1 (numpy.ndarray): Positions (x,y,z first). Matched rows of
+                                the same length, or any two blocks if
+                                block is set.
+        convention (str): One of CONVENTIONS.
+        d0 (numpy.ndarray): See LOSKernel.pairs.
+        block (Boolean): If true, decompose every pair between r0 and r1.
+
+    Returns:
+        s, mu, rpar, rperp (numpy.ndarray): New arrays (not views into
+                                            the shared buffers).
+    """
+
+    kernel = get_kernel(convention)
+    if block:
+        out = kernel.block(r0,r1,d0=d0)
+    else:
+        out = kernel.pairs(r0,r1,d0=d0)
+
+    return tuple(a.copy() for a in out)
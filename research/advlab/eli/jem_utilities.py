@@ -6,10 +6,20 @@ import random
 import math
 import scipy
 import scipy.spatial
+import scipy.interpolate
 import matplotlib.pylab as plt
 from astropy.cosmology import FlatLambdaCDM
 import time
 import argparse
+import os
+import hashlib
+import itertools
+import tempfile
+import json
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import jem_estimators
+import jem_kernels
 #import location
 
 # Test of repo
@@ -39,6 +49,72 @@ def mag(vec):
 
 
 
+################################################################################
+# Comoving distance lookup table
+################################################################################
+# FlatLambdaCDM.comoving_distance integrates separately for every redshift,
+# which is slow for millions of randoms. Instead tabulate D_c(z) once per
+# cosmology and interpolate with a cubic spline, refining the table until
+# the spline agrees with the exact integral in between the nodes.
+DISTANCE_RTOL = 1e-8
+_distance_tables = {}
+
+def _build_distance_table(H0,Om0,zmax,rtol=DISTANCE_RTOL):
+    """Cubic spline of D_c(z) on [0,zmax] with relative error below rtol.
+
+    Args:
+        H0, Om0 (float): Flat LCDM cosmology.
+        zmax (float): Highest redshift covered by the table.
+        rtol (float): Maximum relative interpolation error, checked at
+                      three points between each pair of nodes.
+
+    Returns:
+        spline (scipy.interpolate.CubicSpline): D_c(z) in Mpc.
+    """
+    cosmo=FlatLambdaCDM(H0=H0,Om0=Om0)
+    # dD_c/dz = D_H/E(z); clamping the end slopes keeps the relative error
+    # small even close to z=0, where D_c itself goes to zero.
+    D_H = cosmo.hubble_distance.value
+    bc_type = ((1,D_H),(1,D_H/cosmo.efunc(zmax)))
+    nz = 64
+    while True:
+        z = np.linspace(0,zmax,nz+1)
+        spline = scipy.interpolate.CubicSpline(z,cosmo.comoving_distance(z).value,bc_type=bc_type)
+        zcheck = (z[:-1,np.newaxis] + np.diff(z)[:,np.newaxis]*np.array([0.25,0.5,0.75])).ravel()
+        exact = cosmo.comoving_distance(zcheck).value
+        if np.all(np.abs(spline(zcheck)-exact) <= rtol*exact) or nz>=2**20:
+            return spline
+        nz *= 2
+
+def comoving_distance(redshift,H0=70,Om0=0.3,rtol=DISTANCE_RTOL):
+    """Comoving distance from a cached, interpolated table.
+
+    The table for each (H0,Om0) is built on first use and rebuilt over a
+    wider redshift range if a later call needs it.
+
+    Args:
+        redshift (numpy.ndarray): Redshift values (non-negative)
+        H0, Om0 (float): Flat LCDM cosmology.
+        rtol (float): Maximum relative interpolation error.
+
+    Returns:
+        comdist (numpy.ndarray): Comoving distances in Mpc (not Mpc/h).
+    """
+    redshift = np.asarray(redshift,dtype=float)
+    if redshift.size==0:
+        return np.zeros(redshift.shape)
+    if redshift.min()<0:
+        raise ValueError("comoving_distance needs non-negative redshifts")
+
+    key = (float(H0),float(Om0),float(rtol))
+    spline = _distance_tables.get(key)
+    zmax = redshift.max()
+    if spline is None or zmax>spline.x[-1]:
+        spline = _build_distance_table(H0,Om0,max(1.0,1.5*zmax),rtol)
+        _distance_tables[key] = spline
+
+    return spline(redshift)
+
 # Converting RA and Dec and redshift to Cartesian
 
 def radecredshift2xyz(ra,dec,redshift):
@@ -57,8 +133,7 @@ def radecredshift2xyz(ra,dec,redshift):
     """
 
     # Comoving Distances In Mpc
-    cosmo=FlatLambdaCDM(H0=70,Om0=0.3)
-    comdist=cosmo.comoving_distance(redshift).value * 0.7 # Trying 0.7 for Lado's code.
+    comdist=comoving_distance(redshift,H0=70,Om0=0.3) * 0.7 # Trying 0.7 for Lado's code.
 
     # Convert spherical to Cartesian Coordinates
     #x=comdist*np.sin(dec)*np.cos(ra)
@@ -84,8 +159,7 @@ def radecredshift2xyz_with_weights(oldcoords):
     weights = oldcoords[:,3]
 
     # Comoving Distances In Mpc
-    cosmo=FlatLambdaCDM(H0=70,Om0=0.274)
-    comdist=cosmo.comoving_distance(redshift).value * 0.7 # Trying 0.7 for Lado's code.
+    comdist=comoving_distance(redshift,H0=70,Om0=0.274) * 0.7 # Trying 0.7 for Lado's code.
 
     # Convert spherical to Cartesian Coordinates
     #x=comdist*np.sin(dec)*np.cos(ra)
@@ -123,24 +197,13 @@ def our_para_perp_with_weights(r1,r2):
     """
     w1 = r1[3]
     w2 = r2[:,3]
-    # First compute R_LOS and dR
-    R_LOS = (r1 + r2)/2
-    dR = r2 - r1
-    R_LOS_mag = mag(R_LOS)
 
-    # Dot product
-    
-    # We do this here ([:,0], e.g.) because we expect r1 to be an array.
-    R_para = (dR[:,0]*R_LOS[:,0] + dR[:,1]*R_LOS[:,1] + dR[:,2]*R_LOS[:,2])/R_LOS_mag
-    
-    dR_mag = mag(dR)
-    
-    # Make use of the Pythagorean theorem
-    R_perp = np.sqrt(dR_mag*dR_mag - R_para*R_para)
-    
-    #print i,lo1,indexlo,indexhi,len(R_para),len(paras)
+    # The line of sight is the midpoint of the pair, (r1+r2)/2.
+    s,mu,R_para,R_perp = jem_kernels.los_decompose(r1[np.newaxis,0:3],r2,
+                                                   convention='midpoint',block=True)
+
     weights = w1*w2
-    return R_para,R_perp,weights
+    return R_para[0],R_perp[0],weights
 
 
 # This is the way we think Lado calculates para and perp.
@@ -160,41 +223,11 @@ def lado_para_perp(r1,r2):
         rperp () : The magnitude of the r_perpendicular distance
     """
 
-    #x1=r1[:,0]
-    #y1=r1[:,1]
-    #z1=r1[:,2]
-    x1=r1[0]
-    y1=r1[1]
-    z1=r1[2]
-
-    # Because we know that r1 is an array.
-    x2=r2[:,0]
-    y2=r2[:,1]
-    z2=r2[:,2]
-
-    d1 = x1-x2
-    d2 = y1-y2 
-    d3 = z1-z2
-    
-    r2l = d1*d1 + d2*d2 + d3*d3
-
-    gd1 = mag(r1)
-    gd2 = mag(r2)
-    rat = gd1/gd2
-
-    xb = x1 + (x2)*rat
-    yb = y1 + (y2)*rat
-    zb = z1 + (z2)*rat
+    # Lado's line of sight bisects the directions to the two galaxies.
+    s,mu,rpar,rperp = jem_kernels.los_decompose(r1[np.newaxis,0:3],r2,
+                                                convention='lado',block=True)
 
-    db2 = xb*xb + yb*yb + zb*zb
-
-    mu = np.absolute(((xb*d1 + yb*d2 + zb*d3)/np.sqrt(r2l)/np.sqrt(db2)))
-    rr = np.sqrt(r2l)
-     
-    rpar=rr*mu
-    rperp=rr*np.sqrt(1-(mu*mu))
-
-    return rpar,rperp
+    return np.abs(rpar[0]),rperp[0]
 
 
 
@@ -227,34 +260,25 @@ def one_dimension_trial(r1,r2):
                                    is needed to build an array
                                    shape.  
     """
-    cosmo=FlatLambdaCDM(H0=70,Om0=0.3)
-
     ra1=r1[0]
     dec1=r1[1]
     z1=r1[2]
-    d1=r1[3]
 
     # Because we know that r1 is an array.
     ra2=r2[:,0]
     dec2=r2[:,1]
-    z2=r2[:,2]
-    d2=r2[:,3]
 
-    asep = angular_sep(ra1,dec1,ra2,dec2)
-    asep_in_min = np.rad2deg(asep)*60.
+    # Positions at the distances in the fourth column.
+    xyz1 = r1[3]*np.array([[np.cos(dec1)*np.cos(ra1),np.cos(dec1)*np.sin(ra1),np.sin(dec1)]])
+    xyz2 = r2[:,3:4]*np.column_stack((np.cos(dec2)*np.cos(ra2),np.cos(dec2)*np.sin(ra2),np.sin(dec2)))
 
-    #avgz = (z1+z2)/2.
-
-    x = cosmo.kpc_comoving_per_arcmin(z1).value
-    #x = cosmo.kpc_comoving_per_arcmin(avgz).value
-    x *= asep_in_min/1000.0 # Convert to Mpc
-
-    #d1 = cosmo.comoving_distance(z1).value
-    #d2 = cosmo.comoving_distance(z2).value
-
-    y = d2-d1
-
-    distances = np.sqrt(x*x + y*y)
+    # The transverse separation is the comoving distance to the first
+    # galaxy times the angle between them (for a flat cosmology, the same
+    # as cosmo.kpc_comoving_per_arcmin(z1) times the separation in arcmin),
+    # the radial one the difference of the distances.
+    distances = jem_kernels.los_decompose(xyz1,xyz2,convention='angular',
+                                          d0=comoving_distance(z1,H0=70,Om0=0.3),
+                                          block=True)[0][0]
 
     fake_vals = np.zeros(len(distances))
 
@@ -363,7 +387,297 @@ def pysurvey_distance(r1,r2):
     return  dist,fake_vals
 
 
-def get_coordinates(infilename,xyz=False,maxgals=0,return_radecz=False):
+################################################################################
+# Binary catalog cache
+################################################################################
+# Parsing the ASCII randoms with np.loadtxt dominates the run time of the DD,
+# DR and RR jobs, so each catalog is converted once to a binary table and
+# memory-mapped on later reads. Bump the version if the table layout or the
+# redshift cut changes; old cache files are then simply never matched again.
+CATALOG_CACHE_VERSION = 2
+CATALOG_COLUMNS = ['ra','dec','redshift','w','x','y','z','comdist']
+
+def _fits_columns(data):
+    """ra,dec (radians),redshift,weight from rows of an SDSS FITS table."""
+    ra=np.deg2rad(data['PLUG_RA'])
+    dec=np.deg2rad(data['PLUG_DEC'])
+    redshift=np.array(data['Z'],dtype=float)
+    weights=np.ones(len(redshift))
+    return ra,dec,redshift,weights
+
+def _text_columns(r):
+    """ra,dec (radians),redshift,weight from rows of a text (mock) catalog."""
+    ra=np.deg2rad(r[:,0])
+    dec=np.deg2rad(r[:,1])
+    redshift=r[:,2]
+    if r.shape[1]>3:
+        weights=r[:,3].copy()
+    else:
+        weights=np.ones(len(redshift))
+    return ra,dec,redshift,weights
+
+def read_catalog(infilename):
+    """Read RA, Dec, redshift and weight from a FITS (SDSS data) or text
+                                                   (mocks) catalog.
+
+    Args:
+        infilename (str): The name of the data file.
+
+    Returns:
+        ra, dec (numpy.ndarray): Right Ascension and Declination in radians
+        redshift (numpy.ndarray): Redshift values
+        weights (numpy.ndarray): The fourth column of a text file, or
+                                 ones if there is none.
+    """
+    if(infilename.find('fits')>=0):
+        # Opening FITS file (SDSS Data) 'a'
+        print 'Reading in FITS Data'
+        hdulist1=fits.open(infilename)
+        hdulist1.info()
+        ra,dec,redshift,weights = _fits_columns(hdulist1[1].data)
+        hdulist1.close()
+    else:
+        # Opening txt file (Mocks) 'b'
+        print 'Reading in Text File'
+        ra,dec,redshift,weights = _text_columns(np.loadtxt(infilename,ndmin=2))
+
+    return ra,dec,redshift,weights
+
+def catalog_cache_path(infilename,H0=70,Om0=0.3,cachedir=None):
+    """Name of the cache file for a catalog and cosmology.
+
+    The key covers the absolute path, size and modification time of the
+    catalog, the cosmology and the cache version, so editing the catalog
+    or changing the cosmology never returns a stale table.
+
+    Args:
+        infilename (str): The name of the data file.
+        H0, Om0 (float): Flat LCDM cosmology used for the distances.
+        cachedir (str): Where to keep the cache. Defaults to $JEM_CACHE_DIR,
+                        or a .jem_cache directory next to the catalog.
+
+    Returns:
+        cachefile (str): Path of the .npy cache file.
+    """
+    infilename = os.path.abspath(infilename)
+    st = os.stat(infilename)
+    key = '%d|%s|%d|%r|%r|%r' % (CATALOG_CACHE_VERSION,infilename,st.st_size,
+                                 st.st_mtime,float(H0),float(Om0))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[0:16]
+
+    if cachedir is None:
+        cachedir = os.environ.get('JEM_CACHE_DIR',
+                                  os.path.join(os.path.dirname(infilename),'.jem_cache'))
+
+    return os.path.join(cachedir,'%s.%s.npy' % (os.path.basename(infilename),digest))
+
+def build_catalog_table(infilename,H0=70,Om0=0.3):
+    """Read a catalog, apply the redshift cut and compute the distances.
+
+    Args:
+        infilename (str): The name of the data file.
+        H0, Om0 (float): Flat LCDM cosmology used for the distances.
+
+    Returns:
+        table (numpy.ndarray): A (8,N) array holding, row by row, the
+                               CATALOG_COLUMNS (ra and dec in radians,
+                               distances in Mpc/h).
+    """
+    ra,dec,redshift,weights = read_catalog(infilename)
+
+    return catalog_table(ra,dec,redshift,weights,H0=H0,Om0=Om0)
+
+def catalog_table(ra,dec,redshift,weights,H0=70,Om0=0.3):
+    """Apply the redshift cut and compute the distances for catalog columns.
+
+    Args:
+        ra, dec (numpy.ndarray): Right Ascension and Declination in radians
+        redshift (numpy.ndarray): Redshift values
+        weights (numpy.ndarray): Weights
+        H0, Om0 (float): Flat LCDM cosmology used for the distances.
+
+    Returns:
+        table (numpy.ndarray): A (8,N) array of CATALOG_COLUMNS.
+    """
+    # Made some common cuts
+    index = (redshift<0.7)*(redshift>0.43)
+
+    table = np.empty((len(CATALOG_COLUMNS),index.sum()))
+    table[0] = ra[index]
+    table[1] = dec[index]
+    table[2] = redshift[index]
+    table[3] = weights[index]
+
+    table[7] = comoving_distance(table[2],H0=H0,Om0=Om0) * (H0/100.)
+
+    # Reproducing Lado's stuff.
+    table[4] = table[7]*np.cos(table[1])*np.cos(table[0])
+    table[5] = table[7]*np.cos(table[1])*np.sin(table[0])
+    table[6] = table[7]*np.sin(table[1])
+
+    return table
+
+def load_catalog(infilename,H0=70,Om0=0.3,cache=True,cachedir=None):
+    """Catalog table, read from the binary cache when possible.
+
+    On a cache miss the catalog is parsed with build_catalog_table and
+    written to the cache; the returned table is then a read-only memory
+    map of that file. If the cache cannot be written the table is simply
+    returned in memory.
+
+    Args:
+        infilename (str): The name of the data file.
+        H0, Om0 (float): Flat LCDM cosmology used for the distances.
+        cache (bool): If false, always parse the catalog.
+        cachedir (str): See catalog_cache_path.
+
+    Returns:
+        table (numpy.ndarray): A (8,N) array of CATALOG_COLUMNS.
+    """
+    if not cache:
+        return build_catalog_table(infilename,H0=H0,Om0=Om0)
+
+    cachefile = catalog_cache_path(infilename,H0=H0,Om0=Om0,cachedir=cachedir)
+    if os.path.exists(cachefile):
+        print 'Reading cached catalog %s' % (cachefile)
+        return np.load(cachefile,mmap_mode='r')
+
+    table = build_catalog_table(infilename,H0=H0,Om0=Om0)
+    try:
+        if not os.path.isdir(os.path.dirname(cachefile)):
+            os.makedirs(os.path.dirname(cachefile))
+        # Write to a temporary file first so that an interrupted run never
+        # leaves a truncated table behind under the real name.
+        tmpfile = '%s.%d.tmp' % (cachefile,os.getpid())
+        with open(tmpfile,'wb') as outfile:
+            np.save(outfile,table)
+        os.rename(tmpfile,cachefile)
+    except (IOError,OSError) as err:
+        print 'Could not write catalog cache %s: %s' % (cachefile,err)
+        return table
+
+    print 'Wrote cached catalog %s' % (cachefile)
+    return np.load(cachefile,mmap_mode='r')
+
+class CatalogChunks(object):
+    """Stream a catalog as fixed-size chunks of converted coordinates.
+
+    Each chunk holds the x,y,z,weight,comdist columns of at most chunksize
+    galaxies (after the redshift cut), i.e. the same columns as
+    get_coordinates_with_weight(infilename,xyz=True), so a random catalog
+    never has to be held in memory all at once.
+
+    The chunks are sliced out of the memory-mapped binary cache (see
+    load_catalog). If the catalog is not in the cache yet, it is converted
+    once, a chunk of rows at a time, into the cache file (or, with
+    cache=False, into a temporary file that goes away with the object), so
+    the text or FITS file is parsed only once however many times the
+    chunks are iterated over.
+
+    Attributes:
+        infilename (str): The name of the data file.
+        chunksize (int): Number of galaxies per chunk.
+        table (numpy.ndarray): The (8,N) memory-mapped catalog table.
+        ngals (int): Number of galaxies N. Their weights are all one.
+    """
+
+    def __init__(self,infilename,chunksize=1000000,H0=70,Om0=0.274,cache=True):
+        self.infilename = infilename
+        self.chunksize = int(chunksize)
+        self.H0 = H0
+        self.Om0 = Om0
+
+        cachefile = None
+        if cache:
+            cachefile = catalog_cache_path(infilename,H0=H0,Om0=Om0)
+        if cachefile is not None and os.path.exists(cachefile):
+            self.table = np.load(cachefile,mmap_mode='r')
+        else:
+            self.table = self._convert_catalog(cachefile)
+        self.ngals = self.table.shape[1]
+
+    def __iter__(self):
+        return self.chunks()
+
+    def _coordinates(self,table):
+        # As in get_coordinates_with_weight, the weights are all set to one.
+        return np.column_stack((table[4],table[5],table[6],
+                                np.ones(table.shape[1]),table[7]))
+
+    def _read_columns(self):
+        # ra,dec,redshift,weight of chunksize catalog rows at a time.
+        if self.infilename.find('fits')>=0:
+            hdulist1=fits.open(self.infilename,memmap=True)
+            data=hdulist1[1].data
+            for lo in xrange(0,len(data),self.chunksize):
+                yield _fits_columns(data[lo:lo+self.chunksize])
+            hdulist1.close()
+        else:
+            with open(self.infilename) as infile:
+                while True:
+                    lines = list(itertools.islice(infile,self.chunksize))
+                    if len(lines)==0:
+                        break
+                    r = np.loadtxt(lines,ndmin=2)
+                    if len(r)>0:
+                        yield _text_columns(r)
+
+    def _convert_catalog(self,cachefile=None):
+        """Convert the catalog in one streamed pass into an (8,N) table on
+        disk, the same as load_catalog would write, and memory map it."""
+
+        tmpdir = None
+        if cachefile is not None:
+            tmpdir = os.path.dirname(cachefile)
+            try:
+                if not os.path.isdir(tmpdir):
+                    os.makedirs(tmpdir)
+            except OSError:
+                tmpdir = None
+
+        # The converted rows are appended to a raw file as they come in and
+        # then transposed into the (8,N) .npy table.
+        ngals = 0
+        fd,rawfile = tempfile.mkstemp(suffix='.raw',dir=tmpdir)
+        with os.fdopen(fd,'wb') as raw:
+            for ra,dec,redshift,weights in self._read_columns():
+                table = catalog_table(ra,dec,redshift,weights,H0=self.H0,Om0=self.Om0)
+                table.T.tofile(raw)
+                ngals += table.shape[1]
+
+        fd,tmpfile = tempfile.mkstemp(suffix='.npy',dir=tmpdir)
+        os.close(fd)
+        out = np.lib.format.open_memmap(tmpfile,mode='w+',dtype=float,
+                                        shape=(len(CATALOG_COLUMNS),ngals))
+        if ngals>0:
+            rows = np.memmap(rawfile,dtype=float,mode='r',shape=(ngals,len(CATALOG_COLUMNS)))
+            for lo in xrange(0,ngals,self.chunksize):
+                out[:,lo:lo+self.chunksize] = rows[lo:lo+self.chunksize].T
+            del rows
+        out.flush()
+        del out
+        os.remove(rawfile)
+
+        if cachefile is not None:
+            try:
+                os.rename(tmpfile,cachefile)
+                print 'Wrote cached catalog %s' % (cachefile)
+                return np.load(cachefile,mmap_mode='r')
+            except OSError as err:
+                print 'Could not write catalog cache %s: %s' % (cachefile,err)
+
+        # The memory map keeps the data after the file name is gone.
+        table = np.load(tmpfile,mmap_mode='r')
+        os.remove(tmpfile)
+        return table
+
+    def chunks(self,start=0):
+        """Yield the chunks, beginning with chunk number start."""
+
+        for lo in xrange(start*self.chunksize,self.ngals,self.chunksize):
+            yield self._coordinates(self.table[:,lo:lo+self.chunksize])
+
+def get_coordinates(infilename,xyz=False,maxgals=0,return_radecz=False,cache=True):
     """Grabs either X.Y,Z coordinates or RA,DEC,Z values
                                           of a data set.
 
@@ -377,132 +691,267 @@ def get_coordinates(infilename,xyz=False,maxgals=0,return_radecz=False):
         return_radecz (): If true, Right Ascension,
                           Declination, and Redshift
                           will be returned.
+        cache (bool): Read the catalog through the binary
+                      cache (see load_catalog).
     Returns:
         coords (numpy.ndarray): Either an array of
                                    XYZ or RA,DEC,Z
     """
-    isdatafile = False
-    if(infilename.find('fits')>=0):
-        isdatafile = True
-
-    if isdatafile:
-        # Opening FITS file (SDSS Data) 'a' 
-        print 'Reading in FITS Data'
-        hdulist1=fits.open(infilename)
-        hdulist1.info()
-        h1=hdulist1[1]
-        data=h1.data
-        del h1
-
-
-        # Radians
-        #ra=(data['PLUG_RA'])*((math.pi)/180)
-        #dec=((math.pi)/2)-((data['PLUG_DEC'])*((math.pi)/180))
-        ra=np.deg2rad(data['PLUG_RA'])
-        dec=np.deg2rad(data['PLUG_DEC'])
-        redshift = data['Z']
-
-        del data
-    else:
+    if xyz and infilename.find('fits')<0:
         # Opening txt file (Mocks) 'b'
         print 'Reading in Text File'
         r=np.loadtxt(infilename)
-        if xyz:
-            coords = np.column_stack((r[:,0],r[:,1],r[:,2]))
-            del r
-            return coords
-            exit()
-        else:    
-            # Radians
-            #ra=(r[:,0])*((math.pi)/180)
-            #dec=((math.pi)/2)-((r[:,1])*((math.pi)/180))
-            ra=np.deg2rad(r[:,0])
-            dec=np.deg2rad(r[:,1])
-            redshift=r[:,2]
-
-            del r
+        coords = np.column_stack((r[:,0],r[:,1],r[:,2]))
+        del r
+        return coords
 
-    # Made some common cuts
-    index0 = redshift<0.7
-    index1 = redshift>0.43
-    index = index0*index1
-
-    '''
-    # Fiducial cuts?
-    indexcut = dec<0.35
-    indexcut *= ra<3.7
-    indexcut += ra>3.7
-    index *= indexcut
-    '''
-
-    ra = ra[index]
-    dec = dec[index]
-    redshift = redshift[index]
+    if return_radecz:
+        Om0 = 0.310 # Doing 0.310 to match Lado's code.
+    else:
+        Om0 = 0.3
+    table = load_catalog(infilename,H0=70,Om0=Om0,cache=cache)
 
     # Grab a subsample if we only want a few galaxies
+    index = slice(None)
     if maxgals>0:
-
-        a=np.arange(0,len(redshift))
+        a=np.arange(0,table.shape[1])
         np.random.shuffle(a)
-
-        ra=ra[a[0:maxgals]]
-        dec=dec[a[0:maxgals]]
-        redshift=redshift[a[0:maxgals]]
+        index = a[0:maxgals]
         del a
 
-    if xyz:
-        r=np.loadtxt(infilename)
-        coords = np.column_stack((r[:,0],r[:,1],r[:,2]))
-        del r
     if return_radecz:
-        #coords = np.column_stack((np.rad2deg(ra),np.rad2deg(-(dec-np.pi/2)),redshift))
-        cosmo=FlatLambdaCDM(H0=70,Om0=0.310) # Doing 0.310 to match Lado's code.
-        d = cosmo.comoving_distance(redshift).value * 0.7 # Trying the 0.7 to match Lado's code.
-        #coords = np.column_stack((np.deg2rad(ra),np.deg2rad(dec),redshift,d))
-        #print ra[0:100]
-        #print dec[0:100]
-        coords = np.column_stack((ra,dec,redshift,d))
+        coords = np.column_stack((table[0][index],table[1][index],table[2][index],table[7][index]))
+    else:
+        coords = np.column_stack((table[4][index],table[5][index],table[6][index]))
+
+    return coords
+
+################################################################################
+################################################################################
+def get_coordinates_with_weight(infilename,xyz=False,cache=True):
+    """RA, Dec, redshift and weight of a catalog, after the redshift cut.
+
+    Args:
+        infilename (str): The name of the data file.
+        xyz (bool): If true, return the columns x,y,z,weight,comdist
+                    instead, i.e. the output of
+                    radecredshift2xyz_with_weights, straight from the cache.
+        cache (bool): Read the catalog through the binary cache.
+
+    Returns:
+        coords (numpy.ndarray): ra,dec (radians),redshift,weight columns.
+    """
+    # Same cosmology as radecredshift2xyz_with_weights.
+    table = load_catalog(infilename,H0=70,Om0=0.274,cache=cache)
 
+    #weights=table[3]
+    weights=np.ones(table.shape[1])
+    #weights=0.1*np.ones(table.shape[1])
+
+    if xyz:
+        coords = np.column_stack((table[4],table[5],table[6],weights,table[7]))
     else:
-        coords = radecredshift2xyz(ra,dec,redshift)
-        del ra,dec,redshift
+        coords = np.column_stack((table[0],table[1],table[2],weights))
 
     return coords
 
 ################################################################################
+def pair_weight_totals(w0,w1,samefile=True):
+    """Weight sums used to normalize the pair counts, in O(N).
+
+    The total weight of all pairs is sum_ij w0_i*w1_j = sum(w0)*sum(w1).
+    For a catalog paired with itself the i=j terms are dropped and each
+    pair is only counted once, giving (sum(w)^2 - sum(w^2))/2.
+
+    Args:
+        w0 (numpy.ndarray): Weights of the first catalog.
+        w1 (numpy.ndarray): Weights of the second catalog.
+        samefile (Boolean): If true, the two catalogs are the same (DD or RR).
+
+    Returns:
+        tot_weight0 (float): sum(w0)
+        tot_weight1 (float): sum(w1)
+        tot_weight2 (float): Total weight of the distinct pairs.
+        tot_weight3 (float): sum(w0*w1) if samefile, otherwise 1.
+    """
+
+    tot_weight0 = math.fsum(w0)
+    tot_weight1 = math.fsum(w1)
+    tot_weight2 = tot_weight0*tot_weight1
+
+    if samefile:
+        tot_weight3 = math.fsum(np.asarray(w0)*np.asarray(w1))
+        tot_weight2 = (tot_weight2 - tot_weight3)/2.
+    else:
+        tot_weight3 = 1.0 # Otherwise, not necessarily the same size.
+
+    return tot_weight0,tot_weight1,tot_weight2,tot_weight3
+
+################################################################################
+# Pair-count store
 ################################################################################
-def get_coordinates_with_weight(infilename):
+# RR (and DR) only depend on the catalogs, the cosmology, the binning and the
+# weights, so the counts are saved under a hash of exactly those things and
+# reused whenever the same combination comes up again. The catalogs enter
+# through a hash of their contents, not their names.
+PAIR_COUNT_STORE_VERSION = 1
+_catalog_hashes = {}
+
+def catalog_hash(infilename):
+    """SHA-1 of the contents of a catalog file.
+
+    The hash is remembered for as long as the file keeps the same size and
+    modification time, so each catalog is only read once per session.
+    """
 
-    r=np.loadtxt(infilename,unpack=True)
+    infilename = os.path.abspath(infilename)
+    st = os.stat(infilename)
+    key = (infilename,st.st_size,st.st_mtime)
+    if key not in _catalog_hashes:
+        sha = hashlib.sha1()
+        with open(infilename,'rb') as infile:
+            for block in iter(lambda: infile.read(2**20),b''):
+                sha.update(block)
+        _catalog_hashes[key] = sha.hexdigest()
 
-    ra=np.deg2rad(r[0])
-    dec=np.deg2rad(r[1])
-    redshift=r[2]
-    #weights=r[3]
-    #weights=r[4]
-    weights=np.ones(len(redshift))
-    #weights=0.1*np.ones(len(redshift))
+    return _catalog_hashes[key]
 
-    del r
+def catalog_stamp(infilename):
+    """Path, size and modification time of a catalog file.
 
-    # Made some common cuts
-    index0 = redshift<0.7
-    index1 = redshift>0.43
-    index = index0*index1
+    A cheap stand-in for catalog_hash where a changed file only has to be
+    noticed, not recognized by its contents (e.g. checkpoint keys).
+    """
 
-    ra = ra[index]
-    dec = dec[index]
-    redshift = redshift[index]
-    weights = weights[index]
-    coords = np.column_stack((ra,dec,redshift,weights))
+    infilename = os.path.abspath(infilename)
+    st = os.stat(infilename)
 
-    return coords
+    return '%s:%d:%r' % (infilename,st.st_size,st.st_mtime)
+
+def prefix_catalog_ids(hashes):
+    """Catalog ids (see pair_count_key) of each prefix of a list of files.
+
+    Args:
+        hashes (list): catalog_hash of each file.
+
+    Returns:
+        ids (list): The id of files[:k+1] for each k.
+    """
+
+    ids = []
+    for k in range(0,len(hashes)):
+        if k==0:
+            ids.append(hashes[0])
+        else:
+            ids.append(ids[-1] + '+' + hashes[k])
+
+    return ids
+
+def _catalog_id(infilename):
+    """catalog_hash of a file, or the joined hashes of a list of files."""
+
+    if isinstance(infilename,(list,tuple)):
+        return prefix_catalog_ids([catalog_hash(f) for f in infilename])[-1]
+
+    return catalog_hash(infilename)
+
+def pair_count_key(infilename0,infilename1,edges,samefile=True,
+                   cosmology=None,weights='unit',selection=None,los=None,
+                   catalog_ids=None):
+    """Content-addressed key for a set of pair counts.
+
+    Args:
+        infilename0, infilename1 (str or list): The two catalogs. A list
+                                  of files stands for their concatenation
+                                  (see incremental_pair_counts).
+        edges (numpy.ndarray or list): The bin edges; a list of arrays for
+                                       2D counts.
+        samefile (Boolean): True for DD or RR counts.
+        cosmology (dict): Cosmological parameters used for the distances.
+        weights (str): Name of the weighting scheme.
+        selection (dict): Any cuts applied to the catalogs.
+        los (str): Line-of-sight convention of 2D counts (see jem_kernels).
+        catalog_ids (list): Ids of the two catalogs, if they are already
+                            known (see prefix_catalog_ids); the files are
+                            then not read.
+
+    Returns:
+        key (str): Hex digest identifying the counts.
+        description (dict): Everything that went into the key.
+    """
+
+    if isinstance(edges,np.ndarray):
+        edges = [edges]
+    if catalog_ids is None:
+        catalog_ids = [_catalog_id(infilename0),_catalog_id(infilename1)]
+    description = {'version':PAIR_COUNT_STORE_VERSION,
+                   'catalogs':list(catalog_ids),
+                   'samefile':bool(samefile),
+                   'edges':[[float(e) for e in np.asarray(edge).ravel()] for edge in edges],
+                   'cosmology':cosmology,
+                   'weights':weights,
+                   'selection':selection}
+    if los is not None:
+        description['los'] = los
+    text = json.dumps(description,sort_keys=True)
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest(),description
+
+def pair_count_store_dir(storedir=None):
+    """Directory of the pair-count store: storedir, $JEM_PAIRCOUNT_STORE, or
+    ~/.jem_paircounts."""
+
+    if storedir is None:
+        storedir = os.environ.get('JEM_PAIRCOUNT_STORE',
+                                  os.path.join(os.path.expanduser('~'),'.jem_paircounts'))
+    return storedir
+
+def load_pair_counts(key,storedir=None):
+    """Counts saved under key by save_pair_counts, or None.
+
+    Returns:
+        counts (numpy.ndarray): The pair counts.
+        meta (dict): The metadata saved with them.
+    """
+
+    storefile = os.path.join(pair_count_store_dir(storedir),'%s.npz' % (key))
+    if not os.path.exists(storefile):
+        return None
+
+    stored = np.load(storefile)
+    counts = stored['counts']
+    meta = json.loads(str(stored['meta']))
+    stored.close()
+
+    return counts,meta
+
+def save_pair_counts(key,counts,meta,storedir=None):
+    """Save pair counts, with a JSON-able dict of metadata, under key.
+
+    Returns:
+        storefile (str): The file written, or None if it could not be.
+    """
+
+    storedir = pair_count_store_dir(storedir)
+    storefile = os.path.join(storedir,'%s.npz' % (key))
+    try:
+        if not os.path.isdir(storedir):
+            os.makedirs(storedir)
+        tmpfile = '%s.%d.tmp' % (storefile,os.getpid())
+        with open(tmpfile,'wb') as outfile:
+            np.savez(outfile,counts=counts,meta=json.dumps(meta,sort_keys=True))
+        os.rename(tmpfile,storefile)
+    except (IOError,OSError) as err:
+        print 'Could not save pair counts to %s: %s' % (storefile,err)
+        return None
+
+    return storefile
 
 ################################################################################
 ################################################################################
                                                                                 
 def corr_est(DD,DR,RR,ngals,nrands,nbins,
-             oned=False):
+             oned=False,estimator='LS'):
     """Calculates the Landy-Szalay Correlation Function Estimator,
                                      given three frequency arrays
 
@@ -517,6 +966,8 @@ def corr_est(DD,DR,RR,ngals,nrands,nbins,
                                                      utilized
             nrands (int) : The number of random points originally
                                                          utilized
+            estimator (str) : Any estimator from jem_estimators
+                              (LS, Hamilton, DP or natural)
         Returns:
             Xi (numpy.ndarray) : The frequency array of the Correlation
                                                               Estimator
@@ -545,10 +996,9 @@ def corr_est(DD,DR,RR,ngals,nrands,nbins,
     D_R+=np.fliplr(D_R)
     R_R+=np.fliplr(R_R)
     
-    D_D /=(ngals**2-ngals)/2.
-    D_R /=(nrands*ngals)/1.
-    R_R /=(nrands**2-nrands)/2.
-    Xi = ((D_D - 2*D_R + R_R)/(R_R+(R_R==0)))*(R_R!=0)
+    Xi = jem_estimators.xi_estimator(D_D,D_R,R_R,(ngals**2-ngals)/2.,
+                                     (nrands*ngals)/1.,(nrands**2-nrands)/2.,
+                                     estimator=estimator)
 
     if oned:
         index=nbins/2
@@ -751,7 +1201,8 @@ def define_ranges(loranges, hiranges, maxsep=200):
 
         r = hiranges[i]-loranges[i];
 
-        ngrids.append(int(r/maxsep))
+        # At least one voxel, even if the data are narrower than maxsep.
+        ngrids.append(max(1,int(r/maxsep)))
         gridwidths.append(r/ngrids[i])
 
     return ngrids,gridwidths
@@ -850,54 +1301,7 @@ def twopoint_hist_grid(infile1,infile2,nbins,rangeval,
     ############################################################################
     # Break up into voxels.
     ############################################################################
-    loranges = [np.min((coords0cut[:,0],coords1cut[:,0])),np.min((coords0cut[:,1],coords1cut[:,1])),np.min((coords0cut[:,2],coords1cut[:,2]))]
-    hiranges = [np.max((coords0cut[:,0],coords1cut[:,0])),np.max((coords0cut[:,1],coords1cut[:,1])),np.max((coords0cut[:,2],coords1cut[:,2]))]
-    ngrids,gridwidths = define_ranges(loranges,hiranges, maxsep=200)
-
-    grid_coords0 = assign_grid_coordinate(coords0cut, loranges, hiranges, gridwidths)
-    grid_coords1 = assign_grid_coordinate(coords1cut, loranges, hiranges, gridwidths)
-
-    # Subdivide into voxels.
-
-    # First make our holder of coordinates, broken up by voxel.
-    # Initialize them
-    voxels0 = []
-    for i in range(0,ngrids[0]):
-        voxels0.append([])
-        for j in range(0,ngrids[1]):
-            voxels0[i].append([])
-            for k in range(0,ngrids[2]):
-                voxels0[i][j].append([])
-
-    voxels1 = []
-    for i in range(0,ngrids[0]):
-        voxels1.append([])
-        for j in range(0,ngrids[1]):
-            voxels1[i].append([])
-            for k in range(0,ngrids[2]):
-                voxels1[i][j].append([])
-    #import pdb ; pdb.set_trace()
-    # Fill them
-    for i in range(0,ngals0):
-        a,b,c = grid_coords0[0][i],grid_coords0[1][i],grid_coords0[2][i]
-        voxels0[a][b][c].append(coords0[i])
-    for i in range(0,ngals1):
-        a,b,c = grid_coords1[0][i],grid_coords1[1][i],grid_coords1[2][i] 
-        #print(a,b,c,i)
-        #if i==537:
-        #    import pdb ; pdb.set_trace()
-        voxels1[a][b][c].append(coords1[i])
-    # Convert lists to arrays
-    for i in range(0,ngrids[0]):
-        for j in range(0,ngrids[1]):
-            for k in range(0,ngrids[2]):
-                voxels0[i][j][k] = np.array(voxels0[i][j][k])
-
-    for i in range(0,ngrids[0]):
-        for j in range(0,ngrids[1]):
-            for k in range(0,ngrids[2]):
-                voxels1[i][j][k] = np.array(voxels1[i][j][k])
-
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = voxelize_the_data(coords0cut,coords1cut,maxsep=200)
 
     ############################################################################
     # This is for the histogram.
@@ -917,7 +1321,7 @@ def twopoint_hist_grid(infile1,infile2,nbins,rangeval,
         for jj in range(0,ngrids[1]):
             for kk in range(0,ngrids[2]):
 
-                c0 = voxels0[ii][jj][kk] 
+                c0 = voxels0[ii,jj,kk]
 
                 iimax = ii+2
                 if iimax>=ngrids[0]:
@@ -933,7 +1337,7 @@ def twopoint_hist_grid(infile1,infile2,nbins,rangeval,
                     for bb in range(jj,jjmax):
                         for cc in range(kk,kkmax):
 
-                            c1 = voxels1[aa][bb][cc] 
+                            c1 = voxels1[aa,bb,cc]
 
                             if len(c0)>0 and len(c1)>0:
                                 print ii,jj,kk, aa, bb, cc, len(c0),len(c1)
@@ -959,6 +1363,49 @@ def twopoint_hist_grid(infile1,infile2,nbins,rangeval,
    
     return tot_freq
     
+################################################################################
+################################################################################
+class CellList(object):
+    """Galaxies sorted by the voxel they fall in.
+
+    The voxels are numbered with the linear index of (ii,jj,kk) on the
+    grid, the galaxies are sorted by that index, and offsets[n] is the
+    row of the first galaxy in voxel n, so voxel n is
+    points[offsets[n]:offsets[n+1]]. Indexing with [ii,jj,kk] (or the
+    linear index) returns that slice as a view, without copying.
+
+    Args:
+        coords (numpy.ndarray): One row per galaxy.
+        grid_coordinates (numpy.ndarray): 3 x N voxel coordinates, as
+                                          returned by assign_grid_coordinate.
+        ngrids (list): Number of voxels along each axis.
+        gridwidths (list): Width of the voxels along each axis (optional).
+    """
+
+    def __init__(self,coords,grid_coordinates,ngrids,gridwidths=None):
+
+        self.ngrids = tuple(ngrids)
+        self.gridwidths = gridwidths
+        ncells = self.ngrids[0]*self.ngrids[1]*self.ngrids[2]
+
+        cell_ids = np.ravel_multi_index(tuple(grid_coordinates),self.ngrids)
+
+        # A stable sort keeps the galaxies in each voxel in file order.
+        self.order = np.argsort(cell_ids,kind='mergesort')
+        self.points = coords[self.order]
+        self.counts = np.bincount(cell_ids,minlength=ncells)
+        self.offsets = np.zeros(ncells+1,dtype=int)
+        np.cumsum(self.counts,out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self,index):
+        if isinstance(index,tuple):
+            ii,jj,kk = index
+            index = (ii*self.ngrids[1] + jj)*self.ngrids[2] + kk
+        return self.points[self.offsets[index]:self.offsets[index+1]]
+
 ################################################################################
 ################################################################################
 def voxelize_the_data(coords0,coords1,maxsep=200):
@@ -981,297 +1428,1298 @@ def voxelize_the_data(coords0,coords1,maxsep=200):
     grid_coords1 = assign_grid_coordinate(coords1, loranges, hiranges, gridwidths)
 
     # Subdivide into voxels.
+    voxels0 = CellList(coords0,grid_coords0,ngrids,gridwidths)
+    voxels1 = CellList(coords1,grid_coords1,ngrids,gridwidths)
 
-    # First make our holder of coordinates, broken up by voxel.
-    # Initialize them
-    voxels0 = []
-    for i in range(0,ngrids[0]):
-        voxels0.append([])
-        for j in range(0,ngrids[1]):
-            voxels0[i].append([])
-            for k in range(0,ngrids[2]):
-                voxels0[i][j].append([])
-
-    voxels1 = []
-    for i in range(0,ngrids[0]):
-        voxels1.append([])
-        for j in range(0,ngrids[1]):
-            voxels1[i].append([])
-            for k in range(0,ngrids[2]):
-                voxels1[i][j].append([])
+    return voxels0,voxels1,ngrids,gridwidths,loranges,hiranges
 
-    
-    # Fill them
-    for i in range(0,ngals0):
-        a,b,c = grid_coords0[0][i],grid_coords0[1][i],grid_coords0[2][i]
-        voxels0[a][b][c].append(coords0[i])
-    for i in range(0,ngals1):
-        a,b,c = grid_coords1[0][i],grid_coords1[1][i],grid_coords1[2][i] 
-        voxels1[a][b][c].append(coords1[i])
-
-    # Convert lists to arrays
-    for i in range(0,ngrids[0]):
-        for j in range(0,ngrids[1]):
-            for k in range(0,ngrids[2]):
-                voxels0[i][j][k] = np.array(voxels0[i][j][k])
-
-    for i in range(0,ngrids[0]):
-        for j in range(0,ngrids[1]):
-            for k in range(0,ngrids[2]):
-                voxels1[i][j][k] = np.array(voxels1[i][j][k])
 
+################################################################################
+# Sharded pair counting. The catalogs are copied once into shared memory and
+# the worker processes (forked from this one) read them from _shared_arrays.
+################################################################################
+_shared_arrays = {}
 
-    return voxels0,voxels1,ngrids,gridwidths,loranges,hiranges
+def _init_shared_arrays(arrays):
+    _shared_arrays.clear()
+    _shared_arrays.update(arrays)
 
+################################################################################
+def share_array(array):
+    """Copy an array into shared memory that forked processes can read.
 
-############################################################################
-def do_pair_counts(voxels0,voxels1,ngrids,nbins=10,maxrange=200,samefile=True):
+    Args:
+        array (numpy.ndarray): The array to copy.
 
-    start_time_pc = time.time()
+    Returns:
+        shared (numpy.ndarray): A view of the shared copy.
+    """
 
-    voxel_combinations_so_far = []
+    array = np.asarray(array)
+    raw = RawArray('b',max(array.nbytes,1))
+    shared = np.frombuffer(raw,dtype=array.dtype,count=array.size)
+    shared = shared.reshape(array.shape)
+    shared[...] = array
 
-    tot_distances = []
+    return shared
 
-    tot_freq = np.zeros(nbins)
+################################################################################
+def merge_pair_counts(partials):
+    """Sum pair-count histograms from several shards.
 
-    tot_weight_val = 0
+    Each bin is summed with math.fsum, so the result is the correctly
+    rounded total whatever the number of shards or the order they finish in.
 
-    tot_points_looped_over = 0
+    Args:
+        partials (list): Histograms of the same shape.
 
-    ncalcs = 0
+    Returns:
+        tot_freq (numpy.ndarray): The summed histogram.
+    """
 
-    weight_total = 0
+    stacked = np.array(partials,dtype=float)
+    flat = stacked.reshape(len(partials),-1)
+    tot_freq = np.array([math.fsum(flat[:,i]) for i in range(flat.shape[1])])
 
-    #Calculation Loop
-    for ii in range(0,ngrids[0]):
-        print ii,time.time()-start_time_pc
-        for jj in range(0,ngrids[1]):
-            for kk in range(0,ngrids[2]):
+    return tot_freq.reshape(stacked.shape[1:])
 
-                c0 = voxels0[ii][jj][kk] 
+################################################################################
+# Seconds between checkpoint writes.
+CHECKPOINT_INTERVAL = 60.
 
-                if len(c0)==0:
-                    continue
+class Checkpoint(object):
+    """Histograms of the finished shards of a run, saved to a small file.
 
-                tot_points_looped_over += len(c0)
+    run_sharded hands every finished shard to update(), which rewrites the
+    file at most every interval seconds. A killed run restarted with
+    resume=True only redoes the shards that are missing. As the shards are
+    merged with merge_pair_counts, the final counts are bit-identical to
+    those of an uninterrupted run.
 
-                #print 
-                #print ii,jj,kk
+    Args:
+        filename (str): The checkpoint file (.npz).
+        key (str): Identifies the run (catalogs, binning, sharding); a
+                   checkpoint with a different key is never resumed.
+        resume (Boolean): If false, any existing checkpoint is ignored and
+                          overwritten.
+        interval (float): Seconds between writes.
+    """
 
-                iimin = ii-1
-                iimax = ii+2
-                if iimax>=ngrids[0]:
-                    iimax = ngrids[0]
-                if iimin<0:
-                    iimin=0
-                jjmin = jj-1
-                jjmax = jj+2
-                if jjmax>=ngrids[1]:
-                    jjmax = ngrids[1]
-                if jjmin<0:
-                    jjmin=0
-                kkmin = kk-1
-                kkmax = kk+2
-                if kkmax>=ngrids[2]:
-                    kkmax = ngrids[2]
-                if kkmin<0:
-                    kkmin=0
+    def __init__(self,filename,key='',resume=True,interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.key = key
+        self.resume = resume
+        self.interval = interval
+        self.partials = None
+        self.last_save = time.time()
 
-                for aa in range(iimin,iimax):
-                    for bb in range(jjmin,jjmax):
-                        for cc in range(kkmin,kkmax):
+    def load(self,ntasks):
+        """Partial histograms of the finished shards (None for the others)."""
 
-                            if samefile:
-                                combination0 = "%03s%03s%03s" % (cc,bb,aa)
-                                combination1 = "%03s%03s%03s" % (kk,jj,ii)
-                                combination = "%s%s" % (max(combination0,combination1),min(combination0,combination1))
+        self.partials = [None]*ntasks
+        if not self.resume or not os.path.exists(self.filename):
+            return list(self.partials)
 
-                                if combination in voxel_combinations_so_far:
-                                    continue
-                                else:
-                                    voxel_combinations_so_far.append(combination)
+        saved = np.load(self.filename)
+        key = str(saved['key'])
+        done = saved['done']
+        partials = saved['partials']
+        saved.close()
 
-                            c1 = voxels1[aa][bb][cc] 
+        if key!=self.key or len(done)!=ntasks:
+            raise ValueError("Checkpoint %s is for a different run" % (self.filename))
 
-                            if len(c1)==0:
-                                continue
+        for i in np.flatnonzero(done):
+            self.partials[i] = partials[i]
+        print "Resuming from %s: %d of %d shards done" % (self.filename,done.sum(),ntasks)
 
-                            # These will store the calculations.
-                            for index,r0 in enumerate(c0):
+        return list(self.partials)
 
-                                '''
-                                if samefile and aa==ii and bb==jj and cc==kk:
-                                    distances = distances=scipy.spatial.distance.pdist(c0)
-                                else:
-                                    distances=scipy.spatial.distance.cdist(c0,c1)
+    def update(self,index,partial):
+        """Record a finished shard; save if the interval has passed."""
 
-                                weights = np.ones(len(distances))
-                                '''
+        self.partials[index] = partial
+        if time.time()-self.last_save>=self.interval:
+            self.save()
 
-                                if samefile and aa==ii and bb==jj and cc==kk:
-                                    distances,weights = one_dimension_with_weights(r0,c1[index+1:])
-                                else:
-                                    distances,weights = one_dimension_with_weights(r0,c1)
+    def save(self):
+        """Write the finished shards to the checkpoint file."""
 
-                                #print weights
-                                hist=np.histogram(distances,weights=weights,bins=nbins,range=(0,maxrange))
+        done = np.array([p is not None for p in self.partials])
+        if not done.any():
+            return
+        shape = np.shape(self.partials[np.flatnonzero(done)[0]])
+        partials = np.zeros((len(done),)+shape)
+        for i in np.flatnonzero(done):
+            partials[i] = self.partials[i]
 
-                                #weight_total += weights.sum()
+        tmpfile = '%s.%d.tmp' % (self.filename,os.getpid())
+        with open(tmpfile,'wb') as outfile:
+            np.savez(outfile,key=self.key,done=done,partials=partials)
+        os.rename(tmpfile,self.filename)
+        self.last_save = time.time()
 
-                                tot_freq += hist[0]
+    def remove(self):
+        """Delete the checkpoint file, once the results are safely written."""
 
-                                #print tot_freq
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
 
-                                ncalcs += len(distances)
-                                
-                                weight_tot_one = np.sum(weights)
+################################################################################
+def run_sharded(func,tasks,arrays,nproc=1,checkpoint=None):
+    """Run func(task) over all the tasks and merge the histograms.
 
-                                #print weight_tot_one 
-                                #print weights
+    Args:
+        func (function): Module-level function taking one task and returning
+                         a histogram; it reads its data from _shared_arrays.
+        tasks (list): One entry per shard.
+        arrays (dict): Arrays the shards need, by name.
+        nproc (int): Number of processes; 1 runs the shards in this process.
+        checkpoint (Checkpoint): Save the finished shards as they come in,
+                                 and skip those already saved (optional).
 
-                                #print '..........'
-                                #print 'tot'
-                                tot_weight_val += weight_tot_one
-                                #print "weight one"
-                                #print weight_tot_one, tot_weight_val
-                                del hist
+    Returns:
+        tot_freq (numpy.ndarray): The merged histogram.
+    """
 
-                    #print tot_weight_val
-   
-    #print np.sort(tot_distances)
-    #print "tot points looped over: %d" % (tot_points_looped_over)
-    print "Total weights: %f" % (tot_weight_val)
-    print "# calcs      : %f" % (ncalcs)
-    #new_tot_freq = tot_freq/tot_weight_val
-    new_tot_freq = tot_freq
-    #new_tot_freq *= ncalcs
-    #print new_tot_freq
-    return new_tot_freq
-#####################################################################################
-def do_pair_counts_2d(voxels0,voxels1,ngrids,nbins=10,maxrange=200,samefile=True):
+    if checkpoint is None:
+        partials = [None]*len(tasks)
+    else:
+        partials = checkpoint.load(len(tasks))
+    todo = [i for i in range(len(tasks)) if partials[i] is None]
+
+    if nproc<=1:
+        _init_shared_arrays(arrays)
+        for i in todo:
+            partials[i] = func(tasks[i])
+            if checkpoint is not None:
+                checkpoint.update(i,partials[i])
+    else:
+        shared = {}
+        for name in arrays:
+            shared[name] = share_array(arrays[name])
+        _init_shared_arrays(shared)
+        pool = multiprocessing.Pool(nproc)
+        try:
+            results = pool.imap(func,[tasks[i] for i in todo],chunksize=1)
+            for i,partial in zip(todo,results):
+                partials[i] = partial
+                if checkpoint is not None:
+                    checkpoint.update(i,partial)
+        finally:
+            pool.close()
+            pool.join()
+
+    _shared_arrays.clear()
+    if checkpoint is not None:
+        checkpoint.save()
+
+    return merge_pair_counts(partials)
 
-    start_time_pc = time.time()
+################################################################################
+def split_work(work,nshards):
+    """Cut a list of jobs into contiguous shards of about equal total work.
 
-    voxel_combinations_so_far = []
+    Args:
+        work (numpy.ndarray): Cost of each job.
+        nshards (int): Number of shards wanted.
 
-    tot_distances = []
+    Returns:
+        bounds (list): (lo,hi) index ranges of the shards.
+    """
 
-    tot_freq = np.zeros(nbins)
+    cumwork = np.cumsum(work,dtype=float)
+    if len(cumwork)==0:
+        return [(0,0)]
+    targets = cumwork[-1]*np.arange(1,nshards)/float(nshards)
+    cuts = np.concatenate(([0],np.searchsorted(cumwork,targets),[len(work)]))
 
-    tot_weight_val = 0
+    bounds = []
+    for i in range(0,nshards):
+        if cuts[i+1]>cuts[i]:
+            bounds.append((cuts[i],cuts[i+1]))
 
-    tot_points_looped_over = 0
+    return bounds
 
-    ncalcs = 0
+################################################################################
+def _ordered_tree(pos):
+    """Build a cKDTree on points that are already stored in tree order.
 
-    weight_total = 0
+    Returns the tree and the order the points were put in, so that
+    tree.indices is (normally) just 0,1,2,...
+    """
 
-    #Calculation Loop
-    for ii in range(0,ngrids[0]):
-        print ii,time.time()-start_time_pc
-        for jj in range(0,ngrids[1]):
-            for kk in range(0,ngrids[2]):
+    order = scipy.spatial.cKDTree(pos,balanced_tree=False).indices
+    tree = scipy.spatial.cKDTree(pos[order],balanced_tree=False)
+
+    return tree,order
+
+################################################################################
+def _ordered_cross_counts(tree0,order0,w0,tree1,order1,w1,edges):
+    """Weighted cross counts between two trees made by _ordered_tree.
+
+    Returns None if either tree did not keep its points in order, in which
+    case the scipy weight lookup can not be trusted (see
+    _cross_count_neighbors).
+    """
+
+    if tree0.n<tree1.n:
+        tree0,order0,w0,tree1,order1,w1 = tree1,order1,w1,tree0,order0,w0
+
+    if (tree0.indices==np.arange(tree0.n)).all() and \
+       (tree1.indices==np.arange(tree1.n)).all():
+        return tree0.count_neighbors(tree1,edges,
+                                     weights=(w0[order0],w1[order1]),
+                                     cumulative=False)
+
+    return None
+
+################################################################################
+def _cross_count_neighbors(pos0,w0,pos1,w1,edges):
+    """Weighted pair counts between two sets of points, binned in (r[i-1],r[i]].
+
+    In older scipy (<=1.2) count_neighbors(other,r,weights=(w0,w1)) looks up
+    the weight of each point of other with the index array of self. That is
+    harmless if both trees keep their points in tree order and self is the
+    larger one, so the trees are built that way. If the points still get
+    shuffled, both sets go in one tree and the cross terms are picked out
+    with (w0+w1)^2 - (w0-w1)^2 = 4*w0*w1.
+    """
+
+    tree0,order0 = _ordered_tree(pos0)
+    tree1,order1 = _ordered_tree(pos1)
+
+    counts = _ordered_cross_counts(tree0,order0,w0,tree1,order1,w1,edges)
+    if counts is not None:
+        return counts
+
+    tree = scipy.spatial.cKDTree(np.concatenate((pos0,pos1)))
+    wplus = np.concatenate((w0,w1))
+    wminus = np.concatenate((w0,-w1))
+    counts = tree.count_neighbors(tree,edges,weights=wplus,cumulative=False)
+    counts -= tree.count_neighbors(tree,edges,weights=wminus,cumulative=False)
+    counts /= 4.
+
+    return counts
+
+################################################################################
+def _tree_slab_counts(task):
+    """Pair counts for the galaxies of the first catalog in one x slab."""
+
+    xlo,xhi,last,edges = task
+    points0 = _shared_arrays['points0']
+    points1 = _shared_arrays['points1']
+
+    x0 = points0[:,0]
+    inslab = (x0>=xlo) & ((x0<xhi) | last)
+    x1 = points1[:,0]
+    near = (x1>=xlo-edges[-1]) & (x1<=xhi+edges[-1])
+
+    if inslab.sum()==0 or near.sum()==0:
+        return np.zeros(len(edges))
+
+    return _cross_count_neighbors(points0[inslab][:,0:3],points0[inslab][:,3],
+                                  points1[near][:,0:3],points1[near][:,3],edges)
+
+################################################################################
+def tree_pair_counts(coords0,coords1,nbins=10,maxrange=200,samefile=True,
+                     nproc=1,nshards=None,checkpoint=None):
+    """Weighted, binned pair counts from a dual-tree traversal.
+
+    Both catalogs are put in a scipy.spatial.cKDTree and the pairs are
+    counted with count_neighbors, which walks the two trees together and
+    only opens nodes that straddle a bin edge.
+
+    With nproc>1, or with a checkpoint, the first catalog is cut into
+    slabs in x, and each slab is counted against the galaxies of the
+    second catalog within maxrange of it on a pool of processes.
+
+    Args:
+        coords0 (numpy.ndarray): x,y,z,weight (and optionally more) columns
+                                 for the first catalog.
+        coords1 (numpy.ndarray): Same for the second catalog.
+        nbins (int): Number of separation bins.
+        maxrange (float): Upper edge of the last bin; the first is at 0.
+        samefile (Boolean): If true, the two catalogs are the same (DD or
+                            RR) and each pair is only counted once.
+        nproc (int): Number of processes to use.
+        nshards (int): Number of slabs (default nproc).
+        checkpoint (Checkpoint): Save the finished slabs as they come in
+                                 (see run_sharded).
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    edges = np.linspace(0,maxrange,nbins+1)
+
+    w0 = np.ascontiguousarray(coords0[:,3],dtype=float)
+
+    # Non-cumulative counts come back as (r[i-1],r[i]] with the first bin
+    # open to -inf, so using the upper edges puts zero separations in bin 0.
+    if nproc>1 or checkpoint is not None:
+        # Slabs holding roughly equal numbers of galaxies.
+        if nshards is None:
+            nshards = nproc
+        xedges = np.percentile(coords0[:,0],np.linspace(0,100,nshards+1))
+        tasks = []
+        for i in range(0,nshards):
+            tasks.append((xedges[i],xedges[i+1],i==nshards-1,edges[1:]))
+        shared = {'points0':coords0[:,0:4],'points1':coords1[:,0:4]}
+        tot_freq = run_sharded(_tree_slab_counts,tasks,shared,nproc=nproc,
+                               checkpoint=checkpoint)
+        if samefile:
+            # Every pair was found in both orders, plus each galaxy with itself.
+            tot_freq[0] -= (w0*w0).sum()
+            tot_freq /= 2.
+    elif samefile:
+        tree0 = scipy.spatial.cKDTree(coords0[:,0:3])
+        tot_freq = tree0.count_neighbors(tree0,edges[1:],weights=w0,
+                                         cumulative=False)
+        # Each galaxy is paired with itself at zero separation and every
+        # other pair is found twice.
+        tot_freq[0] -= (w0*w0).sum()
+        tot_freq /= 2.
+    else:
+        w1 = np.ascontiguousarray(coords1[:,3],dtype=float)
+        tot_freq = _cross_count_neighbors(coords0[:,0:3],w0,coords1[:,0:3],w1,
+                                          edges[1:])
+
+    return tot_freq
+
+################################################################################
+def _chunk_tree_counts(tree0,order0,w0,coords1,edges):
+    """Cross counts of a chunk of galaxies against a prebuilt tree."""
+
+    w1 = np.ascontiguousarray(coords1[:,3],dtype=float)
+    tree1,order1 = _ordered_tree(coords1[:,0:3])
+    counts = _ordered_cross_counts(tree0,order0,w0,tree1,order1,w1,edges)
+    if counts is None:
+        counts = _cross_count_neighbors(tree0.data,w0[order0],coords1[:,0:3],w1,edges)
+
+    return counts
+
+################################################################################
+def chunked_pair_counts(coords0,chunks1,nbins=10,maxrange=200):
+    """Cross (DR) pair counts against a catalog that is streamed in chunks.
+
+    The tree for coords0 is built once and every chunk of the second
+    catalog is counted against it, so only one chunk of the second catalog
+    is in memory at a time.
+
+    Args:
+        coords0 (numpy.ndarray): x,y,z,weight columns of the first catalog.
+        chunks1 (iterable): Chunks of x,y,z,weight columns of the second
+                            catalog, e.g. a CatalogChunks.
+        nbins (int): Number of separation bins.
+        maxrange (float): Upper edge of the last bin; the first is at 0.
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    edges = np.linspace(0,maxrange,nbins+1)[1:]
+    w0 = np.ascontiguousarray(coords0[:,3],dtype=float)
+    tree0,order0 = _ordered_tree(coords0[:,0:3])
+
+    tot_freq = np.zeros(nbins)
+    for chunk in chunks1:
+        if len(chunk)>0:
+            tot_freq += _chunk_tree_counts(tree0,order0,w0,chunk,edges)
+
+    return tot_freq
+
+################################################################################
+def chunked_self_pair_counts(chunks,nbins=10,maxrange=200):
+    """Auto (DD or RR) pair counts of a catalog that is streamed in chunks.
+
+    Each chunk is counted against itself and then against every later
+    chunk, so at most two chunks are in memory at a time. The chunks are
+    slices of the memory-mapped catalog table, so going over the later
+    chunks again for each chunk does not parse the catalog again.
+
+    Args:
+        chunks (CatalogChunks): The catalog, which must allow
+                                chunks.chunks(start) to restart the
+                                stream at chunk number start.
+        nbins (int): Number of separation bins.
+        maxrange (float): Upper edge of the last bin; the first is at 0.
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    edges = np.linspace(0,maxrange,nbins+1)[1:]
+
+    tot_freq = np.zeros(nbins)
+    for i,chunk in enumerate(chunks.chunks()):
+        if len(chunk)==0:
+            continue
+        tot_freq += tree_pair_counts(chunk,chunk,nbins=nbins,maxrange=maxrange,
+                                     samefile=True)
+        w0 = np.ascontiguousarray(chunk[:,3],dtype=float)
+        tree0,order0 = _ordered_tree(chunk[:,0:3])
+        for other in chunks.chunks(i+1):
+            if len(other)>0:
+                tot_freq += _chunk_tree_counts(tree0,order0,w0,other,edges)
+
+    return tot_freq
+
+################################################################################
+def incremental_pair_counts(coords_a,coords_b,counts_a,nbins=10,maxrange=200,nproc=1):
+    """Auto (DD) pair counts of catalog A with a batch B appended to it.
+
+    Only the new pairs are counted: A x B and B x B. The galaxies of A
+    further than maxrange from the bounding box of B can not pair with it
+    and are dropped first, so the cost follows the size of the batch (and
+    the part of A around it) rather than the whole catalog.
+
+    Args:
+        coords_a (numpy.ndarray): x,y,z,weight columns of catalog A.
+        coords_b (numpy.ndarray): Same for the batch B.
+        counts_a (numpy.ndarray): The DD counts of A alone, with the same
+                                  binning.
+        nbins (int): Number of separation bins.
+        maxrange (float): Upper edge of the last bin; the first is at 0.
+        nproc (int): Number of processes to use.
+
+    Returns:
+        tot_freq (numpy.ndarray): The DD counts of A and B together.
+    """
+
+    lo = coords_b[:,0:3].min(axis=0) - maxrange
+    hi = coords_b[:,0:3].max(axis=0) + maxrange
+    near = np.all((coords_a[:,0:3]>=lo) & (coords_a[:,0:3]<=hi),axis=1)
+
+    cross = np.zeros(nbins)
+    if near.any():
+        cross = tree_pair_counts(coords_a[near],coords_b,nbins=nbins,maxrange=maxrange,
+                                 samefile=False,nproc=nproc)
+    auto = tree_pair_counts(coords_b,coords_b,nbins=nbins,maxrange=maxrange,
+                            samefile=True,nproc=nproc)
+
+    return merge_pair_counts([counts_a,cross,auto])
+
+################################################################################
+def neighbor_cell_pairs(ngrids,samefile=True):
+    """List the pairs of voxels whose galaxies have to be compared.
+
+    Every voxel is paired with itself and its neighbors (including
+    diagonals). For DD or RR only half of the 26 neighbor offsets are
+    used, the ones that come after (0,0,0) in (di,dj,dk) order, so each
+    unordered pair of voxels is visited exactly once by construction.
+
+    Args:
+        ngrids (list): Number of voxels along each axis.
+        samefile (Boolean): True for DD or RR, False for DR.
 
-                c0 = voxels0[ii][jj][kk] 
+    Returns:
+        cells0 (numpy.ndarray): Linear index of the first voxel of each pair.
+        cells1 (numpy.ndarray): Linear index of the second voxel.
+    """
 
-                if len(c0)==0:
+    offsets = []
+    for di in (-1,0,1):
+        for dj in (-1,0,1):
+            for dk in (-1,0,1):
+                if samefile and (di,dj,dk)<(0,0,0):
                     continue
+                offsets.append((di,dj,dk))
 
-                tot_points_looped_over += len(c0)
+    grid = np.indices(ngrids).reshape(3,-1)
 
-                #print 
-                #print ii,jj,kk
+    cells0 = []
+    cells1 = []
+    for offset in offsets:
+        neighbor = grid + np.array(offset).reshape(3,1)
+        inside = np.ones(grid.shape[1],dtype=bool)
+        for i in range(0,3):
+            inside &= (neighbor[i]>=0) & (neighbor[i]<ngrids[i])
+        cells0.append(np.ravel_multi_index(tuple(grid[:,inside]),ngrids))
+        cells1.append(np.ravel_multi_index(tuple(neighbor[:,inside]),ngrids))
 
-                iimin = ii-1
-                iimax = ii+2
-                if iimax>=ngrids[0]:
-                    iimax = ngrids[0]
-                if iimin<0:
-                    iimin=0
-                jjmin = jj-1
-                jjmax = jj+2
-                if jjmax>=ngrids[1]:
-                    jjmax = ngrids[1]
-                if jjmin<0:
-                    jjmin=0
-                kkmin = kk-1
-                kkmax = kk+2
-                if kkmax>=ngrids[2]:
-                    kkmax = ngrids[2]
-                if kkmin<0:
-                    kkmin=0
+    cells0 = np.concatenate(cells0)
+    cells1 = np.concatenate(cells1)
 
-                for aa in range(iimin,iimax):
-                    for bb in range(jjmin,jjmax):
-                        for cc in range(kkmin,kkmax):
+    order = np.lexsort((cells1,cells0))
 
-                            if samefile:
-                                combination0 = "%03s%03s%03s" % (cc,bb,aa)
-                                combination1 = "%03s%03s%03s" % (kk,jj,ii)
-                                combination = "%s%s" % (max(combination0,combination1),min(combination0,combination1))
+    return cells0[order],cells1[order]
 
-                                if combination in voxel_combinations_so_far:
-                                    continue
-                                else:
-                                    voxel_combinations_so_far.append(combination)
+################################################################################
+def bin_index(values,edges,log=False):
+    """Bin number of each value for evenly spaced bin edges.
 
-                            c1 = voxels1[aa][bb][cc] 
+    Gives the same answer as np.histogram, including the closed last bin
+    and its correction for values that round onto the wrong side of an edge.
 
-                            if len(c1)==0:
-                                continue
+    Args:
+        values (numpy.ndarray): Values to bin.
+        edges (numpy.ndarray): Evenly spaced bin edges (from np.linspace),
+                               or evenly spaced in log10 if log is set.
+        log (Boolean): If true, the edges are logarithmic (np.logspace).
 
-                            # These will store the calculations.
-                            for index,r0 in enumerate(c0):
+    Returns:
+        index (numpy.ndarray): Bin of each value, -1 if it is outside the edges.
+    """
 
-                                '''
-                                if samefile and aa==ii and bb==jj and cc==kk:
-                                    distances = distances=scipy.spatial.distance.pdist(c0)
-                                else:
-                                    distances=scipy.spatial.distance.cdist(c0,c1)
+    if log:
+        index = -1*np.ones(values.shape,dtype=np.intp)
+        positive = values>0
+        index[positive] = bin_index(np.log10(values[positive]),np.log10(edges))
+        return index
 
-                                weights = np.ones(len(distances))
-                                '''
+    nbins = len(edges)-1
+    lo = edges[0]
+    hi = edges[-1]
 
-                                if samefile and aa==ii and bb==jj and cc==kk:
-                                    paras,perps,weights = our_para_perp_with_weights(r0,c1[index+1:])
-                                else:
-                                    paras,perps,weights = our_para_perp_with_weights(r0,c1)
+    index = -1*np.ones(values.shape,dtype=np.intp)
+    inside = (values>=lo) & (values<=hi)
+    v = values[inside]
 
-                                #print weights
-                                hist=np.histogram2d(perps,paras,bins=nbins,range=((-maxrange,maxrange),(-maxrange,maxrange)))
+    i = ((v-lo)*(nbins/float(hi-lo))).astype(np.intp)
+    i[i==nbins] -= 1
+    decrement = v<edges[i]
+    i[decrement] -= 1
+    increment = (v>=edges[i+1]) & (i!=nbins-1)
+    i[increment] += 1
 
-                                #weight_total += weights.sum()
+    index[inside] = i
 
-                                tot_freq += hist[0]
+    return index
 
-                                #print tot_freq
+################################################################################
+# Number of galaxy pairs handled at once by block_pair_counts. 2**15 pairs
+# keeps the temporaries for a tile (a few arrays of doubles) within L2 cache.
+BLOCK_SIZE = 2**15
 
-                                ncalcs += len(distances)
-                                
-                                weight_tot_one = np.sum(weights)
+def close_pairs(c0,c1,maxrange,same=False):
+    """All pairs between two blocks of galaxies closer than maxrange.
 
-                                #print weight_tot_one 
-                                #print weights
+    The c0 x c1 squared distances are computed a tile of about BLOCK_SIZE
+    pairs at a time; this is the inner loop shared by the block kernels.
 
-                                #print '..........'
-                                #print 'tot'
-                                tot_weight_val += weight_tot_one
-                                #print "weight one"
-                                #print weight_tot_one, tot_weight_val
-                                del hist
+    Args:
+        c0 (numpy.ndarray): Rows of the first block (x,y,z first).
+        c1 (numpy.ndarray): Same for the second block.
+        maxrange (float): Largest separation to keep.
+        same (Boolean): If true, c0 and c1 are the same block and only the
+                        pairs (i,j) with j>i are returned.
+
+    Yields:
+        p0, p1 (numpy.ndarray): The rows of the two galaxies in each pair.
+        d2 (numpy.ndarray): Their squared separations.
+    """
 
-                    #print tot_weight_val
-   
-    #print np.sort(tot_distances)
-    #print "tot points looped over: %d" % (tot_points_looped_over)
-    print "Total weights: %f" % (tot_weight_val)
-    print "# calcs      : %f" % (ncalcs)
-    new_tot_freq = tot_freq/tot_weight_val
-    #new_tot_freq = tot_freq
-    #new_tot_freq *= ncalcs
-    #print new_tot_freq
-    return new_tot_freq
+    n0 = len(c0)
+    n1 = len(c1)
+    if n0==0 or n1==0:
+        return
 
-    
+    maxrange2 = maxrange*maxrange
+    ncols = min(n1,BLOCK_SIZE)
+    nrows = max(1,BLOCK_SIZE//ncols)
+
+    for lo0 in range(0,n0,nrows):
+        hi0 = min(lo0+nrows,n0)
+        p0 = c0[lo0:hi0]
+
+        start1 = 0
+        if same:
+            start1 = lo0+1
+
+        for lo1 in range(start1,n1,ncols):
+            hi1 = min(lo1+ncols,n1)
+            p1 = c1[lo1:hi1]
+
+            d2 = np.subtract.outer(p0[:,0],p1[:,0])
+            d2 *= d2
+            for i in (1,2):
+                diff = np.subtract.outer(p0[:,i],p1[:,i])
+                diff *= diff
+                d2 += diff
+
+            close = d2<=maxrange2
+            if same:
+                close &= np.arange(lo1,hi1)>np.arange(lo0,hi0)[:,np.newaxis]
+            rows,cols = np.nonzero(close)
+
+            yield p0[rows],p1[cols],d2[rows,cols]
+
+################################################################################
+def block_pair_counts(c0,c1,edges,same=False,tot_freq=None):
+    """Histogram the separations of all pairs between two blocks of galaxies.
+
+    The c0 x c1 distances are computed a tile at a time and each tile is
+    binned with one np.bincount, weighting each pair by w0*w1.
+
+    Args:
+        c0 (numpy.ndarray): x,y,z,weight rows of the first block.
+        c1 (numpy.ndarray): Same for the second block.
+        edges (numpy.ndarray): Evenly spaced separation bin edges.
+        same (Boolean): If true, c0 and c1 are the same block and only the
+                        pairs (i,j) with j>i are counted.
+        tot_freq (numpy.ndarray): Histogram to add to (optional).
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    nbins = len(edges)-1
+    if tot_freq is None:
+        tot_freq = np.zeros(nbins)
+
+    for p0,p1,d2 in close_pairs(c0,c1,edges[-1],same=same):
+        index = bin_index(np.sqrt(d2),edges)
+        weights = p0[:,3]*p1[:,3]
+        inside = index>=0
+        tot_freq += np.bincount(index[inside],weights=weights[inside],
+                                minlength=nbins)
+
+    return tot_freq
+
+################################################################################
+def pair_search_radius(perp_max,para_max,convention='midpoint',dmin=None):
+    """Largest straight-line separation of a pair inside the (r_perp,
+    r_parallel) box, for picking the candidate pairs.
+
+    For 'midpoint' and 'lado' this is sqrt(perp_max^2 + para_max^2). For
+    'angular', r_perp = theta*|r0| is measured at the nearer galaxy and the
+    separation satisfies s^2 <= r_par^2 + r_perp^2*|r1|/|r0|, so it also
+    depends on the smallest distance dmin of the galaxies.
+
+    Args:
+        perp_max, para_max (float): Upper edges in r_perp and r_parallel.
+        convention (str): Line of sight (see jem_kernels).
+        dmin (float): Smallest distance of the galaxies ('angular' only).
+
+    Returns:
+        radius (float): The search radius.
+    """
+
+    if convention!='angular':
+        return np.sqrt(perp_max**2 + para_max**2)
+    if dmin is None or dmin<=0:
+        return np.inf
+
+    return np.sqrt(para_max**2 + perp_max**2*(1+para_max/dmin))
+
+def block_pair_counts_2d(c0,c1,perp_edges,para_edges,log_perp=False,
+                         log_para=False,same=False,tot_freq=None,
+                         convention='midpoint'):
+    """Histogram all pairs between two blocks in (r_perp, r_parallel).
+
+    The line of sight is the midpoint of the pair (see
+    our_para_perp_with_weights) unless another convention is given, and
+    r_parallel is taken as positive. For 'angular', r_perp is measured at
+    the nearer galaxy of each pair, so a pair is binned the same way
+    whichever block it comes from. The pairs are binned straight into a
+    flattened nperp x npara grid with one np.bincount per tile, weighting
+    each pair by w0*w1.
+
+    Args:
+        c0 (numpy.ndarray): x,y,z,weight rows of the first block.
+        c1 (numpy.ndarray): Same for the second block.
+        perp_edges (numpy.ndarray): r_perp bin edges.
+        para_edges (numpy.ndarray): r_parallel bin edges.
+        log_perp (Boolean): If true, perp_edges are logarithmic.
+        log_para (Boolean): If true, para_edges are logarithmic.
+        same (Boolean): If true, c0 and c1 are the same block and only the
+                        pairs (i,j) with j>i are counted.
+        tot_freq (numpy.ndarray): nperp x npara histogram to add to (optional).
+        convention (str): Line of sight, 'midpoint', 'lado' or 'angular'
+                          (see jem_kernels).
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    nperp = len(perp_edges)-1
+    npara = len(para_edges)-1
+    if tot_freq is None:
+        tot_freq = np.zeros((nperp,npara))
+
+    if len(c0)==0 or len(c1)==0:
+        return tot_freq
+
+    dmin = None
+    if convention=='angular':
+        dmin = min(mag(c0[:,0:3]).min(),mag(c1[:,0:3]).min())
+    maxrange = pair_search_radius(perp_edges[-1],para_edges[-1],convention,dmin)
+    flat = tot_freq.reshape(-1)
+    kernel = jem_kernels.get_kernel(convention)
+
+    for p0,p1,d2 in close_pairs(c0,c1,maxrange,same=same):
+        if convention=='angular':
+            swap = ((p0[:,0:3]**2).sum(axis=1) > (p1[:,0:3]**2).sum(axis=1))[:,np.newaxis]
+            p0,p1 = np.where(swap,p1,p0),np.where(swap,p0,p1)
+        s,mu,para,perp = kernel.pairs(p0,p1)
+        para = np.abs(para,out=para)
+
+        iperp = bin_index(perp,perp_edges,log=log_perp)
+        ipara = bin_index(para,para_edges,log=log_para)
+        inside = (iperp>=0) & (ipara>=0)
+        weights = p0[:,3]*p1[:,3]
+        flat += np.bincount(iperp[inside]*npara+ipara[inside],
+                            weights=weights[inside],minlength=nperp*npara)
+
+    return tot_freq
+
+################################################################################
+def _grid_shard_counts(task):
+    """Pair counts over one shard of voxel pairs, with any block kernel."""
+
+    cells0,cells1,samefile,kernel,kwargs = task
+    points0 = _shared_arrays['points0']
+    offsets0 = _shared_arrays['offsets0']
+    points1 = _shared_arrays['points1']
+    offsets1 = _shared_arrays['offsets1']
+
+    # Start from an empty histogram of the right shape.
+    tot_freq = kernel(points0[:0],points1[:0],**kwargs)
+
+    for icell0,icell1 in zip(cells0,cells1):
+
+        c0 = points0[offsets0[icell0]:offsets0[icell0+1]]
+        c1 = points1[offsets1[icell1]:offsets1[icell1+1]]
+
+        kernel(c0,c1,same=(samefile and icell0==icell1),tot_freq=tot_freq,
+               **kwargs)
+
+    return tot_freq
 
+################################################################################
+def grid_pair_counts(voxels0,voxels1,ngrids,kernel,kwargs,samefile=True,
+                     nproc=1,nshards=None,checkpoint=None):
+    """Run a block kernel over every pair of neighboring voxels.
+
+    This is the traversal shared by the grid pair counters: the voxel
+    pairs come from neighbor_cell_pairs, are split into shards of about
+    equal work, and each shard is run through the kernel (see
+    block_pair_counts) on nproc processes.
+
+    Args:
+        voxels0 (CellList): Voxelized first catalog.
+        voxels1 (CellList): Voxelized second catalog.
+        ngrids (list): Number of voxels along each axis.
+        kernel (function): Block kernel, called as
+                           kernel(c0,c1,same=...,tot_freq=...,**kwargs).
+        kwargs (dict): Binning arguments for the kernel.
+        samefile (Boolean): True for DD or RR, False for DR.
+        nproc (int): Number of processes.
+        nshards (int): Number of shards (default 4*nproc).
+        checkpoint (Checkpoint): Save the finished shards as they come in
+                                 (see run_sharded).
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    # Only keep the voxel pairs that have galaxies on both sides.
+    cells0,cells1 = neighbor_cell_pairs(ngrids,samefile=samefile)
+    keep = (voxels0.counts[cells0]>0) & (voxels1.counts[cells1]>0)
+    cells0 = cells0[keep]
+    cells1 = cells1[keep]
+
+    # Several shards per process so the slow ones even out.
+    if nshards is None:
+        nshards = 4*nproc
+    work = voxels0.counts[cells0]*voxels1.counts[cells1]
+    tasks = []
+    for lo,hi in split_work(work,nshards):
+        tasks.append((cells0[lo:hi],cells1[lo:hi],samefile,kernel,kwargs))
+
+    arrays = {'points0':voxels0.points,'offsets0':voxels0.offsets,
+              'points1':voxels1.points,'offsets1':voxels1.offsets}
+
+    return run_sharded(_grid_shard_counts,tasks,arrays,nproc=nproc,
+                       checkpoint=checkpoint)
+
+############################################################################
+def do_pair_counts(voxels0,voxels1,ngrids,nbins=10,maxrange=200,samefile=True,
+                   engine='tree',nproc=1,nshards=None,checkpoint=None):
+    """Weighted pair counts in bins of separation.
+
+    Args:
+        voxels0 (CellList): Voxelized first catalog (see voxelize_the_data).
+        voxels1 (CellList): Voxelized second catalog.
+        ngrids (list): Number of voxels along each axis.
+        nbins (int): Number of separation bins.
+        maxrange (float): Maximum separation.
+        samefile (Boolean): True for DD or RR, False for DR.
+        engine (str): 'tree' to use the kd-tree pair counter, 'grid'
+                      to loop over neighboring voxels.
+        nproc (int): Number of processes to share the work between.
+        nshards (int): Number of pieces to cut the work into (optional).
+        checkpoint (Checkpoint): Save the finished pieces as they come in,
+                                 and skip any already in the checkpoint.
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    start_time_pc = time.time()
+
+    if engine=='tree':
+        tot_freq = tree_pair_counts(voxels0.points,voxels1.points,nbins=nbins,
+                                    maxrange=maxrange,samefile=samefile,
+                                    nproc=nproc,nshards=nshards,
+                                    checkpoint=checkpoint)
+        print "Time for tree pair counts: %f" % (time.time()-start_time_pc)
+        return tot_freq
+    elif engine!='grid':
+        raise ValueError("Unrecognized pair counting engine %s" % (engine))
+
+    tot_freq = grid_pair_counts(voxels0,voxels1,ngrids,block_pair_counts,
+                                {'edges':np.linspace(0,maxrange,nbins+1)},
+                                samefile=samefile,nproc=nproc,nshards=nshards,
+                                checkpoint=checkpoint)
+
+    print "Time for grid pair counts: %f" % (time.time()-start_time_pc)
+
+    return tot_freq
+
+################################################################################
+def do_pair_counts_2d(voxels0,voxels1,ngrids,nbins=10,maxrange=200,samefile=True,
+                      perp_edges=None,para_edges=None,log_perp=False,
+                      log_para=False,nproc=1,convention='midpoint',
+                      nshards=None,checkpoint=None):
+    """Weighted pair counts in bins of r_perp and r_parallel.
+
+    Uses the same voxel-pair traversal as the grid engine of
+    do_pair_counts, with block_pair_counts_2d binning each pair straight
+    into the 2D grid. The voxels must be at least as wide as the largest
+    separation of a pair inside the grid, see pair_search_radius.
+
+    Args:
+        voxels0 (CellList): Voxelized first catalog (see voxelize_the_data).
+        voxels1 (CellList): Voxelized second catalog.
+        ngrids (list): Number of voxels along each axis.
+        nbins (int): Number of bins along each axis, if the edges are
+                     not given.
+        maxrange (float): Upper edge along each axis, if the edges are
+                          not given.
+        samefile (Boolean): True for DD or RR, False for DR.
+        perp_edges (numpy.ndarray): r_perp bin edges (optional).
+        para_edges (numpy.ndarray): r_parallel bin edges (optional).
+        log_perp (Boolean): If true, perp_edges are evenly spaced in log.
+        log_para (Boolean): If true, para_edges are evenly spaced in log.
+        nproc (int): Number of processes to share the work between.
+        convention (str): Line of sight, 'midpoint', 'lado' or 'angular'
+                          (see jem_kernels).
+        nshards (int): Number of pieces to cut the work into (optional).
+        checkpoint (Checkpoint): Save the finished pieces as they come in,
+                                 and skip any already in the checkpoint.
+
+    Returns:
+        tot_freq (numpy.ndarray): nperp x npara summed pair weights.
+    """
+
+    start_time_pc = time.time()
+
+    if perp_edges is None:
+        perp_edges = np.linspace(0,maxrange,nbins+1)
+    if para_edges is None:
+        para_edges = np.linspace(0,maxrange,nbins+1)
+
+    # An axis with a single voxel holds every pair along it, whatever its
+    # width.
+    maxsep = np.sqrt(perp_edges[-1]**2 + para_edges[-1]**2)
+    if voxels0.gridwidths is not None:
+        widths = [w for n,w in zip(voxels0.ngrids,voxels0.gridwidths) if n>1]
+        if len(widths)>0 and min(widths)<maxsep:
+            raise ValueError("Voxels of width %f are too small for separations up to %f" % (min(widths),maxsep))
+
+    kwargs = {'perp_edges':perp_edges,'para_edges':para_edges,
+              'log_perp':log_perp,'log_para':log_para,
+              'convention':convention}
+    tot_freq = grid_pair_counts(voxels0,voxels1,ngrids,block_pair_counts_2d,
+                                kwargs,samefile=samefile,nproc=nproc,
+                                nshards=nshards,checkpoint=checkpoint)
+
+    print "Time for 2D pair counts: %f" % (time.time()-start_time_pc)
+
+    return tot_freq
+
+################################################################################
+# Jackknife regions
+################################################################################
+def _ra_gap_center(ra):
+    """RA (radians) in the middle of the largest empty gap in RA."""
+
+    ra = np.sort(np.mod(ra,2*np.pi))
+    gaps = np.diff(np.append(ra,ra[0]+2*np.pi))
+    i = np.argmax(gaps)
+
+    return np.mod(ra[i]+0.5*gaps[i],2*np.pi)
+
+def jackknife_edges(ra,dec,nra=4,ndec=4):
+    """Split the sky into nra x ndec regions holding equal numbers of points.
+
+    The points are first cut into nra stripes in RA, and each stripe is
+    then cut into ndec pieces in Dec. Compute the edges once, usually from
+    the randoms, and label every catalog with them so that the regions are
+    the same for DD, DR and RR.
+
+    RA is measured from the middle of the largest empty gap in RA, so a
+    footprint that straddles RA = 0 or RA = 180 deg is not split across
+    the wrap and every stripe is one connected patch.
+
+    Args:
+        ra, dec (numpy.ndarray): Right Ascension and Declination (radians).
+        nra, ndec (int): Number of regions along each direction.
+
+    Returns:
+        ra_edges (numpy.ndarray): nra+1 edges in the rotated RA.
+        dec_edges (numpy.ndarray): nra x (ndec+1) edges in Dec, one row
+                                   per RA stripe.
+        ra_offset (float): RA the stripes are measured from.
+    """
+
+    ra_offset = _ra_gap_center(ra)
+    ra = np.mod(ra-ra_offset,2*np.pi)
+
+    ra_edges = np.percentile(ra,np.linspace(0,100,nra+1))
+    ra_edges[0] = -np.inf
+    ra_edges[-1] = np.inf
+
+    stripe = np.clip(np.searchsorted(ra_edges,ra,side='right')-1,0,nra-1)
+    dec_edges = np.zeros((nra,ndec+1))
+    for i in range(nra):
+        dec_edges[i] = np.percentile(dec[stripe==i],np.linspace(0,100,ndec+1))
+    dec_edges[:,0] = -np.inf
+    dec_edges[:,-1] = np.inf
+
+    return ra_edges,dec_edges,ra_offset
+
+def jackknife_labels(ra,dec,edges):
+    """Region number (0 to nra*ndec-1) of each point, see jackknife_edges."""
+
+    ra_edges,dec_edges,ra_offset = edges
+    nra,ndec = dec_edges.shape[0],dec_edges.shape[1]-1
+
+    ra = np.mod(ra-ra_offset,2*np.pi)
+    stripe = np.clip(np.searchsorted(ra_edges,ra,side='right')-1,0,nra-1)
+    labels = np.zeros(len(ra),dtype=int)
+    for i in range(nra):
+        instripe = stripe==i
+        piece = np.searchsorted(dec_edges[i],dec[instripe],side='right')-1
+        labels[instripe] = i*ndec + np.clip(piece,0,ndec-1)
+
+    return labels
+
+def xyz2radec(coords):
+    """RA and Dec (radians) of x,y,z positions."""
+
+    ra = np.arctan2(coords[:,1],coords[:,0])
+    dec = np.arcsin(coords[:,2]/mag(coords[:,0:3]))
+
+    return ra,dec
+
+################################################################################
+def block_region_pair_counts(c0,c1,edges,nregions,same=False,tot_freq=None):
+    """Histogram the pairs between two blocks separately for every pair of
+    jackknife regions.
+
+    Like block_pair_counts, but the last column of each row holds the
+    region label of the galaxy, and each pair lands in
+    tot_freq[region0,region1,bin].
+
+    Args:
+        c0 (numpy.ndarray): x,y,z,weight,...,label rows of the first block.
+        c1 (numpy.ndarray): Same for the second block.
+        edges (numpy.ndarray): Evenly spaced separation bin edges.
+        nregions (int): Number of jackknife regions.
+        same (Boolean): If true, c0 and c1 are the same block and only the
+                        pairs (i,j) with j>i are counted.
+        tot_freq (numpy.ndarray): nregions x nregions x nbins histogram
+                                  to add to (optional).
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights.
+    """
+
+    nbins = len(edges)-1
+    if tot_freq is None:
+        tot_freq = np.zeros((nregions,nregions,nbins))
+    flat = tot_freq.reshape(-1)
+
+    for p0,p1,d2 in close_pairs(c0,c1,edges[-1],same=same):
+        index = bin_index(np.sqrt(d2),edges)
+        inside = index>=0
+        region_pair = p0[:,-1].astype(int)*nregions + p1[:,-1].astype(int)
+        flat += np.bincount((region_pair*nbins + index)[inside],
+                            weights=(p0[:,3]*p1[:,3])[inside],
+                            minlength=len(flat))
+
+    return tot_freq
+
+def do_region_pair_counts(voxels0,voxels1,ngrids,nregions,nbins=10,
+                          maxrange=200,samefile=True,nproc=1,nshards=None,
+                          checkpoint=None):
+    """Pair counts for every pair of jackknife regions, in one pass.
+
+    The last column of the voxelized catalogs must hold the region label
+    of each galaxy (see jackknife_labels). For DD or RR the counts are
+    folded so that each pair of regions is in the upper triangle.
+
+    Args:
+        voxels0 (CellList): Voxelized first catalog (see voxelize_the_data).
+        voxels1 (CellList): Voxelized second catalog.
+        ngrids (list): Number of voxels along each axis.
+        nregions (int): Number of jackknife regions.
+        nbins (int): Number of separation bins.
+        maxrange (float): Maximum separation.
+        samefile (Boolean): True for DD or RR, False for DR.
+        nproc (int): Number of processes to share the work between.
+        nshards (int): Number of pieces to cut the work into (optional).
+        checkpoint (Checkpoint): See do_pair_counts.
+
+    Returns:
+        tot_freq (numpy.ndarray): nregions x nregions x nbins summed pair
+                                  weights. Summed over the first two
+                                  axes it is the do_pair_counts result.
+    """
+
+    start_time_pc = time.time()
+
+    kwargs = {'edges':np.linspace(0,maxrange,nbins+1),'nregions':nregions}
+    tot_freq = grid_pair_counts(voxels0,voxels1,ngrids,block_region_pair_counts,
+                                kwargs,samefile=samefile,nproc=nproc,
+                                nshards=nshards,checkpoint=checkpoint)
+
+    if samefile:
+        # Which galaxy of a pair comes first depends on the traversal.
+        lower = np.tril_indices(nregions,-1)
+        upper = (lower[1],lower[0])
+        tot_freq[upper] += tot_freq[lower]
+        tot_freq[lower] = 0
+
+    print "Time for region pair counts: %f" % (time.time()-start_time_pc)
+
+    return tot_freq
+
+def jackknife_pair_counts(region_counts):
+    """Pair counts with each jackknife region left out in turn.
+
+    Removing region k drops every pair with either galaxy in it, i.e.
+    row k and column k of the region-pair matrix.
+
+    Args:
+        region_counts (numpy.ndarray): nregions x nregions x nbins, from
+                                       do_region_pair_counts.
+
+    Returns:
+        counts (numpy.ndarray): nregions x nbins; row k is the total count
+                                without region k.
+    """
+
+    total = region_counts.sum(axis=(0,1))
+    rows = region_counts.sum(axis=1)
+    cols = region_counts.sum(axis=0)
+    diagonal = np.einsum('kkb->kb',region_counts)
+
+    return total - rows - cols + diagonal
+
+def jackknife_weight_totals(w0,labels0,w1,labels1,nregions,samefile=True):
+    """pair_weight_totals for each jackknife realization.
+
+    Returns:
+        tot_weights (numpy.ndarray): nregions x 4; row k holds tot_weight0
+                                     to tot_weight3 without region k.
+    """
+
+    sum0 = np.bincount(labels0,weights=w0,minlength=nregions)
+    sum1 = np.bincount(labels1,weights=w1,minlength=nregions)
+    tot_weights = np.zeros((nregions,4))
+    tot_weights[:,0] = sum0.sum() - sum0
+    tot_weights[:,1] = sum1.sum() - sum1
+    tot_weights[:,2] = tot_weights[:,0]*tot_weights[:,1]
+
+    if samefile:
+        sum2 = np.bincount(labels0,weights=w0*w1,minlength=nregions)
+        tot_weights[:,3] = sum2.sum() - sum2
+        tot_weights[:,2] = (tot_weights[:,2] - tot_weights[:,3])/2.
+    else:
+        tot_weights[:,3] = 1.0
+
+    return tot_weights
+
+################################################################################
+# Angular pair counts
+#
+# For w(theta) the galaxies are put on the unit sphere. The straight-line
+# (chord) distance between two unit vectors is 2*sin(theta/2), which grows
+# with theta, so the angular bins map onto chord bins and the pairs can be
+# counted with the same tree and cell engines as the 3D counts, without an
+# arccos for every pair.
+################################################################################
+# Cap on the number of voxels along each axis for the angular grid engine;
+# at small angles the voxels would otherwise be far smaller than needed.
+ANGULAR_MAX_GRID = 100
+
+def read_angular_catalog(infilename):
+    """Read RA, Dec and weight from a photometric (no redshift) catalog.
+
+    FITS files need RA and DEC columns (PLUG_RA and PLUG_DEC for SDSS)
+    and an optional WEIGHT column; text files have ra,dec and optionally
+    a weight in the first columns. Angles are in degrees in the file.
+
+    Args:
+        infilename (str): The name of the data file.
+
+    Returns:
+        ra, dec (numpy.ndarray): Right Ascension and Declination in radians
+        weights (numpy.ndarray): The weights, or ones if there are none.
+    """
+    if(infilename.find('fits')>=0):
+        print 'Reading in FITS Data'
+        hdulist1=fits.open(infilename)
+        data=hdulist1[1].data
+        names=[name.upper() for name in data.columns.names]
+        if 'RA' in names:
+            ra,dec=data['RA'],data['DEC']
+        else:
+            ra,dec=data['PLUG_RA'],data['PLUG_DEC']
+        ra=np.deg2rad(np.array(ra,dtype=float))
+        dec=np.deg2rad(np.array(dec,dtype=float))
+        if 'WEIGHT' in names:
+            weights=np.array(data['WEIGHT'],dtype=float)
+        else:
+            weights=np.ones(len(ra))
+        hdulist1.close()
+    else:
+        print 'Reading in Text File'
+        r=np.loadtxt(infilename,ndmin=2)
+        ra=np.deg2rad(r[:,0])
+        dec=np.deg2rad(r[:,1])
+        if r.shape[1]>2:
+            weights=r[:,2].copy()
+        else:
+            weights=np.ones(len(ra))
+
+    return ra,dec,weights
+
+def radec2unit(ra,dec,weights=None):
+    """Unit vectors on the sphere, with the weights as a fourth column.
+
+    Args:
+        ra, dec (numpy.ndarray): Right Ascension and Declination in radians
+        weights (numpy.ndarray): Weights (default ones).
+
+    Returns:
+        coords (numpy.ndarray): x,y,z,weight columns.
+    """
+
+    if weights is None:
+        weights = np.ones(len(ra))
+    cosdec = np.cos(dec)
+
+    return np.column_stack((cosdec*np.cos(ra),cosdec*np.sin(ra),np.sin(dec),weights))
+
+def theta2chord(theta):
+    """Chord length between two unit vectors theta degrees apart."""
+
+    return 2*np.sin(np.deg2rad(np.asarray(theta,dtype=float))/2.)
+
+def chord2theta(chord):
+    """Inverse of theta2chord, in degrees."""
+
+    return np.rad2deg(2*np.arcsin(np.clip(np.asarray(chord,dtype=float)/2.,0,1)))
+
+def block_chord_pair_counts(c0,c1,chord_edges,same=False,tot_freq=None):
+    """Histogram the chord separations of all pairs between two blocks.
+
+    The bins are (chord_edges[i],chord_edges[i+1]], found by searching the
+    squared edges, so neither a square root nor an arccos is taken per
+    pair. If the first edge is 0, pairs at zero separation go in the
+    first bin. The edges can have any spacing.
+
+    Args:
+        c0 (numpy.ndarray): x,y,z,weight rows of the first block.
+        c1 (numpy.ndarray): Same for the second block.
+        chord_edges (numpy.ndarray): Increasing chord bin edges.
+        same (Boolean): If true, c0 and c1 are the same block and only the
+                        pairs (i,j) with j>i are counted.
+        tot_freq (numpy.ndarray): Histogram to add to (optional).
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each bin.
+    """
+
+    nbins = len(chord_edges)-1
+    if tot_freq is None:
+        tot_freq = np.zeros(nbins)
+
+    edges2 = np.asarray(chord_edges,dtype=float)**2
+    for p0,p1,d2 in close_pairs(c0,c1,chord_edges[-1],same=same):
+        index = np.searchsorted(edges2,d2,side='left')-1
+        if edges2[0]<=0:
+            index[index<0] = 0
+        inside = (index>=0) & (index<nbins)
+        weights = p0[:,3]*p1[:,3]
+        tot_freq += np.bincount(index[inside],weights=weights[inside],
+                                minlength=nbins)
+
+    return tot_freq
+
+def angular_pair_counts(coords0,coords1,theta_edges,samefile=True,engine='tree',
+                        nproc=1,nshards=None,checkpoint=None):
+    """Weighted pair counts in bins of angular separation.
+
+    Args:
+        coords0 (numpy.ndarray): x,y,z,weight columns of unit vectors for
+                                 the first catalog (see radec2unit).
+        coords1 (numpy.ndarray): Same for the second catalog.
+        theta_edges (numpy.ndarray): Increasing bin edges in degrees, with
+                                     any spacing (e.g. np.logspace).
+        samefile (Boolean): True for DD or RR, False for DR.
+        engine (str): 'tree' for the kd-tree counter, 'grid' to loop over
+                      neighboring voxels.
+        nproc, nshards, checkpoint: For the grid engine, as in
+                                    do_pair_counts.
+
+    Returns:
+        tot_freq (numpy.ndarray): The summed pair weights in each theta bin.
+    """
+
+    start_time_pc = time.time()
+
+    chord_edges = theta2chord(theta_edges)
+    if np.any(np.diff(chord_edges)<=0) or theta_edges[-1]>180:
+        raise ValueError("The theta edges must increase and lie between 0 and 180 degrees")
+
+    if engine=='tree':
+        # count_neighbors bins in (r[i-1],r[i]] with the first bin open to
+        # -inf, so counting with all the edges and dropping the first bin
+        # leaves the pairs in (chord_edges[0],chord_edges[-1]].
+        w0 = np.ascontiguousarray(coords0[:,3],dtype=float)
+        if samefile:
+            tree0 = scipy.spatial.cKDTree(coords0[:,0:3])
+            counts = tree0.count_neighbors(tree0,chord_edges,weights=w0,
+                                           cumulative=False)
+            counts[0] -= (w0*w0).sum()
+            counts /= 2.
+        else:
+            w1 = np.ascontiguousarray(coords1[:,3],dtype=float)
+            counts = _cross_count_neighbors(coords0[:,0:3],w0,coords1[:,0:3],w1,
+                                            chord_edges)
+        if chord_edges[0]<=0:
+            counts[1] += counts[0]
+        tot_freq = counts[1:]
+        print "Time for angular tree pair counts: %f" % (time.time()-start_time_pc)
+        return tot_freq
+    elif engine!='grid':
+        raise ValueError("Unrecognized pair counting engine %s" % (engine))
+
+    # Voxels at least as wide as the largest chord, but not so many of
+    # them that the empty ones dominate.
+    extent = max(np.ptp(np.concatenate((coords0[:,i],coords1[:,i]))) for i in range(0,3))
+    voxels0,voxels1,ngrids = voxelize_the_data(coords0,coords1,
+                                               maxsep=max(chord_edges[-1],extent/ANGULAR_MAX_GRID))[0:3]
+    tot_freq = grid_pair_counts(voxels0,voxels1,ngrids,block_chord_pair_counts,
+                                {'chord_edges':chord_edges},samefile=samefile,
+                                nproc=nproc,nshards=nshards,checkpoint=checkpoint)
+
+    print "Time for angular grid pair counts: %f" % (time.time()-start_time_pc)
+
+    return tot_freq
@@ -5,58 +5,27 @@ import math
 from matplotlib.colors import LogNorm
 import matplotlib as mpl
 import sys
+import os
+
+import jem_estimators as est
 
 tag = ""
 if len(sys.argv)>1:
     tag = sys.argv[1]
 
-DD=np.loadtxt(tag+'DD.dat',dtype='float',unpack=True,delimiter=',')
-DR=np.loadtxt(tag+'DR.dat',dtype='float',unpack=True,delimiter=',')
-RR=np.loadtxt(tag+'RR.dat',dtype='float',unpack=True,delimiter=',')
-
-ndata=DD[0][0]
-nrand=RR[0][0]
-
-sum_wd = DD[2][0]
-sum_wd2 = DD[5][0]
-sum_wr = RR[2][0]
-sum_wr2 = RR[5][0]
-
-print sum_wd
-print sum_wd2 
-print sum_wr 
-print sum_wr2 
-print
-
-norm_dd = 0.5*(sum_wd*sum_wd - sum_wd2) 
-norm_rr = 0.5*(sum_wr*sum_wr - sum_wr2)
-#norm_dd = sum_wd*sum_wd
-#norm_rr = sum_wr*sum_wr
-norm_dr = sum_wd*sum_wr
-
-print norm_dd
-print norm_dr
-print norm_rr
-
-x = DD[1][1:]
-DD = DD[3][1:]
-DR = DR[3][1:]
-RR = RR[3][1:]
-
-print ndata,nrand
+ddfile, drfile, rrfile = tag+'DD.dat', tag+'DR.dat', tag+'RR.dat'
 
-#DD /= ((ndata**2-ndata)/2.)
-#DR /= ((nrand*ndata)/1.)
-#RR /= ((nrand**2-nrand)/2.)
-DD /= norm_dd
-DR /= norm_dr
-RR /= norm_rr
-w = (DD - 2*DR + RR)/RR
-#w = (DD - 4*DR + RR)/(2*RR)
+# Landy-Szalay, with each term normalized by its total pair weight (the
+# fifth number in the header of each file).
+jackknife = os.path.exists(ddfile+'.jackknife.npz')
+if jackknife:
+    x,w,cov = est.xi_from_files(ddfile,drfile,rrfile,jackknife=True)
+    werr = np.sqrt(np.diag(cov))
+else:
+    x,w = est.xi_from_files(ddfile,drfile,rrfile)
 
-print DD[-4:]
-print DR[-4:]
-print RR[-4:]
+ndata = est.read_pair_counts(ddfile)[3][0]
+nrand = est.read_pair_counts(rrfile)[3][0]
 
 print w
 print ndata
@@ -65,7 +34,10 @@ print nrand
 plt.figure(figsize=(8,8))
 #plt.plot(x,w,'ko',label='Siena')
 #plt.ylabel(r'$\xi$',fontsize=24)
-plt.plot(x,w*x*x,'ko',label='Siena')
+if jackknife:
+    plt.errorbar(x,w*x*x,yerr=werr*x*x,fmt='ko',label='Siena')
+else:
+    plt.plot(x,w*x*x,'ko',label='Siena')
 plt.ylabel(r'$\xi r^2$ (Mpc$^2$)',fontsize=24)
 
 plt.xlabel(r'Comoving separation (h$^{-1}$Mpc)',fontsize=18)
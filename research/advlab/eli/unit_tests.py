@@ -6,3 +6,435 @@ vec1 = np.array([1.0,1.0,1.0])
 m = jem.mag(vec1)
 print "Answer should be %.8f" % (np.sqrt(3))
 print "jem.mag returns  %.8f" % (m)
+
+# Test the pair counts against a brute-force calculation
+from scipy.spatial.distance import pdist, cdist
+
+def fake_catalog(n, seed):
+    rs = np.random.RandomState(seed)
+    xyz = rs.uniform(0, 600, size=(n,3))
+    w = rs.uniform(0.5, 1.5, size=n)
+    return np.column_stack((xyz, w, jem.mag(xyz)))
+
+c0 = fake_catalog(400, 1)
+c1 = fake_catalog(500, 2)
+nbins, maxsep = 20, 200
+
+w0 = c0[:,3]
+i, j = np.triu_indices(len(c0), 1)
+dd_brute = np.histogram(pdist(c0[:,0:3]), bins=nbins, range=(0,maxsep), weights=w0[i]*w0[j])[0]
+dr_brute = np.histogram(cdist(c0[:,0:3],c1[:,0:3]).ravel(), bins=nbins, range=(0,maxsep),
+                        weights=np.outer(c0[:,3],c1[:,3]).ravel())[0]
+
+for engine in ['tree', 'grid']:
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c0,c0,maxsep=maxsep)
+    dd = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=True,engine=engine)
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c0,c1,maxsep=maxsep)
+    dr = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=False,engine=engine)
+    assert np.allclose(dd, dd_brute), engine
+    assert np.allclose(dr, dr_brute), engine
+    print "%s pair counts match brute force" % (engine)
+
+# Test that the half stencil visits every pair of neighboring voxels once
+ngrids = [3,4,5]
+cells0, cells1 = jem.neighbor_cell_pairs(ngrids, samefile=True)
+pairs = set(zip(np.minimum(cells0,cells1), np.maximum(cells0,cells1)))
+assert len(pairs) == len(cells0)
+grid = np.indices(ngrids).reshape(3,-1).transpose()
+expected = set()
+for a in range(len(grid)):
+    for b in range(a, len(grid)):
+        if np.abs(grid[a]-grid[b]).max() <= 1:
+            expected.add((a,b))
+assert pairs == expected
+cells0, cells1 = jem.neighbor_cell_pairs(ngrids, samefile=False)
+assert len(cells0) == len(expected)*2 - len(grid)
+print "neighbor_cell_pairs visits each voxel pair once"
+
+# DD and RR counts on a finer grid (6x6x6 voxels) should match the output
+# of the old string-keyed voxel loop, which agreed with brute force.
+maxsep = 100
+for c in [c0, c1]:
+    w = c[:,3]
+    i, j = np.triu_indices(len(c), 1)
+    brute = np.histogram(pdist(c[:,0:3]), bins=nbins, range=(0,maxsep), weights=w[i]*w[j])[0]
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c,c,maxsep=maxsep)
+    counts = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=True,engine='grid')
+    assert np.allclose(counts, brute)
+print "grid pair counts on a 6x6x6 grid match brute force"
+
+# Sharded pair counts on a pool of processes should match the serial ones
+for engine in ['tree', 'grid']:
+    for c, samefile in [(c0, True), (c1, False)]:
+        voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c0,c,maxsep=maxsep)
+        serial = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=samefile,engine=engine)
+        parallel = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=samefile,engine=engine,nproc=3)
+        assert np.allclose(serial, parallel), engine
+print "parallel pair counts match serial ones"
+
+# bin_index should put values on the bin edges where np.histogram does
+edges = np.linspace(0, maxsep, nbins+1)
+values = np.concatenate((edges, np.random.RandomState(5).uniform(-10, maxsep+10, 1000)))
+index = jem.bin_index(values, edges)
+inside = index>=0
+assert np.array_equal(np.bincount(index[inside], minlength=nbins), np.histogram(values, bins=nbins, range=(0,maxsep))[0])
+print "bin_index matches np.histogram"
+
+# 2D (r_perp, r_parallel) counts against a brute-force histogram2d
+def brute_para_perp(c, d, same):
+    i, j = np.meshgrid(np.arange(len(c)), np.arange(len(d)), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    if same:
+        keep = j>i
+        i, j = i[keep], j[keep]
+    los = c[i,0:3] + d[j,0:3]
+    dR = d[j,0:3] - c[i,0:3]
+    para = np.abs((dR*los).sum(axis=1))/jem.mag(los)
+    perp = np.sqrt(np.maximum((dR*dR).sum(axis=1) - para*para, 0))
+    return perp, para, c[i,3]*d[j,3]
+
+perp_edges = np.linspace(0, 100, 11)
+para_edges = np.logspace(0, 2, 6)
+for c, samefile in [(c0, True), (c1, False)]:
+    perp, para, w = brute_para_perp(c0, c, samefile)
+    brute = np.histogram2d(perp, para, bins=(perp_edges, para_edges), weights=w)[0]
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c0,c,maxsep=150)
+    counts = jem.do_pair_counts_2d(voxels0,voxels1,ngrids,samefile=samefile,perp_edges=perp_edges,
+                                   para_edges=para_edges,log_para=True)
+    assert np.allclose(counts, brute)
+# A catalog narrower than the largest pair fits in a single voxel.
+small = np.column_stack((np.random.RandomState(2).uniform(0,90,(300,3)), np.ones(300)))
+small[:,0] += 1000
+perp, para, w = brute_para_perp(small, small, True)
+brute = np.histogram2d(perp, para, bins=(perp_edges, para_edges), weights=w)[0]
+voxels0,voxels1,ngrids = jem.voxelize_the_data(small,small,maxsep=150)[0:3]
+counts = jem.do_pair_counts_2d(voxels0,voxels1,ngrids,samefile=True,perp_edges=perp_edges,
+                               para_edges=para_edges,log_para=True)
+assert np.allclose(counts, brute)
+print "2D pair counts match brute force"
+
+# The binary catalog cache should reproduce the text catalog, and a changed
+# cosmology should map to a different cache file.
+import os, shutil, tempfile
+tmpdir = tempfile.mkdtemp()
+os.environ['JEM_CACHE_DIR'] = os.path.join(tmpdir, 'cache')
+rs = np.random.RandomState(3)
+cat = np.column_stack((rs.uniform(150,200,1000), rs.uniform(0,40,1000),
+                       rs.uniform(0.4,0.72,1000), rs.uniform(0.5,1.5,1000)))
+catfile = os.path.join(tmpdir, 'randoms.dat')
+np.savetxt(catfile, cat)
+keep = (cat[:,2]>0.43)*(cat[:,2]<0.7)
+nocache = jem.get_coordinates(catfile, cache=False)
+first = jem.get_coordinates(catfile)
+second = jem.get_coordinates(catfile)
+assert np.allclose(nocache, jem.radecredshift2xyz(np.deg2rad(cat[keep,0]),np.deg2rad(cat[keep,1]),cat[keep,2]))
+assert np.array_equal(first, nocache) and np.array_equal(second, nocache)
+assert isinstance(jem.load_catalog(catfile), np.memmap)
+assert jem.catalog_cache_path(catfile) != jem.catalog_cache_path(catfile, Om0=0.274)
+coords = jem.get_coordinates_with_weight(catfile, xyz=True)
+assert np.allclose(coords, jem.radecredshift2xyz_with_weights(jem.get_coordinates_with_weight(catfile, cache=False)))
+shutil.rmtree(tmpdir)
+del os.environ['JEM_CACHE_DIR']
+print "Binary catalog cache matches the text catalog"
+
+# The interpolated comoving distances should agree with astropy's integral.
+from astropy.cosmology import FlatLambdaCDM
+z = np.random.RandomState(4).uniform(0, 0.8, 5000)
+for Om0 in [0.3, 0.274]:
+    exact = FlatLambdaCDM(H0=70, Om0=Om0).comoving_distance(z).value
+    assert np.allclose(jem.comoving_distance(z, H0=70, Om0=Om0), exact, rtol=1e-8, atol=0)
+exact = FlatLambdaCDM(H0=70, Om0=0.3).comoving_distance(2.5).value
+assert np.allclose(jem.comoving_distance([2.5]), exact, rtol=1e-8, atol=0)
+r1 = np.array([0.3, 0.2, 0.5, 1300.])
+r2 = np.array([[0.31, 0.21, 0.52, 1350.], [0.29, 0.19, 0.48, 1250.]])
+x = FlatLambdaCDM(H0=70, Om0=0.3).kpc_comoving_per_arcmin(r1[2]).value
+x *= np.rad2deg(jem.angular_sep(r1[0], r1[1], r2[:,0], r2[:,1]))*60./1000.
+assert np.allclose(jem.one_dimension_trial(r1, r2)[0], np.sqrt(x*x + (r2[:,3]-r1[3])**2))
+print "Interpolated comoving distances match astropy"
+
+# Streaming a catalog in chunks should give the same pair counts as
+# reading it all at once, from the text file and from the cache.
+tmpdir = tempfile.mkdtemp()
+os.environ['JEM_CACHE_DIR'] = os.path.join(tmpdir, 'cache')
+rs = np.random.RandomState(5)
+catfile0 = os.path.join(tmpdir, 'data.dat')
+catfile1 = os.path.join(tmpdir, 'randoms.dat')
+for catfile, n in [(catfile0, 300), (catfile1, 700)]:
+    np.savetxt(catfile, np.column_stack((rs.uniform(180,185,n), rs.uniform(20,25,n),
+                                         rs.uniform(0.42,0.5,n))))
+coords0 = jem.get_coordinates_with_weight(catfile0, xyz=True, cache=False)
+coords1 = jem.get_coordinates_with_weight(catfile1, xyz=True, cache=False)
+dr = jem.tree_pair_counts(coords0, coords1, nbins=nbins, maxrange=maxsep, samefile=False)
+rr = jem.tree_pair_counts(coords1, coords1, nbins=nbins, maxrange=maxsep, samefile=True)
+text_columns = jem._text_columns
+for cache, nparsed in [(False, 700), (True, 700), (True, 0)]:
+    # The text catalog is parsed once (and not at all once it is cached),
+    # however many times the chunks are gone over.
+    parsed = []
+    jem._text_columns = lambda r: parsed.append(len(r)) or text_columns(r)
+    chunks = jem.CatalogChunks(catfile1, 160, cache=cache)
+    assert chunks.ngals == len(coords1)
+    assert np.allclose(np.concatenate(list(chunks)), coords1)
+    assert np.allclose(jem.chunked_pair_counts(coords0, chunks, nbins=nbins, maxrange=maxsep), dr)
+    assert np.allclose(jem.chunked_self_pair_counts(chunks, nbins=nbins, maxrange=maxsep), rr)
+    jem._text_columns = text_columns
+    assert sum(parsed) == nparsed
+cachefile = jem.catalog_cache_path(catfile1, Om0=0.274)
+assert np.array_equal(np.load(cachefile), jem.build_catalog_table(catfile1, Om0=0.274))
+shutil.rmtree(tmpdir)
+del os.environ['JEM_CACHE_DIR']
+print "Chunked pair counts match the in-memory counts"
+
+# The closed-form weight totals should match the old double loop.
+w0, w1 = c0[:,3], c1[:,3]
+for wa, wb, same in [(w0, w0, True), (w0, w1, False)]:
+    tot_weight2 = 0.
+    for i in wa:
+        tot_weight2 += (i*wb).sum()
+    if same:
+        tot_weight2 = (tot_weight2 - (wa*wb).sum())/2.
+    totals = jem.pair_weight_totals(wa, wb, samefile=same)
+    assert np.allclose(totals[0:3], [wa.sum(), wb.sum(), tot_weight2])
+    assert np.allclose(totals[3], (wa*wb).sum() if same else 1.0)
+print "Closed-form weight totals match the pair loop"
+
+# Stored pair counts are found again only for the same catalogs and binning.
+tmpdir = tempfile.mkdtemp()
+catfile0 = os.path.join(tmpdir, 'data.dat')
+catfile1 = os.path.join(tmpdir, 'randoms.dat')
+np.savetxt(catfile0, c0[:,0:3])
+np.savetxt(catfile1, c1[:,0:3])
+edges = np.linspace(0, maxsep, nbins+1)
+key, description = jem.pair_count_key(catfile1, catfile1, edges, cosmology={'H0':70,'Om0':0.274})
+assert jem.load_pair_counts(key, storedir=tmpdir) is None
+jem.save_pair_counts(key, dd_brute, {'ngals':[len(c1),len(c1)]}, storedir=tmpdir)
+counts, meta = jem.load_pair_counts(key, storedir=tmpdir)
+assert np.array_equal(counts, dd_brute) and meta['ngals'] == [len(c1),len(c1)]
+shutil.copy(catfile1, os.path.join(tmpdir, 'copy.dat'))
+assert jem.pair_count_key(os.path.join(tmpdir, 'copy.dat'), catfile1, edges,
+                          cosmology={'H0':70,'Om0':0.274})[0] == key
+assert jem.pair_count_key(catfile0, catfile1, edges, cosmology={'H0':70,'Om0':0.274})[0] != key
+assert jem.pair_count_key(catfile1, catfile1, edges[0:-1], cosmology={'H0':70,'Om0':0.274})[0] != key
+assert jem.pair_count_key(catfile1, catfile1, edges, cosmology={'H0':70,'Om0':0.3})[0] != key
+# Keys built from catalog hashes that are already known match the ones read
+# from the files.
+parts = [catfile0, catfile1, catfile0]
+ids = jem.prefix_catalog_ids([jem.catalog_hash(f) for f in parts])
+for k in range(len(parts)):
+    assert jem.pair_count_key(None, None, edges, catalog_ids=[ids[k], ids[k]])[0] == \
+        jem.pair_count_key(parts[:k+1], parts[:k+1], edges)[0]
+assert jem.catalog_stamp(catfile1) != jem.catalog_stamp(os.path.join(tmpdir, 'copy.dat'))
+shutil.rmtree(tmpdir)
+print "Pair-count store keys on catalog contents, cosmology and binning"
+
+# Region-pair counts: every jackknife realization should match a brute-force
+# count on the catalogs with that region removed.
+maxsep = 100
+ra, dec = jem.xyz2radec(c1)
+edges = jem.jackknife_edges(ra, dec, nra=3, ndec=2)
+labels0 = jem.jackknife_labels(*jem.xyz2radec(c0), edges=edges)
+labels1 = jem.jackknife_labels(ra, dec, edges)
+assert np.abs(np.bincount(labels1, minlength=6) - len(c1)/6.).max() <= 2
+l0 = np.column_stack((c0, labels0))
+l1 = np.column_stack((c1, labels1))
+for a, b, same in [(l0, l0, True), (l0, l1, False)]:
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(a,b,maxsep=maxsep)
+    regions = jem.do_region_pair_counts(voxels0,voxels1,ngrids,6,nbins=nbins,maxrange=maxsep,samefile=same)
+    total = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=same)
+    assert np.allclose(regions.sum(axis=(0,1)), total)
+    jack = jem.jackknife_pair_counts(regions)
+    totals = jem.jackknife_weight_totals(a[:,3],a[:,-1].astype(int),b[:,3],b[:,-1].astype(int),6,samefile=same)
+    for k in [0, 4]:
+        ak, bk = a[a[:,-1]!=k], b[b[:,-1]!=k]
+        if same:
+            wk = ak[:,3]
+            i, j = np.triu_indices(len(ak), 1)
+            brute = np.histogram(pdist(ak[:,0:3]), bins=nbins, range=(0,maxsep), weights=wk[i]*wk[j])[0]
+        else:
+            brute = np.histogram(cdist(ak[:,0:3],bk[:,0:3]).ravel(), bins=nbins, range=(0,maxsep),
+                                 weights=np.outer(ak[:,3],bk[:,3]).ravel())[0]
+        assert np.allclose(jack[k], brute)
+        assert np.allclose(totals[k], jem.pair_weight_totals(ak[:,3], ak[:,3] if same else bk[:,3], samefile=same))
+print "Jackknife region pair counts match brute force"
+
+# A footprint across RA = 180 deg, where arctan2 wraps, should still be cut
+# into contiguous RA stripes.
+rs = np.random.RandomState(9)
+ra = np.radians(rs.uniform(110, 260, 3000))
+dec = np.radians(rs.uniform(0, 60, 3000))
+xyz = np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)))
+ra_wrapped, dec_wrapped = jem.xyz2radec(xyz)
+assert ra_wrapped.min() < 0 < ra_wrapped.max()
+labels = jem.jackknife_labels(ra_wrapped, dec_wrapped, jem.jackknife_edges(ra_wrapped, dec_wrapped, nra=3, ndec=1))
+for i in range(3):
+    stripe = np.degrees(ra[labels==i])
+    assert np.abs(len(stripe) - 1000) <= 1
+    assert stripe.max() - stripe.min() < 60
+print "Jackknife regions stay contiguous across RA = 180 deg"
+
+# Estimators over a stack of realizations should match the formulas applied
+# one realization at a time, and the covariances np.cov.
+import jem_estimators as est
+rs = np.random.RandomState(6)
+DD, DR, RR = [rs.uniform(1, 10, size=(30, nbins)) for i in range(3)]
+norms = [rs.uniform(1, 2, size=30) for i in range(3)]
+for estimator in est.ESTIMATORS:
+    xi = est.xi_estimator(DD, DR, RR, norms[0], norms[1], norms[2], estimator=estimator)
+    for m in [0, 17]:
+        dd, dr, rr = DD[m]/norms[0][m], DR[m]/norms[1][m], RR[m]/norms[2][m]
+        expected = {'LS': (dd - 2*dr + rr)/rr, 'Hamilton': dd*rr/dr**2 - 1,
+                    'DP': dd/dr - 1, 'natural': dd/rr - 1}[estimator]
+        assert np.allclose(xi[m], expected), estimator
+xi, mean, cov = est.xi_with_covariance(DD, DR, RR, norms[0], norms[1], norms[2])
+assert np.allclose(mean, xi.mean(axis=0)) and np.allclose(cov, np.cov(xi.T))
+mean, cov = est.covariance(xi, jackknife=True)
+assert np.allclose(cov, np.cov(xi.T)*(29.**2/30.))
+assert np.array_equal(est.xi_estimator(np.ones(3), np.ones(3), np.array([1., 0., 2.])), [0., 0., 0.5])
+Xi = jem.corr_est(np.ones((4,4)), np.ones((4,4)), np.ones((4,4)), 10, 20, 4)
+assert np.allclose(Xi, (2/45. - 4/200. + 2/190.)/(2/190.))
+print "Vectorized estimators match the per-realization formulas"
+
+# A run resumed from a partial checkpoint should give bit-identical counts.
+tmpdir = tempfile.mkdtemp()
+ckfile = os.path.join(tmpdir, 'run.checkpoint.npz')
+for engine, same in [('tree', True), ('grid', False)]:
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c0,c1 if not same else c0,maxsep=maxsep)
+    checkpoint = jem.Checkpoint(ckfile, key='test', resume=False, interval=0)
+    full = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=same,
+                              engine=engine,nshards=5,checkpoint=checkpoint)
+    # Pretend the run was killed after two shards.
+    saved = dict(np.load(ckfile))
+    saved['done'][2:] = False
+    saved['partials'][2:] = 0
+    np.savez(ckfile, **saved)
+    checkpoint = jem.Checkpoint(ckfile, key='test', resume=True)
+    resumed = jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=same,
+                                 engine=engine,nshards=5,checkpoint=checkpoint)
+    assert np.array_equal(full, resumed), engine
+    try:
+        jem.do_pair_counts(voxels0,voxels1,ngrids,nbins=nbins,maxrange=maxsep,samefile=same,engine=engine,
+                           nshards=5,checkpoint=jem.Checkpoint(ckfile, key='other'))
+        assert False
+    except ValueError:
+        pass
+    checkpoint.remove()
+    assert not os.path.exists(ckfile)
+shutil.rmtree(tmpdir)
+print "Resumed pair counts are bit-identical"
+
+# The benchmark mocks are reproducible, inside the cuts, and its brute-force
+# reference agrees with the tree counts.
+import benchmark_pair_counts as bench
+for kind in ['uniform', 'clustered']:
+    mock, filename = bench.make_mock(kind, 800, seed=3)
+    again, filename = bench.make_mock(kind, 800, seed=3)
+    assert mock.shape == (800, 5) and np.array_equal(mock, again)
+    reference = bench.brute_force_counts(mock, nbins=nbins, maxrange=maxsep, blocksize=300)
+    counts = jem.tree_pair_counts(mock, mock, nbins=nbins, maxrange=maxsep, samefile=True)
+    assert bench.compare_counts(counts, reference)[1], kind
+print "Benchmark mocks and brute-force reference agree with the tree counts"
+
+# The line-of-sight kernels against the per-galaxy formulas they replace.
+import jem_kernels
+r0 = c0[:50,0:3] + 1000.
+r1 = c1[:60,0:3] + 1000.
+i, j = np.meshgrid(np.arange(50), np.arange(60), indexing='ij')
+a, b = r0[i.ravel()], r1[j.ravel()]
+d = b - a
+s = jem.mag(d)
+los = a + b
+para = (d*los).sum(axis=1)/jem.mag(los)
+bis = a + b*(jem.mag(a)/jem.mag(b))[:,np.newaxis]
+lado_mu = np.abs((bis*d).sum(axis=1))/s/jem.mag(bis)
+theta = np.arccos(np.clip((a*b).sum(axis=1)/jem.mag(a)/jem.mag(b), -1, 1))
+ang_par = jem.mag(b) - jem.mag(a)
+ang_perp = jem.mag(a)*theta
+expected = {'midpoint': (para, np.sqrt(s*s - para*para)),
+            'lado': (s*lado_mu, s*np.sqrt(1 - lado_mu*lado_mu)),
+            'angular': (ang_par, ang_perp)}
+for convention in jem_kernels.CONVENTIONS:
+    kernel = jem_kernels.LOSKernel(convention, size=100)
+    blk = [x.ravel().copy() for x in kernel.block(r0, r1)]
+    prs = kernel.pairs(a, b)
+    for x, y in zip(blk, prs):
+        assert np.allclose(x, y, rtol=1e-12, atol=1e-9), convention
+    rpar, rperp = expected[convention]
+    assert np.allclose(np.abs(blk[2]), np.abs(rpar), atol=1e-6), convention
+    assert np.allclose(blk[3], rperp, atol=1e-5), convention
+    assert np.allclose(blk[0]*blk[1], blk[2]) and np.allclose(blk[0]**2, blk[2]**2 + blk[3]**2)
+assert np.allclose(jem.lado_para_perp(r0[0], r1)[0], expected['lado'][0][:60])
+assert np.allclose(jem.our_para_perp_with_weights(c0[0], c1)[0],
+                   (lambda d, l: (d*l).sum(axis=1)/jem.mag(l))(c1[:,0:3]-c0[0,0:3], c1[:,0:3]+c0[0,0:3]))
+for convention in jem_kernels.CONVENTIONS:
+    voxels0,voxels1,ngrids,gridwidths,loranges,hiranges = jem.voxelize_the_data(c0,c1,maxsep=150)
+    counts = jem.do_pair_counts_2d(voxels0,voxels1,ngrids,samefile=False,perp_edges=perp_edges,
+                                   para_edges=para_edges,log_para=True,convention=convention)
+    assert counts.sum() > 0
+print "Line-of-sight kernels match the per-galaxy formulas"
+
+# (r_perp, r_parallel) counts against a brute-force histogram of the same
+# kernel, on a dense cap far from the observer where the angular r_perp
+# lets pairs inside the grid lie further apart than sqrt(perp^2+par^2).
+# The angular r_perp is taken at the nearer galaxy of each pair.
+rs = np.random.RandomState(10)
+def cap(n):
+    ra = rs.uniform(0, 0.12, n)
+    dec = rs.uniform(0, 0.12, n)
+    dist = rs.uniform(1000, 1300, n)
+    return np.column_stack((jem.radec2unit(ra, dec)[:,0:3]*dist[:,np.newaxis],
+                            rs.uniform(0.5, 1.5, n)))
+k0, k1 = cap(1500), cap(1200)
+cap_edges = np.linspace(0, 100, 11)
+for convention in jem_kernels.CONVENTIONS:
+    for a, b, same in [(k0, k0, True), (k0, k1, False)]:
+        s, mu, rpar, rperp = jem_kernels.los_decompose(a, b, convention, block=True)
+        if convention == 'angular':
+            flipped = jem_kernels.los_decompose(b, a, convention, block=True)[3].T
+            rperp = np.where(jem.mag(a[:,0:3])[:,np.newaxis] <= jem.mag(b[:,0:3]), rperp, flipped)
+        weights = np.outer(a[:,3], b[:,3])
+        keep = np.ones(s.shape, bool)
+        if same:
+            keep = np.triu(keep, 1)
+        brute = np.histogram2d(rperp[keep], np.abs(rpar[keep]), bins=(cap_edges, cap_edges),
+                               weights=weights[keep])[0]
+        counts = jem.block_pair_counts_2d(a, b, cap_edges, cap_edges, same=same, convention=convention)
+        assert np.allclose(counts, brute), convention
+        voxsep = jem.pair_search_radius(100, 100, convention, min(jem.mag(a[:,0:3]).min(), jem.mag(b[:,0:3]).min()))
+        voxels0,voxels1,ngrids = jem.voxelize_the_data(a, b, maxsep=voxsep)[0:3]
+        counts = jem.do_pair_counts_2d(voxels0, voxels1, ngrids, samefile=same, perp_edges=cap_edges,
+                                       para_edges=cap_edges, convention=convention)
+        assert np.allclose(counts, brute), convention
+print "(r_perp, r_parallel) counts match brute force for every line of sight"
+
+# Angular pair counts in chord space against arccos of every pair.
+rs = np.random.RandomState(6)
+def sky(n):
+    ra = np.deg2rad(rs.uniform(150, 170, n))
+    dec = np.arcsin(rs.uniform(np.sin(np.deg2rad(-5)), np.sin(np.deg2rad(10)), n))
+    return jem.radec2unit(ra, dec, rs.uniform(0.5, 1.5, n))
+s0, s1 = sky(700), sky(900)
+assert np.allclose(jem.chord2theta(jem.theta2chord([0.1, 1., 90.])), [0.1, 1., 90.])
+for theta_edges in [np.logspace(-1, 1, 9), np.linspace(0, 5, 6)]:
+    for other, same in [(s0, True), (s1, False)]:
+        cosang = np.clip(np.dot(s0[:,0:3], other[:,0:3].T), -1, 1)
+        theta = np.rad2deg(np.arccos(cosang))
+        w = np.outer(s0[:,3], other[:,3])
+        if same:
+            upper = np.triu(np.ones(theta.shape, dtype=bool), 1)
+            theta, w = theta[upper], w[upper]
+        brute = np.histogram(theta.ravel(), bins=theta_edges, weights=w.ravel())[0]
+        for engine in ['tree', 'grid']:
+            counts = jem.angular_pair_counts(s0, other, theta_edges, samefile=same, engine=engine)
+            assert np.allclose(counts, brute), (engine, same)
+print "Angular pair counts match brute force"
+
+# Appending a batch should only need the A x B and B x B pairs.
+nbins, maxsep = 10, 150
+full = jem.tree_pair_counts(np.concatenate((c0, c1)), np.concatenate((c0, c1)), nbins=nbins, maxrange=maxsep, samefile=True)
+base = jem.tree_pair_counts(c0, c0, nbins=nbins, maxrange=maxsep, samefile=True)
+assert np.allclose(jem.incremental_pair_counts(c0, c1, base, nbins=nbins, maxrange=maxsep), full)
+far = c1.copy()
+far[:,0] += 1e4
+assert np.allclose(jem.incremental_pair_counts(c0, far, base, nbins=nbins, maxrange=maxsep),
+                   base + jem.tree_pair_counts(far, far, nbins=nbins, maxrange=maxsep, samefile=True))
+print "Incremental pair counts match a full recount"
@@ -0,0 +1,178 @@
+"""Covariance of correlation functions measured on an ensemble of mock (or
+random) catalogs, as written by CUTE or cute-2ptcor.py.
+
+Each measurement is turned into one data vector (optionally the stacked
+multipoles xi_0, xi_2, xi_4), the vectors of all the mocks are put in an
+(Nmock, Nbin) array, and the covariance and correlation matrices follow
+from a single matrix product.  When the ensemble does not fit in memory the
+mocks are read in chunks and combined with OnlineCovariance.
+
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+def read_corr_table(cfile):
+    '''Read a correlation function table as a 2D array.'''
+    return np.loadtxt(cfile, ndmin=2)
+
+def _grid(table):
+    '''Shape of the 2D grid of bins of a table whose first two columns are the
+    bin coordinates, and whether the first column varies slowest.
+
+    '''
+    n0, n1 = len(np.unique(table[:, 0])), len(np.unique(table[:, 1]))
+    slow0 = table[0, 0] == table[1, 0]
+    return (n0, n1) if slow0 else (n1, n0), slow0
+
+def xi_multipoles_rmu(mu, rad, xi, ells=(0, 2, 4)):
+    '''Multipoles xi_ell(r) = (2 ell + 1) int_0^1 xi(r, mu) L_ell(mu) dmu from
+    xi(r, mu) in equal-width mu bins between 0 and 1.
+
+    mu, rad, and xi are the columns of a CUTE 3D_rm table.  Returns the radii
+    and an [len(ells), Nr] array.
+
+    '''
+    table = np.vstack((mu, rad, xi)).T
+    shape, mu_slow = _grid(table)
+    xi2d = xi.reshape(shape)
+    mu2d = mu.reshape(shape)
+    if mu_slow:
+        xi2d, mu2d = xi2d.T, mu2d.T
+    mubin = mu2d[0, :]
+    radii = np.unique(rad)
+
+    dmu = 1 / len(mubin)
+    legendre = dict()
+    legendre[0] = np.ones_like(mubin)
+    legendre[2] = 0.5*(3*mubin**2 - 1)
+    legendre[4] = (35*mubin**4 - 30*mubin**2 + 3)/8
+    return radii, np.array([(2*ell+1) * np.dot(xi2d, legendre[ell]) * dmu for ell in ells])
+
+def data_vector(table, corrtype='3D_rm', ells=None, rmax=None):
+    '''Turn one correlation function table into a data vector.
+
+    corrtype is the CUTE correlation type of the table, or 'multipoles' for
+    the r xi0 xi2 xi4 tables of cute-2ptcor.py.  For 'multipoles' and '3D_rm'
+    the multipoles in ells (e.g., (0, 2)) are stacked one after the other (for
+    '3D_rm' with ells=None the full xi(r, mu) grid is used instead).  Bins
+    beyond rmax are dropped.
+
+    Returns the vector and an [Nbin, 2] array that labels its bins: (ell, r)
+    for monopoles and multipoles, the first two columns of the table for the
+    2D grids.
+
+    '''
+    if corrtype == 'monopole':
+        ells, rad, xiell = [0], table[:, 0], table[:, 1][np.newaxis, :]
+    elif corrtype == 'multipoles':
+        ells = (0, 2, 4) if ells is None else ells
+        rad = table[:, 0]
+        xiell = table[:, [1 + ell//2 for ell in ells]].T
+    elif corrtype == '3D_rm' and ells is not None:
+        rad, xiell = xi_multipoles_rmu(table[:, 0], table[:, 1], table[:, 2], ells)
+    elif corrtype in ('3D_rm', '3D_ps'):
+        if ells is not None:
+            raise ValueError('Multipoles are not defined for {}'.format(corrtype))
+        keep = np.ones(len(table), bool)
+        if rmax is not None and corrtype == '3D_rm':
+            keep = table[:, 1] <= rmax
+        return table[keep, 2], table[keep, :2]
+    else:
+        raise ValueError('Unrecognized correlation type {}'.format(corrtype))
+
+    keep = np.ones(len(rad), bool) if rmax is None else rad <= rmax
+    vector = np.concatenate([xi[keep] for xi in xiell])
+    labels = np.vstack((np.repeat(ells, np.sum(keep)), np.tile(rad[keep], len(ells)))).T
+    return vector, labels
+
+def mock_matrix(corrfiles, corrtype='3D_rm', ells=None, rmax=None):
+    '''Read each file once and return the (Nmock, Nbin) array of data vectors
+    and the bin labels (see data_vector).
+
+    '''
+    vectors = []
+    for cfile in corrfiles:
+        vector, labels = data_vector(read_corr_table(cfile), corrtype, ells, rmax)
+        vectors.append(vector)
+    return np.array(vectors), labels
+
+def sample_covariance(vectors):
+    '''Mean and unbiased covariance of an (Nmock, Nbin) array of data vectors.'''
+    vectors = np.asarray(vectors, dtype='f8')
+    mean = np.mean(vectors, axis=0)
+    delta = vectors - mean
+    return mean, np.dot(delta.T, delta) / (len(vectors) - 1)
+
+def correlation_matrix(cov):
+    '''Correlation matrix cov_ij / sqrt(cov_ii cov_jj).'''
+    sigma = np.sqrt(np.diag(cov))
+    return cov / np.outer(sigma, sigma)
+
+def hartlap_factor(nmock, nbin):
+    '''Hartlap et al. (2007) factor (Nmock - Nbin - 2) / (Nmock - 1) that
+    debiases the inverse of a covariance estimated from Nmock mocks.
+
+    '''
+    if nmock <= nbin + 2:
+        raise ValueError('The Hartlap correction needs more than Nbin+2={} mocks (got {})'.format(
+            nbin+2, nmock))
+    return (nmock - nbin - 2) / (nmock - 1)
+
+def precision_matrix(cov, nmock, hartlap=True):
+    '''Inverse covariance, with the Hartlap correction unless hartlap=False.'''
+    precision = np.linalg.inv(cov)
+    if hartlap:
+        precision *= hartlap_factor(nmock, len(cov))
+    return precision
+
+class OnlineCovariance(object):
+    '''Running mean and covariance of data vectors that are added in chunks.
+
+    Each chunk is reduced with one matrix product and merged into the running
+    totals with the pairwise form of Welford's update (Chan, Golub & LeVeque
+    1979), so only one chunk has to be in memory at a time and the result
+    matches sample_covariance on the whole ensemble to round-off.
+
+    '''
+    def __init__(self, nbin=None):
+        self.nmock = 0
+        self.mean = None if nbin is None else np.zeros(nbin)
+        self._m2 = None if nbin is None else np.zeros((nbin, nbin))
+
+    def update(self, vectors):
+        '''Add an (N, Nbin) chunk of data vectors.'''
+        vectors = np.atleast_2d(np.asarray(vectors, dtype='f8'))
+        nchunk = len(vectors)
+        if nchunk == 0:
+            return
+        mean = np.mean(vectors, axis=0)
+        delta = vectors - mean
+        m2 = np.dot(delta.T, delta)
+
+        if self.nmock == 0:
+            self.nmock, self.mean, self._m2 = nchunk, mean, m2
+            return
+
+        ntot = self.nmock + nchunk
+        dmean = mean - self.mean
+        self.mean = self.mean + dmean * nchunk / ntot
+        self._m2 = self._m2 + m2 + np.outer(dmean, dmean) * self.nmock * nchunk / ntot
+        self.nmock = ntot
+
+    @property
+    def covariance(self):
+        '''Unbiased covariance of the vectors added so far.'''
+        return self._m2 / (self.nmock - 1)
+
+def stream_covariance(corrfiles, corrtype='3D_rm', ells=None, rmax=None, chunksize=100):
+    '''Mean and covariance of the mocks in corrfiles, read chunksize files at a
+    time (see OnlineCovariance).  Also returns the bin labels.
+
+    '''
+    online = OnlineCovariance()
+    labels = None
+    for lo in range(0, len(corrfiles), chunksize):
+        vectors, labels = mock_matrix(corrfiles[lo:lo+chunksize], corrtype, ells, rmax)
+        online.update(vectors)
+    return online.mean, online.covariance, labels
@@ -8,18 +8,24 @@ from __future__ import division, print_function
 
 import os
 import sys
-import pdb
+import time
+import hashlib
 import logging
 import argparse
+import subprocess
+import multiprocessing
 from glob import glob
 
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.io import fits
-from astropy.cosmology import WMAP7
+from astropy.cosmology import WMAP7, FlatwCDM
+from scipy.spatial import cKDTree
 from matplotlib.colors import LogNorm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
+from covariance import sample_covariance, xi_multipoles_rmu
+
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger()
 
@@ -51,42 +57,280 @@ def compute_hexadecapole(mu, r, xirm):
     hexadecapole = xr*np.trapz(Bxirm)
     return hexadecapole
 
-def calc_fkp_weights(z, zmin, zmax, area=1.0):
-    '''Compute the FKP statistical weights.'''
+def legendre_even(mu):
+    '''Return the Legendre polynomials L0, L2, and L4 evaluated at mu.'''
+    mu2 = mu*mu
+    return np.vstack((np.ones_like(mu), 0.5*(3*mu2-1), (35*mu2*mu2-30*mu2+3)/8))
+
+def radecz2xyz(ra, dec, z, omega_M=0.3, ww=-1.0):
+    '''Convert RA, Dec (degrees) and redshift to comoving Cartesian coordinates
+    in Mpc/h, using the same flat wCDM cosmology we hand to CUTE.
+
+    '''
+    cosmo = FlatwCDM(H0=100, Om0=omega_M, w0=ww)
+    dist = cosmo.comoving_distance(z).value
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.vstack((dist*np.cos(dec)*np.cos(ra),
+                      dist*np.cos(dec)*np.sin(ra),
+                      dist*np.sin(dec))).T
+
+def paircount_multipoles(xyz1, w1, xyz2=None, w2=None, rmax=150.0, nrbin=75,
+                         chunksize=5000, maxpairs=1000000):
+    '''Count weighted pairs in bins of separation, weighting each pair by the
+    Legendre polynomials L0, L2, and L4 of mu, the cosine of the angle between
+    the pair separation and the (midpoint) line of sight.
+
+    The pairs of a chunk are counted before they are gathered, and a chunk
+    with more than maxpairs of them is split in two until it has fewer (or is
+    a single point), so the memory used does not grow with the density of
+    the catalogs.
+
+    Pass only xyz1 and w1 for an auto-count (DD or RR), in which case each pair
+    is counted once.  Returns a [3, nrbin] array; row 0 is the ordinary
+    (monopole) pair count.
 
-    NRB = 200 
-    dz = zmax - zmin
+    '''
+    auto = xyz2 is None
+    if auto:
+        xyz2, w2 = xyz1, w1
+
+    tree2 = cKDTree(xyz2)
+    counts = np.zeros((3, nrbin))
+    todo = [(lo, min(lo+chunksize, len(xyz1))) for lo in range(0, len(xyz1), chunksize)]
+    while todo:
+        lo, hi = todo.pop()
+        tree1 = cKDTree(xyz1[lo:hi])
+        if hi - lo > 1 and tree1.count_neighbors(tree2, rmax) > maxpairs:
+            mid = (lo + hi) // 2
+            todo.extend([(lo, mid), (mid, hi)])
+            continue
+
+        pairs = tree1.sparse_distance_matrix(tree2, rmax, output_type='ndarray')
+        ii, jj, rr = pairs['i'], pairs['j'], pairs['v']
+        del pairs
+        keep = rr > 0
+        if auto:
+            keep &= jj > (ii + lo)
+        ii, jj, rr = ii[keep] + lo, jj[keep], rr[keep]
+
+        los = xyz1[ii] + xyz2[jj]
+        mu = np.abs(np.sum((xyz2[jj] - xyz1[ii]) * los, axis=1)) / (
+            rr * np.sqrt(np.sum(los*los, axis=1)))
+        rbin = np.minimum((rr * nrbin / rmax).astype(int), nrbin-1)
+        weight = w1[ii] * w2[jj]
+        ell = legendre_even(mu)
+        for il in range(3):
+            counts[il, :] += np.bincount(rbin, weights=weight*ell[il], minlength=nrbin)
+
+    return counts
+
+def pairweight_norm(w1, w2=None):
+    '''Total pair weight of an auto- (w2=None) or cross-count.'''
+    if w2 is None:
+        return 0.5*(np.sum(w1)**2 - np.sum(w1*w1))
+    return np.sum(w1)*np.sum(w2)
+
+def xi_multipoles(DD, DR, RR, normDD, normDR, normRR):
+    '''Landy-Szalay monopole, quadrupole, and hexadecapole from
+    Legendre-weighted pair counts.
+
+    Assumes RR is isotropic within each radial bin, so that
+    xi_ell(r) = (2*ell+1) * (DD_ell - 2*DR_ell + RR_ell) / RR_0.
+
+    '''
+    dd, dr, rr = DD/normDD, DR/normDR, RR/normRR
+    rr0 = rr[0, :] + (rr[0, :] == 0)
+    ell = np.array([0, 2, 4])[:, np.newaxis]
+    return (2*ell+1) * (dd - 2*dr + rr) / rr0 * (rr[0, :] != 0)
 
+def redshift_shells(zmin, zmax, area=1.0, nrb=200):
+    '''Edges of nrb equal-width redshift shells between zmin and zmax and their
+    comoving volumes in (Mpc/h)^3 over a survey area (deg^2).
+
+    '''
+    zedges = np.linspace(zmin, zmax, nrb+1)
     omega = area/(4*np.pi*(180.0/np.pi)**2)
-    
-    red_interval = dz/NRB
-    red_markers = []
-    red_vol = []
-    bin_num = []
-    bin_sum = []
-    wfkp = []
-
-    for ii in range(NRB + 1):
-        red_markers.append(zmin + ii*red_interval) 
-        if ii >= 1:
-            red_vol.append((4/3)*np.pi*((WMAP7.comoving_distance(red_markers[ii]).value*0.704)**3-
-                                        (WMAP7.comoving_distance(red_markers[ii-1]).value*0.704)**3)
-                                        *omega)
-    for ii in range(len(z)):
-        bin_num.append(int(np.floor(NRB * (z[ii]-zmin)/dz))) 
-    bin_num = np.asarray(bin_num)
-
-    for ii in range(NRB):
-        bin_sum.append(len(np.where(bin_num==ii)[0])) 
-
-    bin_sum = np.asarray(bin_sum)
-    red_vol = np.asarray(red_vol)
-    nbar_slice = bin_sum/red_vol
-
-    for ii in range(len(z)):
-        wfkp.append(1/(1+20000*nbar_slice[bin_num[ii]]))
-                 
-    return wfkp
+    # One cosmology call for all the shell edges.
+    dist = WMAP7.comoving_distance(zedges).value*0.704
+    return zedges, (4/3)*np.pi*np.diff(dist**3)*omega
+
+def _shell_index(z, zedges):
+    '''Shell number of each redshift (clipped to the first and last shell).'''
+    nrb = len(zedges) - 1
+    index = np.floor(nrb*(np.asarray(z)-zedges[0])/(zedges[-1]-zedges[0])).astype(int)
+    return np.clip(index, 0, nrb-1)
+
+def calc_nbar(z, zmin, zmax, area=1.0, nrb=200):
+    '''Number density n(z) [(h/Mpc)^3] in redshift shells, from the redshifts of
+    the data.  Returns the shell edges and n(z) in each shell.
+
+    '''
+    zedges, vol = redshift_shells(zmin, zmax, area, nrb)
+    counts = np.bincount(_shell_index(z, zedges), minlength=nrb)
+    return zedges, counts/vol
+
+def calc_fkp_weights(z, zmin, zmax, area=1.0, nbar=None, P0=20000.0):
+    '''Compute the FKP statistical weights, 1/(1+n(z)*P0).
+
+    nbar is the (zedges, n(z)) pair from calc_nbar.  Pass the one measured from
+    the data when weighting the randoms, so that the data and every random
+    catalog share the same n(z); if it is not given, n(z) is measured from z
+    itself.
+
+    '''
+    if nbar is None:
+        nbar = calc_nbar(z, zmin, zmax, area)
+    zedges, nz = nbar
+    return 1/(1+P0*nz[_shell_index(z, zedges)])
+
+def read_ascii_table(filename, ncol):
+    '''Read a whitespace-separated table of ncol numeric columns into an
+    (N, ncol) array.  Plain tables are parsed in one pass with np.fromstring,
+    which is much faster than np.loadtxt.  np.fromstring stops quietly at the
+    first token it cannot parse, so unless it returns ncol values for every
+    line of the file the table is read again with np.loadtxt, which skips
+    comments and raises on bad values.
+
+    '''
+    with open(filename, 'r') as tfile:
+        text = tfile.read()
+    nline = text.count('\n') + (len(text) > 0 and not text.endswith('\n'))
+    table = np.fromstring(text, sep=' ')
+    del text
+    if table.size != nline*ncol or table.size == 0:
+        table = np.loadtxt(filename, ndmin=2)
+        if table.shape[1] != ncol:
+            raise ValueError('Expected {} columns in {} but found {}'.format(
+                ncol, filename, table.shape[1]))
+    return table.reshape(-1, ncol)
+
+def write_cute_ascii(catalog, asciifile, chunksize=100000):
+    '''Write a parsed (N, 4) ra, dec, z, weight catalog as the ASCII file that
+    CUTE reads (input_format=2).  Values are written with 17 significant digits,
+    so nothing is lost, and a whole chunk of rows is formatted at a time.
+
+    '''
+    ncol = catalog.shape[1]
+    rowfmt = ' '.join(['%.17g']*ncol) + '\n'
+    with open(asciifile, 'w') as afile:
+        for lo in range(0, len(catalog), chunksize):
+            chunk = np.asarray(catalog[lo:lo+chunksize])
+            afile.write((rowfmt*len(chunk)) % tuple(chunk.ravel()))
+
+def _newer(file1, file2):
+    '''True if file1 exists and is at least as recent as file2.'''
+    return os.path.isfile(file1) and os.path.getmtime(file1) >= os.path.getmtime(file2)
+
+def cute_ascii(npyfile):
+    '''Return the ASCII version (.dat) of a parsed .npy catalog for CUTE,
+    converting it first if it is missing or older than the .npy file.
+
+    '''
+    asciifile = os.path.splitext(npyfile)[0] + '.dat'
+    if not _newer(asciifile, npyfile):
+        log.info('Writing {}'.format(asciifile))
+        write_cute_ascii(np.load(npyfile, mmap_mode='r'), asciifile)
+    return asciifile
+
+def save_corrfile(outfile, table, header=''):
+    '''Write a correlation function table as ASCII (outfile) along with its
+    binary copy (outfile with a .npy extension), which is what load_corrfile
+    reads back.
+
+    '''
+    np.savetxt(outfile, table, header=header)
+    np.save(os.path.splitext(outfile)[0] + '.npy', table)
+
+def load_corrfile(corrfile):
+    '''Read a correlation function table (e.g., a CUTE output file).  The
+    table is read from its binary copy (see save_corrfile), which is made the
+    first time the ASCII file is read and remade if the ASCII file changes.
+
+    '''
+    npyfile = os.path.splitext(corrfile)[0] + '.npy'
+    if _newer(npyfile, corrfile):
+        return np.load(npyfile)
+    table = np.loadtxt(corrfile, ndmin=2)
+    np.save(npyfile, table)
+    return table
+
+def _file_hash(filename, blocksize=2**20):
+    '''SHA1 of the contents of a file.'''
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as ff:
+        for block in iter(lambda: ff.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def reduce_corrfile(corrfile, corrtype):
+    '''Reduce one correlation function to what the QA plots need.
+
+    Returns the radii and the [nell, Nr] multipoles xi_ell(r) (ell=0 for the
+    monopole; 0, 2, and 4 for multipoles and 3D_rm) or, for 3D_ps, the sigma
+    bins and the [Npi, Nsigma] xi(pi, sigma) grid.
+
+    '''
+    table = load_corrfile(corrfile)
+    if corrtype == 'monopole':
+        return table[:, 0], table[:, 1][np.newaxis, :]
+    elif corrtype == 'multipoles':
+        return table[:, 0], table[:, 1:4].T
+    elif corrtype == '3D_rm':
+        return xi_multipoles_rmu(table[:, 0], table[:, 1], table[:, 2])
+    elif corrtype == '3D_ps':
+        return np.unique(table[:, 1]), table[:, 2].reshape(len(np.unique(table[:, 0])), -1)
+    raise ValueError('Unrecognized correlation type {}'.format(corrtype))
+
+def reduce_corrfiles(corrfiles, corrtype, cachefile):
+    '''Reduce a set of correlation functions (see reduce_corrfile) through a
+    cache keyed by the SHA1 of the contents of each file.
+
+    Only the files that are not in the cache yet (new or changed ones) are
+    read and reduced, after which they are added to the cache.  If their bins
+    differ from the cached ones the cache is rebuilt, and if they differ from
+    each other a ValueError is raised.  Returns the radii and an [Nfile, ...]
+    array of the reductions in the order of corrfiles.
+
+    '''
+    def samebins(rad1, rad2):
+        return rad1.shape == rad2.shape and np.allclose(rad1, rad2)
+
+    cache, rad = dict(), None
+    if os.path.isfile(cachefile):
+        cached = np.load(cachefile)
+        rad = cached['rad']
+        cache = dict(zip([str(fhash) for fhash in cached['hash']], cached['values']))
+
+    hashes = [_file_hash(corrfile) for corrfile in corrfiles]
+    missing = [ii for ii, fhash in enumerate(hashes) if fhash not in cache]
+    newrad, newfile = None, None
+    for count, ii in enumerate(missing):
+        if ((count + 1) % 10) == 0:
+            log.info('Reducing correlation function {}/{}'.format(count+1, len(missing)))
+        rad1, cache[hashes[ii]] = reduce_corrfile(corrfiles[ii], corrtype)
+        if newrad is None:
+            newrad, newfile = rad1, corrfiles[ii]
+        elif not samebins(newrad, rad1):
+            raise ValueError('Correlation functions {} and {} have different bins'.format(
+                newfile, corrfiles[ii]))
+
+    if newrad is not None:
+        if rad is not None and not samebins(rad, newrad):
+            log.warning('Binning changed; rebuilding {}'.format(cachefile))
+            if os.path.isfile(cachefile):
+                os.remove(cachefile)
+            return reduce_corrfiles(corrfiles, corrtype, cachefile)
+        rad = newrad
+
+    if len(missing) > 0:
+        log.info('Writing {} ({} new correlation functions)'.format(cachefile, len(missing)))
+        keys = sorted(cache)
+        np.savez(cachefile, hash=np.array(keys), rad=rad,
+                 values=np.array([cache[fhash] for fhash in keys]))
+    else:
+        log.info('Read {} reduced correlation functions from {}'.format(len(hashes), cachefile))
+
+    return rad, np.array([cache[fhash] for fhash in hashes])
 
 def _dr11_cmass_north_zminmax():
     '''Return minimum and maximum redshifts and the survey area (deg^2).'''
@@ -106,37 +350,78 @@ def _literature(author='anderson', sample='dr11_cmass_north'):
         else:
             log.warning('Published correlation function {} not found!'.format(litfile))
 
+def _read_speczcat(sample='dr11_cmass_north'):
+    '''Read the spectroscopic redshift catalog of a sample, within its redshift
+    range (or return None if it is missing).
+
+    '''
+    sampledir = os.path.join(os.getenv('LSS_CUTE'), sample)
+    zmin, zmax, area = _dr11_cmass_north_zminmax()
+
+    speczfile = os.path.join(sampledir, 'galaxy_DR11v1_CMASS_North.fits.gz')
+    if not os.path.isfile(speczfile):
+        log.fatal('Spectroscopic redshift catalog {} not found!'.format(speczfile))
+        return None
+
+    log.info('Reading {}.'.format(speczfile))
+    allspecz = fits.getdata(speczfile, 1)
+    keep = np.where((allspecz['Z'] > zmin) * (allspecz['Z'] < zmax))[0]
+    return allspecz[keep]
+
+def _sample_nbar(sample='dr11_cmass_north', specz=None, clobber=False):
+    '''Return the n(z) of the spectroscopic sample (see calc_nbar), which is
+    shared by the data and every random catalog.  It is written to
+    cutefiles/{sample}_nbar.dat the first time and read back after that.
+
+    '''
+    sampledir = os.path.join(os.getenv('LSS_CUTE'), sample)
+    nbarfile = os.path.join(sampledir, 'cutefiles', '{}_nbar.dat'.format(sample))
+
+    if os.path.isfile(nbarfile) and not clobber:
+        zlo, zhi, nz = np.loadtxt(nbarfile, unpack=True)
+        return np.append(zlo, zhi[-1]), nz
+
+    if specz is None:
+        specz = _read_speczcat(sample)
+        if specz is None:
+            return None
+
+    zmin, zmax, area = _dr11_cmass_north_zminmax()
+    zedges, nz = calc_nbar(specz['Z'], zmin, zmax, area)
+    log.info('Writing {}'.format(nbarfile))
+    np.savetxt(nbarfile, np.vstack((zedges[:-1], zedges[1:], nz)).T, header='zlo zhi nbar')
+    return zedges, nz
+
 def _parse_speczcat(sample='dr11_cmass_north', clobber=False):
-    '''Parse the spectroscopic redshift catalog for a give sample.'''
+    '''Parse the spectroscopic redshift catalog for a give sample into an
+    (N, 4) ra, dec, z, weight array, saved as a .npy file (see cute_ascii for
+    the ASCII file CUTE reads).
+
+    '''
 
     sampledir = os.path.join(os.getenv('LSS_CUTE'), sample)
 
     if sample == 'dr11_cmass_north':
         zmin, zmax, area = _dr11_cmass_north_zminmax()
-        datafile = os.path.join(sampledir, 'cutefiles', '{}_specz.dat'.format(sample))
+        datafile = os.path.join(sampledir, 'cutefiles', '{}_specz.npy'.format(sample))
         
         if not os.path.isfile(datafile) or clobber:
 
-            speczfile = os.path.join(sampledir, 'galaxy_DR11v1_CMASS_North.fits.gz')
-            if not os.path.isfile(speczfile):
-                log.fatal('Spectroscopic redshift catalog {} not found!'.format(speczfile))
+            specz = _read_speczcat(sample)
+            if specz is None:
                 return 0
 
-            log.info('Reading {}.'.format(speczfile))
-            allspecz = fits.getdata(speczfile, 1)
-            keep = np.where((allspecz['Z'] > zmin) * (allspecz['Z'] < zmax))[0]
-            specz = allspecz[keep]
-
             log.info('Calculating FKP weights.')
-            fkp = calc_fkp_weights(specz['Z'], zmin, zmax, area)
-            data = np.zeros((len(keep), 4))
+            nbar = _sample_nbar(sample, specz=specz, clobber=True)
+            fkp = calc_fkp_weights(specz['Z'], zmin, zmax, area, nbar=nbar)
+            data = np.zeros((len(specz), 4))
             data[:, 0] = specz['RA']
             data[:, 1] = specz['DEC']
             data[:, 2] = specz['Z']
             data[:, 3] = fkp*specz['WEIGHT_SYSTOT']*(specz['WEIGHT_NOZ']+specz['WEIGHT_CP']-1)
             
             log.info('Writing {}'.format(datafile))
-            np.savetxt(datafile, data)
+            np.save(datafile, data)
             
         return datafile
     
@@ -144,10 +429,13 @@ def _parse_speczcat(sample='dr11_cmass_north', clobber=False):
         log.fatal('Unrecognized sample {}.'.format(sample))
         return 0
 
-def _parse_randomcat(sample='dr11_cmass_north', infile=None, outfile=None, clobber=False):
+def _parse_randomcat(sample='dr11_cmass_north', infile=None, outfile=None, clobber=False,
+                     nbar=None):
     '''Parse a given random catalog.
 
-    infile/outfile can both be arrays.
+    infile/outfile can both be arrays.  The FKP weights use the n(z) of the data
+    (nbar, see _sample_nbar), which is read in if it is not given.  The parsed
+    catalog is saved as a .npy file, like the data (see _parse_speczcat).
 
     '''
     if infile is None or outfile is None:
@@ -159,7 +447,7 @@ def _parse_randomcat(sample='dr11_cmass_north', infile=None, outfile=None, clobb
         for infile1, outfile1 in zip([infile], [outfile]):
             if not os.path.isfile(outfile1) or clobber:
                 log.info('Reading {}'.format(infile1))
-                ra, dec, z, ipoly, wboss, wcp, wzf, veto = np.loadtxt(infile1, unpack=True)
+                ra, dec, z, ipoly, wboss, wcp, wzf, veto = read_ascii_table(infile1, 8).T
 
                 keep = np.where(veto == 1)[0]
                 rand = np.zeros((len(keep), 4))
@@ -167,18 +455,168 @@ def _parse_randomcat(sample='dr11_cmass_north', infile=None, outfile=None, clobb
                 rand[:, 1] = dec[keep]
                 rand[:, 2] = z[keep]
 
-                #log.info('  Calculating FKP weights.')
-                randfkp = calc_fkp_weights(rand[:, 2], zmin, zmax, area)
+                if nbar is None:
+                    nbar = _sample_nbar(sample)
+                    if nbar is None:
+                        return 0
+                randfkp = calc_fkp_weights(rand[:, 2], zmin, zmax, area, nbar=nbar)
                 rand[:, 3] = randfkp * (wcp[keep]+wzf[keep]-1)
 
                 log.info('Writing {}'.format(outfile1))
-                np.savetxt(outfile1, rand)
+                np.save(outfile1, rand)
                 return 1
 
     else:
         log.fatal('Unrecognized sample {}.'.format(sample))
         return 0
 
+def _write_cute_param(paramfile, params):
+    '''Write a CUTE parameter file from a list of (keyword, value) pairs.'''
+    pfile = open(paramfile, 'w')
+    for keyword, value in params:
+        pfile.write('{}= {}\n'.format(keyword, value))
+    pfile.close()
+
+# Arrays shared by all the random-catalog jobs of a run (the data and, for the
+# multipoles, the data-data counts), set once per worker process.
+_shared = dict()
+
+def _init_random_jobs(shared):
+    '''Set the arrays shared by the random-catalog jobs (pool initializer).'''
+    _shared.clear()
+    _shared.update(shared)
+
+def _completed(outfile):
+    return os.path.isfile(outfile) and os.path.getsize(outfile) > 0
+
+def _random_job(job):
+    '''Process one random catalog: parse it, then run CUTE on it with its own
+    parameter file (or, for the multipoles, count the data-random and
+    random-random pairs).  Everything it logs, including the CUTE output, goes
+    to the log file of the job.
+
+    Jobs whose correlation function already exists are skipped unless clobber
+    is set.  Returns a dictionary with the status ('done', 'skipped', or
+    'failed') and wall time of the job.
+
+    '''
+    result = dict(index=job['index'], outfile=job['outfile'], logfile=job['logfile'],
+                  status='skipped', time=0.0)
+    if _completed(job['outfile']) and not job['clobber']:
+        return result
+
+    t0 = time.time()
+    handler = logging.FileHandler(job['logfile'], mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    log.addHandler(handler)
+    try:
+        check = _parse_randomcat(job['sample'], infile=job['randomfile'], outfile=job['randfile'],
+                                 clobber=job['clobber'], nbar=_shared['nbar'])
+        if check == 0:
+            raise IOError('Unable to parse random catalog {}'.format(job['randomfile']))
+
+        if job['corrtype'] == 'multipoles':
+            _random_multipoles(job)
+        else:
+            # CUTE only reads ASCII catalogs.
+            params = [('data_filename', _shared['speczascii']),
+                      ('random_filename', cute_ascii(job['randfile'])),
+                      ('mask_filename', 'junk'),
+                      ('z_dist_filename', 'junk'),
+                      ('output_filename', job['outfile'])] + job['cuteparams']
+            _write_cute_param(job['paramfile'], params)
+
+            # Run CUTE, passing the parameter file of this job.
+            log.info('Running CUTE {}'.format(job['paramfile']))
+            handler.flush()
+            with open(job['logfile'], 'a') as cutelog:
+                retcode = subprocess.call(['CUTE', job['paramfile']], stdout=cutelog,
+                                          stderr=subprocess.STDOUT)
+            if retcode != 0:
+                raise RuntimeError('CUTE exited with status {}'.format(retcode))
+
+        if not _completed(job['outfile']):
+            raise IOError('Output file {} was not written'.format(job['outfile']))
+        result['status'] = 'done'
+    except Exception as err:
+        log.error('Random catalog {} failed: {}'.format(job['randomfile'], err))
+        result['status'] = 'failed'
+    finally:
+        log.removeHandler(handler)
+        handler.close()
+
+    result['time'] = time.time() - t0
+    return result
+
+def _random_multipoles(job):
+    '''Write the multipoles of the data against one random catalog.'''
+    xyzdata, wdata, DD = _shared['xyzdata'], _shared['wdata'], _shared['DD']
+    rmax, nrbin, maxpairs = job['dim1_max'], job['dim1_nbin'], job['maxpairs']
+
+    log.info('Counting data-random and random-random pairs.')
+    ra, dec, zz, wrand = np.load(job['randfile']).T
+    xyzrand = radecz2xyz(ra, dec, zz, job['omega_M'], job['w'])
+    DR = paircount_multipoles(xyzdata, wdata, xyzrand, wrand, rmax=rmax, nrbin=nrbin,
+                              maxpairs=maxpairs)
+    RR = paircount_multipoles(xyzrand, wrand, rmax=rmax, nrbin=nrbin, maxpairs=maxpairs)
+    xiell = xi_multipoles(DD, DR, RR, pairweight_norm(wdata),
+                          pairweight_norm(wdata, wrand), pairweight_norm(wrand))
+
+    rad = (np.arange(nrbin) + 0.5) * rmax / nrbin
+    log.info('Writing {}'.format(job['outfile']))
+    save_corrfile(job['outfile'], np.vstack((rad, xiell, DD[0, :], DR[0, :], RR[0, :])).T,
+                  header='r xi0 xi2 xi4 DD DR RR')
+
+def run_random_jobs(jobs, shared, nproc=1):
+    '''Run the random-catalog jobs (see _random_job) on a pool of nproc worker
+    processes (nproc=1 runs them in turn in this process) and return their
+    results in job order.
+
+    '''
+    nproc = max(1, min(nproc, len(jobs)))
+    results = []
+    if nproc == 1:
+        _init_random_jobs(shared)
+        for job in jobs:
+            results.append(_random_job(job))
+            log.info('Random catalog {:05d}: {}'.format(job['index'], results[-1]['status']))
+    else:
+        pool = multiprocessing.Pool(nproc, initializer=_init_random_jobs, initargs=(shared,))
+        try:
+            for result in pool.imap_unordered(_random_job, jobs):
+                results.append(result)
+                log.info('Random catalog {:05d}: {} ({}/{})'.format(
+                    result['index'], result['status'], len(results), len(jobs)))
+        finally:
+            pool.close()
+            pool.join()
+    return sorted(results, key=lambda result: result['index'])
+
+def summarize_random_jobs(results, walltime, summaryfile=None):
+    '''Log (and optionally write) a summary of the random-catalog jobs.  Returns
+    the number of failed jobs.
+
+    '''
+    status = [result['status'] for result in results]
+    jobtime = np.sum([result['time'] for result in results])
+    log.info('{} random catalogs: {} done, {} skipped, {} failed in {:.1f} s '
+             '({:.1f} s of job time).'.format(len(results), status.count('done'),
+                                               status.count('skipped'),
+                                               status.count('failed'), walltime, jobtime))
+    for result in results:
+        if result['status'] == 'failed':
+            log.warning('  Random catalog {:05d} failed; see {}'.format(result['index'],
+                                                                       result['logfile']))
+
+    if summaryfile is not None:
+        with open(summaryfile, 'w') as sfile:
+            sfile.write('# index status time outfile logfile\n')
+            for result in results:
+                sfile.write('{:05d} {} {:.2f} {} {}\n'.format(result['index'], result['status'],
+                                                              result['time'], result['outfile'],
+                                                              result['logfile']))
+    return status.count('failed')
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -186,11 +624,13 @@ def main():
     parser.add_argument('--sample', type=str, default='dr11_cmass_north', help='Dataset to use (currently only dr11_cmass_north is supported).')
     parser.add_argument('--omegaM', type=float, default='0.3', help='Omega_matter (note: Omega_Lambda = 1-Omega_Matter)')
     parser.add_argument('--w', type=float, default='-1.0', help='w parameter (choose w=-1.0 for cosmological constant)')
-    parser.add_argument('--corrtype', type=str, default='monopole', help='Specify correlation type (monopole|3D_ps|3D_rm).')
+    parser.add_argument('--corrtype', type=str, default='monopole', help='Specify correlation type (monopole|3D_ps|3D_rm|multipoles).')
     parser.add_argument('--nrandom', type=str, default='all', help='Number of random catalogs to use (integer number|all)')
-    parser.add_argument('--docute', action='store_true', help='Generate the individual correlation functions using CUTE.')
+    parser.add_argument('--docute', action='store_true', help='Generate the individual correlation functions using CUTE (or, for multipoles, the built-in pair counter).')
     parser.add_argument('--qaplots', action='store_true', help='Generate QAplots.')
-    parser.add_argument('--clobber', action='store_true', help='Regenerate the parsed data/random files, even if they exist.')
+    parser.add_argument('--clobber', action='store_true', help='Regenerate the parsed data/random files and the correlation functions, even if they exist.')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of random catalogs to process at the same time with --docute (0 to use all the cores).')
+    parser.add_argument('--maxpairs', type=int, default=1000000, help='Most pairs held in memory at once by each multipoles pair count.')
 
     args = parser.parse_args()
     if len(sys.argv) == 1:
@@ -253,6 +693,10 @@ def main():
         dim1_nbin = 150  # number of "r" bins
         dim2_max = 1     # maximum "mu" value [Mpc]
         dim2_nbin = 20   # number of "mu" bins
+    elif args.corrtype == 'multipoles':
+        # Computed in-process (no CUTE) with Legendre-weighted pair counts.
+        dim1_max = 150  # maximum "r" value [Mpc]
+        dim1_nbin = 75  # number of "r" bins
     else:
         log.fatal('Unrecognized or unsupported correlation type {}'.format(args.corrtype))
         return 0
@@ -276,58 +720,75 @@ def main():
         if type(speczfile) == int:
             return
 
-        # Call CUTE using each random catalog in turn, optionally restricting to
-        # a smaller number of random catalogs.
-        allrandomfile = glob(os.path.join(randomdir, '*'))
+        # Call CUTE using each random catalog, optionally restricting to a
+        # smaller number of random catalogs.  The catalogs are sorted so that
+        # each one keeps its index (and output files) from run to run.
+        allrandomfile = sorted(glob(os.path.join(randomdir, '*')))
         if len(allrandomfile) == 0:
             log.fatal('No random catalogs in {} found!'.format(randomdir))
             return 0
         if args.nrandom != 'all':
             allrandomfile = allrandomfile[:int(args.nrandom)]
 
+        # The random catalogs are weighted with the n(z) of the data.
+        nbar = _sample_nbar(sample)
+        if nbar is None:
+            return 0
+        shared = dict(nbar=nbar, speczfile=speczfile)
+
+        if args.corrtype == 'multipoles':
+            # The data-data counts are the same for every random catalog.
+            log.info('Counting data-data pairs.')
+            ra, dec, zz, wdata = np.load(speczfile).T
+            xyzdata = radecz2xyz(ra, dec, zz, omega_M, ww)
+            DD = paircount_multipoles(xyzdata, wdata, rmax=dim1_max, nrbin=dim1_nbin,
+                                      maxpairs=args.maxpairs)
+            shared.update(xyzdata=xyzdata, wdata=wdata, DD=DD)
+            cuteparams = []
+        else:
+            shared.update(speczascii=cute_ascii(speczfile))
+            cuteparams = [('corr_type', args.corrtype),
+                          ('num_lines', 'all'),
+                          ('corr_estimator', 'LS'),
+                          ('input_format', 2),
+                          ('np_rand_fact', 1),
+                          ('omega_M', omega_M),
+                          ('omega_L', omega_L),
+                          ('w', ww),
+                          ('radial_aperture', 1), # [degrees]
+                          ('use_pm', 0),
+                          ('n_pix_sph', 2048),
+                          ('log_bin', log_bin),
+                          ('n_logint', n_logint),
+                          ('dim1_max', dim1_max),
+                          ('dim1_nbin', dim1_nbin),
+                          ('dim2_max', dim2_max),
+                          ('dim2_nbin', dim2_nbin),
+                          ('dim3_min', zmin),
+                          ('dim3_max', zmax),
+                          ('dim3_nbin', 1)]
+
+        # One job per random catalog, each with its own parameter and log file.
+        jobs = []
         for ii, randomfile in enumerate(allrandomfile):
-
-            randfile = os.path.join(cutefiledir, '{}_{:05d}.dat'.format(sample, ii+1))
-            check = _parse_randomcat(infile=randomfile, outfile=randfile, clobber=args.clobber)
-            if check == 0:
-                return
-            
-            # Correlation function output file name.
-            outfile = os.path.join(cutefiledir, '{}_{:05d}_{}.dat'.format(sample, ii+1, args.corrtype))
-
-            # Write the CUTE parameter file.
-            paramfile = os.path.join(cutefiledir, '{}.param'.format(sample))
-            
-            pfile = open(paramfile, 'w')
-            pfile.write('data_filename= {}\n'.format(speczfile))
-            pfile.write('random_filename= {}\n'.format(randfile))
-            pfile.write('mask_filename= junk\n')
-            pfile.write('z_dist_filename= junk\n')
-            pfile.write('output_filename= {}\n'.format(outfile))
-            pfile.write('corr_type= {}\n'.format(args.corrtype))
-            pfile.write('num_lines= all\n')
-            pfile.write('corr_estimator= LS\n')
-            pfile.write('input_format= 2\n')
-            pfile.write('np_rand_fact= 1\n')
-            pfile.write('omega_M= {}\n'.format(omega_M))
-            pfile.write('omega_L= {}\n'.format(omega_L))
-            pfile.write('w= {}\n'.format(ww))
-            pfile.write('radial_aperture= 1\n') # [degrees]
-            pfile.write('use_pm= 0\n')
-            pfile.write('n_pix_sph= 2048\n')
-            pfile.write('log_bin= {}\n'.format(log_bin))
-            pfile.write('n_logint= {}\n'.format(n_logint))
-            pfile.write('dim1_max= {}\n'.format(dim1_max))
-            pfile.write('dim1_nbin= {}\n'.format(dim1_nbin))
-            pfile.write('dim2_max= {}\n'.format(dim2_max))
-            pfile.write('dim2_nbin= {}\n'.format(dim2_nbin))
-            pfile.write('dim3_min= {}\n'.format(zmin))
-            pfile.write('dim3_max= {}\n'.format(zmax))
-            pfile.write('dim3_nbin= 1\n')
-            pfile.close()
-
-            # Run CUTE, passing the newly created parameter file
-            os.system('CUTE {}'.format(paramfile))
+            prefix = os.path.join(cutefiledir, '{}_{:05d}'.format(sample, ii+1))
+            jobs.append(dict(index=ii+1, sample=sample, corrtype=args.corrtype,
+                             randomfile=randomfile, randfile=prefix+'.npy',
+                             outfile='{}_{}.dat'.format(prefix, args.corrtype),
+                             paramfile='{}_{}.param'.format(prefix, args.corrtype),
+                             logfile='{}_{}.log'.format(prefix, args.corrtype),
+                             clobber=args.clobber, cuteparams=cuteparams,
+                             omega_M=omega_M, w=ww, dim1_max=dim1_max,
+                             dim1_nbin=dim1_nbin, maxpairs=args.maxpairs))
+
+        nproc = args.nproc if args.nproc > 0 else multiprocessing.cpu_count()
+        log.info('Processing {} random catalogs with {} process(es).'.format(len(jobs), nproc))
+        t0 = time.time()
+        results = run_random_jobs(jobs, shared, nproc=nproc)
+        summaryfile = os.path.join(cutefiledir, '{}_{}_jobs.txt'.format(sample, args.corrtype))
+        nfailed = summarize_random_jobs(results, time.time()-t0, summaryfile=summaryfile)
+        if nfailed > 0:
+            return 0
 
     ##########
     # Generate QAplots.
@@ -335,16 +796,25 @@ def main():
     if args.qaplots:
         log.info('Building {} QAplots.'.format(args.corrtype))
 
-        allcorrfile = glob(os.path.join(cutefiledir, '{}_?????_{}.dat'.format(sample, args.corrtype)))
+        allcorrfile = sorted(glob(os.path.join(cutefiledir, '{}_?????_{}.dat'.format(sample, args.corrtype))))
         ncorr = len(allcorrfile)
+        if ncorr == 0:
+            log.fatal('No {} correlation functions in {} found!'.format(args.corrtype, cutefiledir))
+            return 0
+
+        # Each correlation function is only read and reduced once.
+        cachefile = os.path.join(cutefiledir, '{}_{}_qacache.npz'.format(sample, args.corrtype))
+        rad, allred = reduce_corrfiles(allcorrfile, args.corrtype, cachefile)
+
+        # Covariance of the (stacked) multipoles.
+        if args.corrtype != '3D_ps' and ncorr > 1:
+            xibar, cov = sample_covariance(allred.reshape(ncorr, -1))
+            covfile = os.path.join(qadir, '{}_{}_covariance.npz'.format(sample, args.corrtype))
+            log.info('Writing {}'.format(covfile))
+            np.savez(covfile, rad=rad, xibar=xibar, cov=cov, nmock=ncorr)
 
         if args.corrtype == 'monopole':
-            allxi = np.zeros((ncorr, dim1_nbin))
-            for ii, corrfile in enumerate(allcorrfile):
-                if ((ii + 1) % 10) == 0:
-                    log.info('Reading correlation function {}/{}'.format(ii+1, ncorr))
-                rad, xi, xierr, DD, DR, RR = np.loadtxt(corrfile, unpack=True)
-                allxi[ii, :] = xi
+            allxi = allred[:, 0, :]
 
             # Compare with Anderson+
             andrad, andmono, andquad = _literature(author='anderson', sample=sample)
@@ -366,13 +836,34 @@ def main():
             log.info('Writing {}'.format(qafile))
             plt.savefig(qafile)
 
+        if args.corrtype == 'multipoles':
+            allmono = allred[:, 0, :]
+            allquad = allred[:, 1, :]
+
+            monobar = np.mean(allmono, axis=0)
+            quadbar = np.mean(allquad, axis=0)
+
+            # Compare with Anderson+
+            andrad, andmono, andquad = _literature(author='anderson', sample=sample)
+
+            qafile = os.path.join(qadir, '{}_multipoles.pdf'.format(sample))
+            fig, ax = plt.subplots(figsize=(8, 6))
+            ax.scatter(rad, monobar*rad*rad, label='Siena Average Monopole')
+            ax.scatter(rad, quadbar*rad*rad, marker='^', label='Siena Average Quadrupole')
+            ax.scatter(andrad, andmono*andrad*andrad, marker='s', color='orange', label='Anderson+13 Monopole')
+            ax.scatter(andrad, andquad*andrad*andrad, marker='s', color='red', label='Anderson+13 Quadrupole')
+            ax.set_xlabel(r'$r$ (Mpc / h)')
+            ax.set_ylabel(r'$r^2 \xi_\ell$')
+            ax.legend(loc='upper right', frameon=None)
+            ax.margins(0.05)
+
+            plt.subplots_adjust(bottom=0.15, top=0.88)
+
+            log.info('Writing {}'.format(qafile))
+            plt.savefig(qafile)
+
         if args.corrtype == '3D_ps':
-            allxi = np.zeros((ncorr, dim1_nbin, dim2_nbin))
-            for ii, corrfile in enumerate(allcorrfile):
-                if ((ii + 1) % 10) == 0:
-                    log.info('Reading correlation function {}/{}'.format(ii+1, ncorr))
-                pi, sigma, xi, xierr, DD, DR, RR = np.loadtxt(corrfile, unpack=True)
-                allxi[ii, :, :] = xi.reshape(dim1_nbin, dim2_nbin)
+            allxi = allred
 
             xibar = np.mean(allxi, axis=0)
 
@@ -409,22 +900,10 @@ def main():
             log.info('Writing {}'.format(qafile))
             plt.savefig(qafile)
 
-            pdb.set_trace()
-
         if args.corrtype == '3D_rm':
-            allmono = np.zeros((ncorr, dim1_nbin))
-            allquad = np.zeros((ncorr, dim1_nbin))
-            for ii, corrfile in enumerate(allcorrfile[:10]):
-                if ((ii + 1) % 10) == 0:
-                    log.info('Reading correlation function {}/{}'.format(ii+1, ncorr))
-                mu, rad, xi, xierr, DD, DR, RR = np.loadtxt(corrfile, unpack=True)
-                allmono[ii, :] = compute_monopole(mu, rad, xi)
-                #allquad[ii, :] = compute_quadrapole(mu, rad, xi)
-
-            rad = np.unique(rad)
+            allmono = allred[:, 0, :]
             monobar = np.mean(allmono, axis=0)
             #quadbar = np.mean(allquad, axis=0)
-            #pdb.set_trace()
 
             # Compare with Anderson+
             andrad, andmono, andquad = _literature(author='anderson', sample=sample)
@@ -10,53 +10,74 @@ import glob
 import numpy as np
 import matplotlib.pyplot as plt
 
+from covariance import (mock_matrix, sample_covariance, stream_covariance,
+                        correlation_matrix, precision_matrix, hartlap_factor)
+
 def main():
-    
+
     # argument parsing
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--dr', type=str, default='dr11', help='Specify the SDSS data release.')
-    parser.add_argument('--type', type=str, default='3D_rm', help='Specify the correlation type used.')
+    parser.add_argument('--type', type=str, default='3D_rm', help='Specify the correlation type used (monopole|multipoles|3D_rm|3D_ps).')
     parser.add_argument('--cov', action='store_true', help='Compute the covariace matrix.')
+    parser.add_argument('--ells', type=str, default=None, help='Comma-separated multipoles to stack into the data vector, e.g. 0,2,4 (multipoles and 3D_rm only).')
+    parser.add_argument('--rmax', type=float, default=None, help='Drop the bins beyond this separation [Mpc/h].')
+    parser.add_argument('--chunksize', type=int, default=0, help='Read the mocks this many at a time and update the covariance as they come in (0 to read them all at once).')
+    parser.add_argument('--qaplots', action='store_true', help='Plot the correlation matrix.')
 
     args = parser.parse_args()
+    if not args.cov:
+        parser.print_help()
+        sys.exit(1)
 
     # convenience variables
     datadir = os.path.join(os.getenv('LSS_BOSS'), args.dr, 'cuteout', args.type)
-    corrfiles = glob.glob(os.path.join(datadir, '*_fkp_????.dat'))
+    corrfiles = sorted(glob.glob(os.path.join(datadir, '*_fkp_????.dat')))
     outdir = os.path.join(os.getenv('LSS_BOSS'), args.dr, 'covariance')
-
-    #corrfiles = corrfiles[:20] # testing!
-    thisdimension = len(np.unique(pi))
-    thatdimension = len(np.unique(sig))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
 
     ncorr = len(corrfiles)
+    if ncorr < 2:
+        print('Need at least two correlation functions in {}'.format(datadir))
+        sys.exit(1)
+
+    ells = None
+    if args.ells is not None:
+        ells = [int(ell) for ell in args.ells.split(',')]
+
+    print('Reading {} correlation functions from {}'.format(ncorr, datadir))
+    if args.chunksize > 0:
+        xibar, cov, labels = stream_covariance(corrfiles, args.type, ells, args.rmax,
+                                               chunksize=args.chunksize)
+    else:
+        xi, labels = mock_matrix(corrfiles, args.type, ells, args.rmax)
+        xibar, cov = sample_covariance(xi)
+    corr = correlation_matrix(cov)
+    nbin = len(xibar)
+
+    out = dict(xibar=xibar, cov=cov, corr=corr, labels=labels, nmock=ncorr)
+    try:
+        out['precision'] = precision_matrix(cov, ncorr)
+        out['hartlap'] = hartlap_factor(ncorr, nbin)
+    except ValueError as err:
+        print('Not writing the precision matrix: {}'.format(err))
+
+    outfile = os.path.join(outdir, '{}_{}_covariance.npz'.format(args.dr, args.type))
+    print('Writing {} ({} mocks, {} bins)'.format(outfile, ncorr, nbin))
+    np.savez(outfile, **out)
+
+    if args.qaplots:
+        qafile = os.path.join(outdir, '{}_{}_correlation.pdf'.format(args.dr, args.type))
+        fig, ax = plt.subplots(figsize=(7, 6))
+        im = ax.imshow(corr, origin='lower', vmin=-1, vmax=1, cmap='RdBu_r', interpolation='nearest')
+        fig.colorbar(im, ax=ax)
+        ax.set_xlabel('Bin')
+        ax.set_ylabel('Bin')
+        print('Writing {}'.format(qafile))
+        plt.savefig(qafile)
 
-    xi = np.zeros((ncorr, thisdimension, thatdimension))
-    
-    for ii, cfile in enumerate(corrfiles):
-        print('Reading {}'.format(cfile))
-        data = np.loadtxt(cfile)
-        xi[ii, :] = data[:,2].reshape(thisdimension,thatdimension) # grab xi and reshape
-
-    rad = np.unique(np.loadtxt(cfile)[:,1])
-    mu = np.unique(np.loadtxt(cfile)[:,0])
-    cov = np.zeros((40,40))
-    xibar = np.mean(xi, axis=0)
-
-    xr = 0.025
-    xibar = np.mean(np.mean(xi, axis=2), axis=0)
-    mono1 = xr*np.trapz(xi, axis=1)
-
-    for mm in range(ncorr):
-        for ii in range(0, 75):
-            for jj in range(0, 75):
-                # cov[ii,jj] += (xibar[mm, ii] - xii[ii])*(xibar[mm, jj] - xij[jj])
-                cov[ii,jj] += (xi[mm, ii] - xibar[ii])*(xi[mm, jj] - xibar[jj])
-                
-    cov = cov/(ncorr-1)
-    aa = np.tile(rad[0:40]*rad[0:40], (1, 40)).reshape(40,40)
-                        
 if __name__ == "__main__":
     main()
-    
+
@@ -6,6 +6,8 @@ from mpi4py import MPI
 from nbodykit.lab import *
 from nbodykit import setup_logging
 
+from paircounts import projected_correlation
+
 cosmo = cosmology.Cosmology(h=0.7).match(Omega0_m=0.31)
 datadir = os.path.join(os.getenv('IM_DATA_DIR'), 'sdss', 'dr12')
 
@@ -99,9 +101,15 @@ random['Weight'] = np.ones(len(random))
 pimax = 2
 edges = np.array([0.5, 1, 2, 3])
 
-xi = SurveyData2PCF('projected', data[::100], random[::100], edges, cosmo=cosmo, pimax=pimax,
-                    redshift='Z')#, weight='Weight', show_progress=True)#, **{'nthreads': 4})
-# xi.save()
+# The native (r_p, pi) pair counter is fast enough for the full sample, so no
+# more data[::100] subsampling.
+#xi = SurveyData2PCF('projected', data[::100], random[::100], edges, cosmo=cosmo, pimax=pimax,
+#                    redshift='Z')#, weight='Weight', show_progress=True)#, **{'nthreads': 4})
+rp, wp, counts = projected_correlation(data['Position'].compute(), data['Weight'].compute(),
+                                       random['Position'].compute(), random['Weight'].compute(),
+                                       edges, pimax=pimax, npibin=int(pimax))
+for rr, ww in zip(rp, wp):
+    print('rp = {:.3f}  wp = {:.4f}'.format(rr, ww))
 
 
 #pdb.set_trace()
@@ -0,0 +1,136 @@
+"""Native pair counts in (r_p, pi) and the projected correlation function
+w_p(r_p), as a replacement for nbodykit's SurveyData2PCF('projected', ...)
+that is fast enough to run on the full DR12 CMASS/LOWZ samples.
+
+Positions are comoving Cartesian coordinates (e.g., in Mpc/h) and the line of
+sight of each pair is the direction to its midpoint.
+
+"""
+from __future__ import division, print_function
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+def pairweight_norm(w1, w2=None):
+    '''Total pair weight of an auto- (w2=None) or cross-count.'''
+    if w2 is None:
+        return 0.5*(np.sum(w1)**2 - np.sum(w1*w1))
+    return np.sum(w1)*np.sum(w2)
+
+def paircount_rppi(xyz1, w1, xyz2=None, w2=None, rpbins=None, pimax=40.0,
+                   npibin=40, chunksize=5000, maxpairs=1000000):
+    '''Count weighted pairs in bins of projected (r_p) and line-of-sight (pi)
+    separation, out to |pi| < pimax.
+
+    For the midpoint line of sight |pi| = ||r2|^2 - |r1|^2| / |r1 + r2| is never
+    smaller than ||r2| - |r1||, so both catalogs are sorted by distance and each
+    chunk of the first is only compared with the shell of the second within
+    pimax of it.  Within that shell the kd-trees are walked out to
+    sqrt(rpmax^2 + pimax^2), so the pi cut prunes both the radial range and the
+    tree traversal before any pair is looked at.
+
+    The pairs of a chunk are counted before they are gathered, and a chunk
+    with more than maxpairs of them is split in two until it has fewer (or is
+    a single point), so the memory used does not grow with the density of
+    the catalogs.
+
+    Pass only xyz1 and w1 for an auto-count (DD or RR), in which case each pair
+    is counted once.  rpbins are the r_p bin edges (any spacing) and the pi
+    bins are npibin linear bins between 0 and pimax.  Returns a
+    [len(rpbins)-1, npibin] array.
+
+    '''
+    auto = xyz2 is None
+    if auto:
+        xyz2, w2 = xyz1, w1
+    rpbins = np.asarray(rpbins, dtype='f8')
+    nrpbin = len(rpbins) - 1
+    smax = np.hypot(rpbins[-1], pimax)
+
+    dist1 = np.sqrt(np.sum(xyz1*xyz1, axis=1))
+    dist2 = np.sqrt(np.sum(xyz2*xyz2, axis=1))
+    order1 = np.argsort(dist1)
+    order2 = np.argsort(dist2)
+    sorted2 = dist2[order2]
+
+    counts = np.zeros(nrpbin*npibin)
+    todo = [(lo, min(lo+chunksize, len(xyz1))) for lo in range(0, len(xyz1), chunksize)]
+    while todo:
+        lo, hi = todo.pop()
+        idx1 = order1[lo:hi]
+        jlo = np.searchsorted(sorted2, dist1[idx1[0]] - pimax, side='left')
+        jhi = np.searchsorted(sorted2, dist1[idx1[-1]] + pimax, side='right')
+        idx2 = order2[jlo:jhi]
+        if len(idx2) == 0:
+            continue
+
+        tree1 = cKDTree(xyz1[idx1])
+        tree2 = cKDTree(xyz2[idx2])
+        if hi - lo > 1 and tree1.count_neighbors(tree2, smax) > maxpairs:
+            mid = (lo + hi) // 2
+            todo.extend([(lo, mid), (mid, hi)])
+            continue
+
+        pairs = tree1.sparse_distance_matrix(tree2, smax, output_type='ndarray')
+        ii, jj, rr = idx1[pairs['i']], idx2[pairs['j']], pairs['v']
+        del pairs
+        keep = rr > 0
+        if auto:
+            keep &= jj > ii
+        ii, jj, rr = ii[keep], jj[keep], rr[keep]
+
+        los = xyz1[ii] + xyz2[jj]
+        pi = np.abs(np.sum((xyz2[jj] - xyz1[ii]) * los, axis=1)) / np.sqrt(np.sum(los*los, axis=1))
+        del los
+        rp = np.sqrt(np.maximum(rr*rr - pi*pi, 0))
+
+        irp = np.searchsorted(rpbins, rp, side='right') - 1
+        ipi = (pi * npibin / pimax).astype(int)
+        keep = (irp >= 0) & (irp < nrpbin) & (ipi < npibin)
+        counts += np.bincount(irp[keep]*npibin + ipi[keep],
+                              weights=w1[ii[keep]] * w2[jj[keep]],
+                              minlength=nrpbin*npibin)
+
+    return counts.reshape(nrpbin, npibin)
+
+def wp_from_counts(DD, DR, RR, normDD, normDR, normRR, pimax=40.0):
+    '''Landy-Szalay xi(r_p, pi) from the (r_p, pi) pair counts, and the projected
+    correlation function w_p(r_p) = 2 * int_0^pimax xi(r_p, pi) dpi.
+
+    Bins with no random pairs are set to zero.
+
+    '''
+    dd, dr, rr = DD/normDD, DR/normDR, RR/normRR
+    xi = (dd - 2*dr + rr) / (rr + (rr == 0)) * (rr != 0)
+    dpi = pimax / DD.shape[1]
+    return 2 * np.sum(xi, axis=1) * dpi, xi
+
+def projected_correlation(data_xyz, data_w, rand_xyz, rand_w, rpbins,
+                          pimax=40.0, npibin=40, chunksize=5000, maxpairs=1000000):
+    '''Projected correlation function w_p(r_p) of a data and random catalog.
+
+    Returns the r_p bin centers (geometric means of the edges), w_p(r_p), and a
+    dictionary with the DD, DR, and RR counts and their normalizations.
+
+    '''
+    rpbins = np.asarray(rpbins, dtype='f8')
+    kwargs = dict(rpbins=rpbins, pimax=pimax, npibin=npibin, chunksize=chunksize,
+                  maxpairs=maxpairs)
+
+    counts = dict()
+    counts['DD'] = paircount_rppi(data_xyz, data_w, **kwargs)
+    counts['DR'] = paircount_rppi(data_xyz, data_w, rand_xyz, rand_w, **kwargs)
+    counts['RR'] = paircount_rppi(rand_xyz, rand_w, **kwargs)
+    counts['normDD'] = pairweight_norm(data_w)
+    counts['normDR'] = pairweight_norm(data_w, rand_w)
+    counts['normRR'] = pairweight_norm(rand_w)
+
+    wp, xi = wp_from_counts(counts['DD'], counts['DR'], counts['RR'], counts['normDD'],
+                            counts['normDR'], counts['normRR'], pimax=pimax)
+    counts['xi'] = xi
+
+    rp = np.sqrt(rpbins[1:] * rpbins[:-1])
+    if rpbins[0] <= 0:
+        rp = 0.5 * (rpbins[1:] + rpbins[:-1])
+
+    return rp, wp, counts
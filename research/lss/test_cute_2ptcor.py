@@ -0,0 +1,92 @@
+"""Check the in-process pair counts of cute-2ptcor.py against brute-force
+histograms of every pair.
+
+Run with pytest or as a script.
+
+"""
+from __future__ import division, print_function
+
+import os
+import imp
+import tempfile
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+cute = imp.load_source('cute_2ptcor', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                   'cute-2ptcor.py'))
+
+RMAX = 20.0
+NRBIN = 10
+
+def _catalog(n, rng):
+    '''A small patch of sky at 600-700 Mpc/h, dense enough to have pairs in
+    every bin.
+
+    '''
+    ra = rng.uniform(0, 0.08, n)
+    dec = rng.uniform(0, 0.08, n)
+    dist = rng.uniform(600, 700, n)
+    xyz = np.vstack((dist*np.cos(dec)*np.cos(ra), dist*np.cos(dec)*np.sin(ra),
+                     dist*np.sin(dec))).T
+    return xyz, rng.uniform(0.5, 1.5, n)
+
+def _brute_multipoles(xyz1, w1, xyz2=None, w2=None):
+    auto = xyz2 is None
+    if auto:
+        xyz2, w2 = xyz1, w1
+    sep = xyz2[np.newaxis, :, :] - xyz1[:, np.newaxis, :]
+    los = xyz2[np.newaxis, :, :] + xyz1[:, np.newaxis, :]
+    rr = np.sqrt(np.sum(sep*sep, axis=2))
+    keep = (rr > 0) & (rr <= RMAX)
+    if auto:
+        keep = np.triu(keep, 1)
+    rr, sep, los = rr[keep], sep[keep], los[keep]
+    mu = np.abs(np.sum(sep*los, axis=1)) / (rr*np.sqrt(np.sum(los*los, axis=1)))
+    weight = np.outer(w1, w2)[keep]
+    rbins = np.linspace(0, RMAX, NRBIN+1)
+    return np.array([np.histogram(rr, bins=rbins, weights=weight*ell)[0]
+                     for ell in cute.legendre_even(mu)])
+
+def test_paircount_multipoles():
+    rng = np.random.RandomState(3)
+    xyz1, w1 = _catalog(500, rng)
+    xyz2, w2 = _catalog(700, rng)
+    kwargs = dict(rmax=RMAX, nrbin=NRBIN)
+
+    for args in [(xyz1, w1), (xyz1, w1, xyz2, w2)]:
+        brute = _brute_multipoles(*args)
+        assert brute[0].sum() > 0
+        # One chunk, several chunks, and chunks split down to bound the pairs.
+        for chunksize, maxpairs in [(10000, 10**8), (97, 10**8), (10000, 500)]:
+            counts = cute.paircount_multipoles(*args, chunksize=chunksize, maxpairs=maxpairs,
+                                               **kwargs)
+            assert np.allclose(counts, brute, rtol=1e-12, atol=1e-9)
+
+def test_read_ascii_table():
+    rows = np.arange(12.0).reshape(4, 3)
+    plain = ''.join('{} {} {}\n'.format(*row) for row in rows)
+    # A comment on a row boundary used to cut the table short.
+    commented = plain.replace('3.0 4.0', '# comment\n3.0 4.0')
+    tmpdir = tempfile.mkdtemp()
+    for ii, text in enumerate([plain, plain.rstrip(), commented]):
+        tfile = os.path.join(tmpdir, '{}.dat'.format(ii))
+        with open(tfile, 'w') as ff:
+            ff.write(text)
+        assert np.array_equal(cute.read_ascii_table(tfile, 3), rows)
+
+    tfile = os.path.join(tmpdir, 'bad.dat')
+    with open(tfile, 'w') as ff:
+        ff.write(plain.replace('6.0', 'nope'))
+    try:
+        cute.read_ascii_table(tfile, 3)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('A bad value was not caught')
+
+if __name__ == '__main__':
+    test_paircount_multipoles()
+    test_read_ascii_table()
+    print('cute-2ptcor.py matches the brute-force pair counts')
@@ -0,0 +1,72 @@
+"""Check paircounts.py against brute-force histograms of every pair.
+
+Run with pytest or as a script.
+
+"""
+from __future__ import division, print_function
+
+import numpy as np
+
+from paircounts import paircount_rppi, projected_correlation
+
+RPBINS = np.logspace(-0.5, 1.5, 9)
+PIMAX = 20.0
+NPIBIN = 10
+
+def _catalog(n, rng):
+    '''A small patch of sky at 600-700 Mpc/h, dense enough to have pairs in
+    every bin.
+
+    '''
+    ra = rng.uniform(0, 0.08, n)
+    dec = rng.uniform(0, 0.08, n)
+    dist = rng.uniform(600, 700, n)
+    xyz = np.vstack((dist*np.cos(dec)*np.cos(ra), dist*np.cos(dec)*np.sin(ra),
+                     dist*np.sin(dec))).T
+    return xyz, rng.uniform(0.5, 1.5, n)
+
+def _brute_rppi(xyz1, w1, xyz2=None, w2=None):
+    auto = xyz2 is None
+    if auto:
+        xyz2, w2 = xyz1, w1
+    sep = xyz2[np.newaxis, :, :] - xyz1[:, np.newaxis, :]
+    los = xyz2[np.newaxis, :, :] + xyz1[:, np.newaxis, :]
+    pi = np.abs(np.sum(sep*los, axis=2)) / np.sqrt(np.sum(los*los, axis=2))
+    rp = np.sqrt(np.maximum(np.sum(sep*sep, axis=2) - pi*pi, 0))
+    weight = np.outer(w1, w2)
+    keep = np.ones(pi.shape, bool)
+    if auto:
+        keep = np.triu(keep, 1)
+    pibins = np.linspace(0, PIMAX, NPIBIN+1)
+    return np.histogram2d(rp[keep], pi[keep], bins=(RPBINS, pibins), weights=weight[keep])[0]
+
+def test_paircount_rppi():
+    rng = np.random.RandomState(1)
+    xyz1, w1 = _catalog(600, rng)
+    xyz2, w2 = _catalog(800, rng)
+    kwargs = dict(rpbins=RPBINS, pimax=PIMAX, npibin=NPIBIN)
+
+    for args in [(xyz1, w1), (xyz1, w1, xyz2, w2)]:
+        brute = _brute_rppi(*args)
+        assert brute.sum() > 0
+        # One chunk, several chunks, and chunks split down to bound the pairs.
+        for chunksize, maxpairs in [(10000, 10**8), (97, 10**8), (10000, 500)]:
+            counts = paircount_rppi(*args, chunksize=chunksize, maxpairs=maxpairs, **kwargs)
+            assert np.allclose(counts, brute, rtol=1e-12, atol=1e-9)
+
+def test_projected_correlation():
+    rng = np.random.RandomState(2)
+    data_xyz, data_w = _catalog(300, rng)
+    rand_xyz, rand_w = _catalog(900, rng)
+    rp, wp, counts = projected_correlation(data_xyz, data_w, rand_xyz, rand_w, RPBINS,
+                                           pimax=PIMAX, npibin=NPIBIN)
+    assert np.allclose(counts['DD'], _brute_rppi(data_xyz, data_w))
+    assert np.allclose(counts['DR'], _brute_rppi(data_xyz, data_w, rand_xyz, rand_w))
+    assert np.allclose(counts['RR'], _brute_rppi(rand_xyz, rand_w))
+    assert np.allclose(rp, np.sqrt(RPBINS[1:]*RPBINS[:-1]))
+    assert wp.shape == (len(RPBINS)-1,)
+
+if __name__ == '__main__':
+    test_paircount_rppi()
+    test_projected_correlation()
+    print('paircounts.py matches the brute-force pair counts')